@@ -0,0 +1,67 @@
+"""
+Benchmark PDF fills per second: copying pages per fill vs. a compiled fill plan.
+
+Run from the backend directory:
+    python benchmark_fill.py [--pdf test_files/sterilization_form.pdf] [--iterations 200]
+"""
+import argparse
+import io
+import time
+
+from PyPDF2 import PdfWriter
+
+import pdf_utils
+
+
+def fill_by_copying_pages(pdf_path, json_data):
+    """The per-fill approach fill_pdf used before fill plans: reparse, copy every page, update fields"""
+    form = pdf_utils._parse_form(pdf_path)  # uncached, as every fill used to reparse
+    field_mapping = pdf_utils.extract_field_mapping(form.text_fields)
+    field_values = pdf_utils.rename_json_keys(json_data, field_mapping)
+
+    writer = PdfWriter()
+    for page in form.reader.pages:
+        writer.add_page(page)
+    writer.update_page_form_field_values(writer.pages[0], field_values)
+
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def fill_with_plan(pdf_path, json_data):
+    return pdf_utils.get_fill_plan(pdf_path).fill(json_data)
+
+
+def sample_values(pdf_path):
+    """Give every text field a value so both approaches do comparable work"""
+    form = pdf_utils.get_parsed_form(pdf_path)
+    return {
+        str(i): f"Value {i}"
+        for i, field in enumerate(form.fields, start=1)
+        if field.field_type == "/Tx"
+    }
+
+
+def run(name, fill, pdf_path, json_data, iterations):
+    fill(pdf_path, json_data)  # warm-up (parses and compiles caches for the plan)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fill(pdf_path, json_data)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<20} {iterations / elapsed:10.1f} fills/sec  ({elapsed / iterations * 1000:.2f} ms/fill)")
+    return iterations / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pdf", default="test_files/sterilization_form.pdf")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    json_data = sample_values(args.pdf)
+    print(f"Filling {len(json_data)} fields in {args.pdf}, {args.iterations} iterations\n")
+
+    baseline = run("copy pages", fill_by_copying_pages, args.pdf, json_data, args.iterations)
+    planned = run("fill plan", fill_with_plan, args.pdf, json_data, args.iterations)
+    print(f"\nSpeedup: {planned / baseline:.1f}x")
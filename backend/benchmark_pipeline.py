@@ -0,0 +1,125 @@
+"""
+Benchmark the generation pipeline offline: chain1 runs and chain2 fills per second.
+
+Every model call goes to the deterministic stub backend (CONFORM_LLM_BACKEND=stub),
+optionally with a simulated latency per call, so no API key or network is
+needed and what is measured is the pipeline's own overhead and how well the
+shared gateway overlaps calls. Checkpoints, caches and outputs go to a
+scratch database and blob store that are deleted afterwards, never conform.db.
+
+Run from the backend directory:
+    python benchmark_pipeline.py [--pdf test_files/sterilization_form.pdf] [--iterations 50]
+                                 [--concurrency 8] [--latency 0.2]
+"""
+import argparse
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def sample_context(patient_id):
+    """Context shaped like fill_template's, different for every patient"""
+    return {
+        "patient": {
+            "name": f"Patient {patient_id}",
+            "dob": "1990-02-03",
+            "address": "",
+            "ethnicity": "",
+            "race": "",
+            "preferred_language": "English",
+            "email": f"patient{patient_id}@example.com",
+            "gender": "",
+            "age": "",
+            "conditions": "",
+            "medications": "",
+        },
+        "doctor": {"name": "Dr Bench", "specialty": "MD", "license": "", "facility": "Bench Health"},
+        "practice": {"name": "Bench Health", "address": "", "phone": ""},
+        "procedure": {"type": "", "date": "2025-01-01", "codes": []},
+    }
+
+
+def run(name, work, iterations, concurrency):
+    """Call work(i) for every iteration on concurrency threads and print the rate"""
+    start = time.perf_counter()
+    # chain1 and chain2 log every step; keep the results table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(work, range(iterations)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {iterations / elapsed:10.1f} runs/sec  ({elapsed / iterations * 1000:.2f} ms/run)")
+    return iterations / elapsed
+
+
+def main(args):
+    scratch = tempfile.mkdtemp(prefix="conform-benchmark-")
+    os.environ.update({
+        "CONFORM_LLM_BACKEND": "stub",
+        "CONFORM_LLM_STUB_LATENCY": str(args.latency),
+        "CONFORM_LLM_MAX_CONCURRENCY": str(args.concurrency),
+        "CONFORM_DB_PATH": os.path.join(scratch, "benchmark.db"),
+        "CONFORM_BLOB_DIR": os.path.join(scratch, "blobs"),
+    })
+
+    # Imported once the environment is set: the gateway, pool and blob store read it at import
+    import pdf_utils
+    from llm import llm_gateway
+    from migrations import migrate_database
+    from chains.chain1 import run_pipeline
+    from chains.chain2 import chain2
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate_database()
+            field_mapping_string = pdf_utils.generate_field_mapping_string(args.pdf)
+        pdf_form = pathlib.Path(args.pdf)
+        print(f"{args.pdf}, {args.iterations} iterations on {args.concurrency} threads, "
+              f"{args.latency:.3f}s simulated latency per model call\n")
+
+        # chain1: a fresh PDF hash per run misses every checkpoint, so each run
+        # makes all three stage calls; reusing one hash resumes from checkpoints
+        run("chain1 (cold)", lambda i: run_pipeline(pdf_form, field_mapping_string, f"benchmark-{i}"),
+            args.iterations, args.concurrency)
+        with contextlib.redirect_stdout(io.StringIO()):
+            template_html = run_pipeline(pdf_form, field_mapping_string, "benchmark-warm")
+        run("chain1 (checkpointed)", lambda i: run_pipeline(pdf_form, field_mapping_string, "benchmark-warm"),
+            args.iterations, args.concurrency)
+
+        # chain2: the first fill learns the template's field mapping; after that
+        # each new patient is a prefill, and refilling one is a cache hit
+        template_path = os.path.join(scratch, "benchmark_template.html")
+        with open(template_path, "w", encoding="utf-8") as f:
+            f.write(template_html)
+
+        def fill(patient_id):
+            success, result = chain2(template_path, sample_context(patient_id), template_html,
+                                     patient_id=patient_id, user_id=1)
+            if not success:
+                raise RuntimeError(result)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            fill(0)
+        run("chain2 (prefill)", lambda i: fill(i + 1), args.iterations, args.concurrency)
+        run("chain2 (cached)", lambda i: fill(i + 1), args.iterations, args.concurrency)
+
+        print("\nModel calls:")
+        for model, counters in llm_gateway.stats()["models"].items():
+            print(f"  {model:<32} {counters['completed']:6d} completed, {counters['failed']} failed")
+    finally:
+        llm_gateway.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pdf", default="test_files/sterilization_form.pdf")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the stub waits per model call, to stand in for generation time")
+    main(parser.parse_args())
@@ -0,0 +1,281 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from precompress import write_variants, fresh_variants, ENCODINGS
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Content-addressed store for generated HTML (overridable from the environment)
+BLOB_DIR = os.getenv("CONFORM_BLOB_DIR", os.path.join(BASE_DIR, "blobs"))
+
+# Garbage collection: how often to sweep the store, and how long an
+# unreferenced blob is kept (so one stored just before its row is committed
+# survives). A non-positive interval disables the background sweep.
+BLOB_GC_INTERVAL = float(os.getenv("CONFORM_BLOB_GC_INTERVAL", str(60 * 60)))
+BLOB_GC_MIN_AGE = float(os.getenv("CONFORM_BLOB_GC_MIN_AGE", str(60 * 60)))
+
+# Every column that refers to a blob. Prefilled forms stop counting once expired.
+REFERENCED_BLOBS_SQL = """
+    SELECT html_hash FROM universal_pdfs WHERE html_hash IS NOT NULL
+    UNION SELECT html_hash FROM html_cache
+    UNION SELECT html_hash FROM filled_output_cache WHERE expires_at > ?
+"""
+
+
+def hash_content(data):
+    """Hex SHA-256 digest used as a blob's address"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path(digest):
+    """Path of a blob on disk, fanned out by the first two hex digits"""
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+
+def put_blob(content):
+    """
+    Store content once under its hash.
+
+    Args:
+        content (str or bytes): The content to store (str is UTF-8 encoded)
+
+    Returns:
+        tuple: (digest, size in bytes)
+    """
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    digest = hash_content(data)
+    path = blob_path(digest)
+
+    try:
+        # Storing an existing blob again renews it for the garbage collector's
+        # age guard. Published blobs are skipped: they share their mtime (and
+        # so their ETag) with every link, and the collector keeps them anyway.
+        if os.stat(path).st_nlink == 1:
+            os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so readers never see a partial blob
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return digest, len(data)
+
+
+def read_blob(digest):
+    """Return a blob's bytes (raises FileNotFoundError if it is missing)"""
+    with open(blob_path(digest), "rb") as f:
+        return f.read()
+
+
+def read_blob_text(digest):
+    """Return a blob decoded as UTF-8, or None for a missing digest"""
+    if not digest:
+        return None
+    return read_blob(digest).decode("utf-8")
+
+
+def link_blob(digest, dest_path):
+    """
+    Publish a blob at dest_path without storing a second copy.
+
+    The file is hard-linked to the blob where the filesystem allows it (and
+    copied otherwise), then renamed into place so it is replaced atomically.
+    Because the link shares the blob's inode, rewriting identical content
+    leaves its mtime (and so its ETag) unchanged.
+    """
+    source = blob_path(digest)
+    try:
+        # Already published; renaming a link onto itself is a no-op that
+        # would leave the temp link behind
+        if os.path.samefile(source, dest_path):
+            return
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f"{dest_path}.tmp-{uuid.uuid4().hex}"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def publish_blob(digest, dest_path):
+    """
+    Publish a blob at dest_path together with its compressed variants.
+
+    The variants are stamped with the blob's mtime, which the linked file
+    shares. Republishing the same blob to the same path is a no-op.
+    """
+    try:
+        if os.path.samefile(blob_path(digest), dest_path):
+            stat_result = os.stat(dest_path)
+            if len(fresh_variants(dest_path, stat_result)) == len(ENCODINGS):
+                return
+    except FileNotFoundError:
+        pass
+
+    write_variants(dest_path, read_blob(digest), os.stat(blob_path(digest)).st_mtime_ns)
+    link_blob(digest, dest_path)
+
+
+def is_blob_referenced(conn, digest):
+    """Whether any row still refers to a blob"""
+    row = conn.execute(
+        f"SELECT 1 FROM ({REFERENCED_BLOBS_SQL}) WHERE html_hash = ? LIMIT 1",
+        (time.time(), digest),
+    ).fetchone()
+    return row is not None
+
+
+def remove_blob(digest):
+    """
+    Delete a blob that no row refers to any more.
+
+    Files published from it (hard links) keep their content; only the
+    store's copy goes. Returns the bytes freed on disk.
+    """
+    path = blob_path(digest)
+    try:
+        stat_result = os.stat(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return stat_result.st_size if stat_result.st_nlink == 1 else 0
+
+
+def collect_garbage(db_pool, min_age=BLOB_GC_MIN_AGE):
+    """
+    Mark and sweep the blob store.
+
+    Deletes blobs that no row refers to, that aren't published (hard-linked
+    into html_outputs) and that weren't stored in the last min_age seconds,
+    plus temp files left behind by interrupted writes. Runs on a reader
+    connection, so it never holds up writers.
+
+    Returns:
+        dict: Counts of blobs kept and removed, and the bytes freed
+    """
+    now = time.time()
+    with db_pool.read() as conn:
+        referenced = {row[0] for row in conn.execute(REFERENCED_BLOBS_SQL, (now,))}
+
+    stats = {"kept": 0, "removed": 0, "freedBytes": 0}
+    if not os.path.isdir(BLOB_DIR):
+        return stats
+
+    for fan_out in os.scandir(BLOB_DIR):
+        if not fan_out.is_dir():
+            continue
+        for entry in os.scandir(fan_out.path):
+            is_temp = ".tmp-" in entry.name
+            if entry.name in referenced:
+                stats["kept"] += 1
+                continue
+            try:
+                stat_result = os.stat(entry.path)
+                if (not is_temp and stat_result.st_nlink > 1) or now - stat_result.st_mtime < min_age:
+                    stats["kept"] += 1
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            stats["removed"] += 1
+            stats["freedBytes"] += stat_result.st_size
+    return stats
+
+
+class BlobCollector:
+    """Runs collect_garbage every BLOB_GC_INTERVAL seconds on a daemon thread"""
+
+    def __init__(self, db_pool, interval=BLOB_GC_INTERVAL, min_age=BLOB_GC_MIN_AGE):
+        self.db_pool = db_pool
+        self.interval = interval
+        self.min_age = min_age
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._stats = {"runs": 0, "removed": 0, "freedBytes": 0, "lastRun": None, "lastError": None}
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                result = collect_garbage(self.db_pool, self.min_age)
+            except Exception as e:
+                print(f"Blob garbage collection failed: {str(e)}")
+                self._stats["lastError"] = str(e)
+                continue
+            self._stats["runs"] += 1
+            self._stats["removed"] += result["removed"]
+            self._stats["freedBytes"] += result["freedBytes"]
+            self._stats["lastRun"] = dict(result, at=time.time())
+            if result["removed"]:
+                print(f"Removed {result['removed']} unreferenced blobs ({result['freedBytes']} bytes)")
+
+    def stats(self):
+        """Return a snapshot of collector counters for monitoring"""
+        return dict(self._stats, running=self._thread is not None, interval=self.interval, minAge=self.min_age)
+
+
+def migrate_universal_pdfs_html(conn):
+    """
+    Move universal_pdfs.html_content into the blob store.
+
+    Adds html_hash/html_size, stores each row's HTML as a blob, and drops the
+    html_content column so scans of universal_pdfs no longer drag the pages
+    of every template through the page cache. Safe to run repeatedly.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(universal_pdfs)")
+    column_names = [column[1] for column in cursor.fetchall()]
+
+    if 'html_hash' not in column_names:
+        cursor.execute("ALTER TABLE universal_pdfs ADD COLUMN html_hash TEXT")
+    if 'html_size' not in column_names:
+        cursor.execute("ALTER TABLE universal_pdfs ADD COLUMN html_size INTEGER")
+    if 'html_content' not in column_names:
+        return 0
+
+    ids = [row[0] for row in cursor.execute(
+        "SELECT id FROM universal_pdfs WHERE html_content IS NOT NULL"
+    ).fetchall()]
+
+    # One row at a time so only a single template is in memory
+    for pdf_id in ids:
+        html_content = cursor.execute(
+            "SELECT html_content FROM universal_pdfs WHERE id = ?", (pdf_id,)
+        ).fetchone()[0]
+        digest, size = put_blob(html_content)
+        cursor.execute(
+            "UPDATE universal_pdfs SET html_hash = ?, html_size = ?, html_content = NULL WHERE id = ?",
+            (digest, size, pdf_id),
+        )
+
+    try:
+        cursor.execute("ALTER TABLE universal_pdfs DROP COLUMN html_content")
+    except sqlite3.OperationalError as e:
+        # SQLite < 3.35 can't drop columns; the column stays, always NULL
+        print(f"Could not drop universal_pdfs.html_content: {str(e)}")
+
+    if ids:
+        print(f"Moved HTML for {len(ids)} templates into the blob store")
+    return len(ids)
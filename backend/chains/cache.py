@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import time
+
+from blob_store import put_blob, read_blob_text, blob_path, is_blob_referenced, remove_blob
+from db import pool
+
+# Size limits for the generated-HTML cache (overridable from the environment)
+HTML_CACHE_MAX_BYTES = int(os.getenv("CONFORM_HTML_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+HTML_CACHE_MAX_ENTRIES = int(os.getenv("CONFORM_HTML_CACHE_MAX_ENTRIES", "5000"))
+
+# Seconds a prefilled form is reused for the same template and context
+FILLED_CACHE_TTL = float(os.getenv("CONFORM_FILLED_CACHE_TTL", str(24 * 60 * 60)))
+
+
+def hash_pdf(pdf_path):
+    """
+    Hash the bytes of a PDF.
+
+    Args:
+        pdf_path: Path to the PDF file
+
+    Returns:
+        str: Hex SHA-256 digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def html_cache_key(pdf_hash, field_mapping_string, prompt_version):
+    """Build the cache key for a PDF + field mapping + prompt version"""
+    digest = hashlib.sha256()
+    for part in (pdf_hash, field_mapping_string, prompt_version):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def hash_text(text):
+    """Hex SHA-256 digest of a string"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_cached_html(cache_key):
+    """Return cached HTML for a key (recording the hit), or None"""
+    with pool.read() as conn:
+        row = conn.execute(
+            "SELECT html_hash FROM html_cache WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+    if not row:
+        return None
+
+    try:
+        html = read_blob_text(row["html_hash"])
+    except FileNotFoundError:
+        return None
+
+    with pool.write() as conn:
+        conn.execute(
+            "UPDATE html_cache SET hit_count = hit_count + 1, last_accessed = ? WHERE cache_key = ?",
+            (time.time(), cache_key),
+        )
+    return html
+
+
+def put_cached_html(cache_key, pdf_hash, prompt_version, html):
+    """
+    Record generated HTML and evict least recently used entries over the limits.
+
+    The HTML itself goes to the blob store (shared with universal_pdfs), so
+    the cache only maps a key to a content hash.
+
+    Returns:
+        str: The HTML's content hash
+    """
+    html_hash, size = put_blob(html)
+    with pool.write() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO html_cache
+            (cache_key, pdf_hash, prompt_version, html_hash, size_bytes, last_accessed)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (cache_key, pdf_hash, prompt_version, html_hash, size, time.time()),
+        )
+        orphans = _evict(conn)
+
+    # Delete evicted HTML once the eviction is committed, so the byte limit
+    # bounds the blob store on disk too
+    for digest in orphans:
+        remove_blob(digest)
+    return html_hash
+
+
+def _evict(conn):
+    """
+    Drop least recently used entries until the cache is within its size and count limits.
+
+    Returns:
+        list: Content hashes of evicted HTML that nothing else refers to
+    """
+    total_bytes, total_entries = conn.execute(
+        "SELECT COALESCE(SUM(size_bytes), 0), COUNT(*) FROM html_cache"
+    ).fetchone()
+    if total_bytes <= HTML_CACHE_MAX_BYTES and total_entries <= HTML_CACHE_MAX_ENTRIES:
+        return []
+
+    evicted = []
+    evicted_hashes = set()
+    for row in conn.execute(
+        "SELECT cache_key, html_hash, size_bytes FROM html_cache ORDER BY last_accessed"
+    ).fetchall():
+        if total_bytes <= HTML_CACHE_MAX_BYTES and total_entries <= HTML_CACHE_MAX_ENTRIES:
+            break
+        evicted.append((row["cache_key"],))
+        evicted_hashes.add(row["html_hash"])
+        total_bytes -= row["size_bytes"]
+        total_entries -= 1
+
+    conn.executemany("DELETE FROM html_cache WHERE cache_key = ?", evicted)
+    print(f"Evicted {len(evicted)} entries from the HTML cache")
+    return [digest for digest in evicted_hashes if not is_blob_referenced(conn, digest)]
+
+
+def get_checkpoint(pdf_hash, stage, prompt_version, input_hash):
+    """
+    Return the saved output of a pipeline stage, or None.
+
+    A checkpoint only matches if the stage's input is unchanged, so rerunning
+    an earlier stage invalidates everything downstream of it.
+    """
+    with pool.read() as conn:
+        row = conn.execute(
+            """
+            SELECT output FROM stage_checkpoints
+            WHERE pdf_hash = ? AND stage = ? AND prompt_version = ? AND input_hash = ?
+            """,
+            (pdf_hash, stage, prompt_version, input_hash),
+        ).fetchone()
+    return row["output"] if row else None
+
+
+def put_checkpoint(pdf_hash, stage, prompt_version, input_hash, output):
+    """Save the output of a pipeline stage"""
+    with pool.write() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO stage_checkpoints
+            (pdf_hash, stage, prompt_version, input_hash, output)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (pdf_hash, stage, prompt_version, input_hash, output),
+        )
+
+
+def list_checkpoints(pdf_hash, prompt_version):
+    """Return the stages checkpointed for a PDF under a prompt version"""
+    with pool.read() as conn:
+        rows = conn.execute(
+            """
+            SELECT stage, input_hash, length(output) AS output_length, created_at
+            FROM stage_checkpoints
+            WHERE pdf_hash = ? AND prompt_version = ?
+            """,
+            (pdf_hash, prompt_version),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_prefill_mapping(template_hash, mapper_version):
+    """Return the field mapping learned for a template, or None"""
+    with pool.read() as conn:
+        row = conn.execute(
+            "SELECT mapping FROM prefill_mappings WHERE template_hash = ? AND mapper_version = ?",
+            (template_hash, mapper_version),
+        ).fetchone()
+    return json.loads(row["mapping"]) if row else None
+
+
+def put_prefill_mapping(template_hash, mapper_version, mapping):
+    """Save the field mapping learned for a template"""
+    with pool.write() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO prefill_mappings (template_hash, mapper_version, mapping)
+            VALUES (?, ?, ?)
+            """,
+            (template_hash, mapper_version, json.dumps(mapping)),
+        )
+
+
+def filled_cache_key(template_hash, context_data, version):
+    """Build the cache key for a template + the context it is filled with"""
+    digest = hashlib.sha256()
+    context_json = json.dumps(context_data, sort_keys=True, separators=(",", ":"), default=str)
+    for part in (template_hash, context_json, version):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_cached_fill(cache_key):
+    """Return the content hash of an unexpired prefilled form, or None"""
+    with pool.read() as conn:
+        row = conn.execute(
+            "SELECT html_hash FROM filled_output_cache WHERE cache_key = ? AND expires_at > ?",
+            (cache_key, time.time()),
+        ).fetchone()
+    if not row or not os.path.exists(blob_path(row["html_hash"])):
+        return None
+    return row["html_hash"]
+
+
+def put_cached_fill(cache_key, template_hash, html_hash, patient_id=None, user_id=None):
+    """Record a prefilled form (already in the blob store) and drop expired entries"""
+    now = time.time()
+    with pool.write() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO filled_output_cache
+            (cache_key, template_hash, patient_id, user_id, html_hash, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (cache_key, template_hash, patient_id, user_id, html_hash, now, now + FILLED_CACHE_TTL),
+        )
+        conn.execute("DELETE FROM filled_output_cache WHERE expires_at <= ?", (now,))
+
+
+def invalidate_cached_fills(patient_id=None, user_id=None, template_hash=None, conn=None):
+    """
+    Drop the prefilled forms for a patient, a user or a template.
+
+    Pass conn to delete inside a caller's transaction on the writer connection
+    (taking the writer again would deadlock); the caller commits.
+
+    Returns:
+        int: Number of entries removed
+    """
+    conditions = []
+    params = []
+    for column, value in (("patient_id", patient_id), ("user_id", user_id), ("template_hash", template_hash)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if not conditions:
+        return 0
+
+    sql = f"DELETE FROM filled_output_cache WHERE {' OR '.join(conditions)}"
+    if conn is not None:
+        return conn.execute(sql, params).rowcount
+    with pool.write() as conn:
+        return conn.execute(sql, params).rowcount
@@ -1,20 +1,29 @@
-# Direct Anthropic API implementation
+# Anthropic API implementation (calls go through the shared LLM gateway)
 import os
-from dotenv import load_dotenv
-import anthropic
 import pathlib
 import re
 import base64
-import sqlite3
-from contextlib import closing
 
-load_dotenv()
-
-# Initialize Anthropic client
-client = anthropic.Anthropic(
-    api_key=os.getenv("ANTHROPIC_API_KEY"),
+from blob_store import put_blob, publish_blob
+from llm import llm_gateway
+from db import pool
+from template_cache import template_cache
+from healthcare_systems import healthcare_systems_cache
+from chains.cache import (
+    hash_pdf,
+    hash_text,
+    html_cache_key,
+    get_cached_html,
+    put_cached_html,
+    get_checkpoint,
+    put_checkpoint,
 )
 
+# Bump whenever the prompts or model settings below change, so cached HTML
+# generated by an older pipeline is not reused (the gateway's tag keeps
+# output of the offline stub backend apart)
+PROMPT_VERSION = "chain1-v1" + llm_gateway.cache_tag
+
 
 def get_pdf_base64(pdf_path):
     """Read PDF file and encode as base64"""
@@ -44,20 +53,15 @@ def extract_html(text):
 
 
 def stream_response(messages):
-    """Stream response and collect the full text"""
-    full_text = ""
-    with client.messages.stream(
+    """Generate a response through the LLM gateway and return its text"""
+    full_text = llm_gateway.complete(
+        messages,
         model="claude-3-7-sonnet-20250219",
         max_tokens=30000,
         thinking={"type": "enabled", "budget_tokens": 16000},
         temperature=1,
-        messages=messages,
-    ) as stream:
-        for text in stream.text_stream:
-            full_text += text
-            # Optional: print progress
-            print(".", end="", flush=True)
-    print()  # Newline after streaming completes
+    )
+    print(f"Received response of length {len(full_text)}")
     return full_text
 
 
@@ -264,8 +268,57 @@ def convert_to_typeform(html_content):
     return typeform_html
 
 
-def chain1(pdf_path, field_mapping_string, hospital_system=None):
-    """Process a PDF and generate HTML"""
+# Pipeline stages, in order. Each stage's output is checkpointed so a failed
+# run resumes from the last completed stage.
+STAGES = ("generate_form", "validate_form", "convert_to_typeform")
+
+
+def run_stage(stage, pdf_form: pathlib.Path, stage_input: str):
+    """Run a single pipeline stage on the previous stage's output"""
+    if stage == "generate_form":
+        return generate_form(pdf_form, stage_input)
+    if stage == "validate_form":
+        return validate_form(pdf_form, stage_input)
+    if stage == "convert_to_typeform":
+        return convert_to_typeform(stage_input)
+    raise ValueError(f"Unknown chain1 stage: {stage}")
+
+
+def run_pipeline(pdf_form: pathlib.Path, field_mapping_string: str, pdf_hash: str, rerun_stage=None):
+    """
+    Run every stage, reusing checkpointed outputs where the stage input is unchanged.
+
+    Args:
+        pdf_form: Path to the PDF
+        field_mapping_string: Keys and coordinates passed to generate_form
+        pdf_hash: Content hash of the PDF
+        rerun_stage: Optional stage to recompute even if it has a checkpoint
+
+    Returns:
+        str: The final Typeform-style HTML
+    """
+    if rerun_stage is not None and rerun_stage not in STAGES:
+        raise ValueError(f"Unknown chain1 stage: {rerun_stage}")
+
+    stage_input = field_mapping_string
+    for stage in STAGES:
+        input_hash = hash_text(stage_input)
+        output = None
+        if stage != rerun_stage:
+            output = get_checkpoint(pdf_hash, stage, PROMPT_VERSION, input_hash)
+
+        if output is not None:
+            print(f"Resuming {stage} from checkpoint")
+        else:
+            output = run_stage(stage, pdf_form, stage_input)
+            put_checkpoint(pdf_hash, stage, PROMPT_VERSION, input_hash, output)
+
+        stage_input = output
+    return stage_input
+
+
+def chain1(pdf_path, field_mapping_string, hospital_system=None, rerun_stage=None):
+    """Process a PDF and generate HTML (optionally forcing one stage to rerun)"""
     try:
         print(f"chain1 processing started for {pdf_path}")
 
@@ -295,32 +348,27 @@ def chain1(pdf_path, field_mapping_string, hospital_system=None):
             # For backward compatibility, still support the root directory
             html_path = os.path.join(html_output_dir, html_filename)
 
-        # Process the PDF and generate HTML
-        pdf_form = pathlib.Path(pdf_path)
-        html_form_initial = generate_form(pdf_form, field_mapping_string)
-        validated_form = validate_form(pdf_form, html_form_initial)
-        html_content = convert_to_typeform(validated_form)
+        # Look up the generated HTML by PDF content, field mapping and prompt version
+        pdf_hash = hash_pdf(pdf_path)
+        cache_key = html_cache_key(pdf_hash, field_mapping_string, PROMPT_VERSION)
+        html_content = None if rerun_stage else get_cached_html(cache_key)
 
-        # Save the HTML to a file
-        with open(html_path, "w", encoding="utf-8") as f:
-            f.write(html_content)
-
-        print(f"HTML saved to {html_path}")
+        if html_content is not None:
+            print(f"HTML cache hit for {original_filename} ({cache_key[:12]})")
+        else:
+            # Process the PDF and generate HTML, resuming from any checkpoints
+            pdf_form = pathlib.Path(pdf_path)
+            html_content = run_pipeline(pdf_form, field_mapping_string, pdf_hash, rerun_stage)
 
-        # Update the database
-        db_path = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)), "conform.db"
-        )
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+            put_cached_html(cache_key, pdf_hash, PROMPT_VERSION, html_content)
 
-        # Check if a record already exists for this PDF
-        cursor.execute(
-            "SELECT id FROM universal_pdfs WHERE original_filename = ?",
-            (original_filename,),
-        )
+        # Store the HTML once and publish it under html_outputs as a link to
+        # the blob, with its compressed variants
+        html_hash, html_size = put_blob(html_content)
+        publish_blob(html_hash, html_path)
 
-        existing_record = cursor.fetchone()
+        print(f"HTML saved to {html_path}")
+        template_cache.invalidate(html_filename)
 
         # Store the relative path to the HTML file (from the html_outputs directory)
         relative_html_path = (
@@ -329,60 +377,95 @@ def chain1(pdf_path, field_mapping_string, hospital_system=None):
             else html_filename
         )
 
-        if existing_record:
-            # Update the existing record
-            cursor.execute(
-                """
-                UPDATE universal_pdfs
-                SET html_content = ?, html_filename = ?, hospital_system = ?, updated_at = datetime('now')
-                WHERE original_filename = ?
-                """,
-                (html_content, relative_html_path, hospital_system, original_filename),
-            )
-        else:
-            # Insert a new record
+        # Update the database
+        with pool.write() as conn:
+            cursor = conn.cursor()
+
+            # Check if a record already exists for this PDF
             cursor.execute(
-                """
-                INSERT INTO universal_pdfs (original_filename, html_content, html_filename, hospital_system, created_at, updated_at)
-                VALUES (?, ?, ?, ?, datetime('now'), datetime('now'))
-                """,
-                (original_filename, html_content, relative_html_path, hospital_system),
+                "SELECT id FROM universal_pdfs WHERE original_filename = ?",
+                (original_filename,),
             )
 
-        conn.commit()
-        conn.close()
+            existing_record = cursor.fetchone()
+
+            if existing_record:
+                # Update the existing record
+                cursor.execute(
+                    """
+                    UPDATE universal_pdfs
+                    SET html_hash = ?, html_size = ?, html_filename = ?, html_basename = ?, hospital_system = ?, updated_at = datetime('now')
+                    WHERE original_filename = ?
+                    """,
+                    (html_hash, html_size, relative_html_path, html_filename, hospital_system, original_filename),
+                )
+            else:
+                # Insert a new record
+                cursor.execute(
+                    """
+                    INSERT INTO universal_pdfs (original_filename, html_hash, html_size, html_filename, html_basename, hospital_system, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))
+                    """,
+                    (original_filename, html_hash, html_size, relative_html_path, html_filename, hospital_system),
+                )
 
         print(f"Database updated for {original_filename}")
+        healthcare_systems_cache.invalidate()
         return True
     except Exception as e:
         print(f"Error in chain1 processing: {str(e)}")
         return False
 
 
+def rerun_template_stage(original_filename, stage):
+    """Rerun one stage (and whatever it invalidates downstream) for an uploaded template"""
+    import pdf_utils
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pdf_path = os.path.join(backend_dir, "uploads", original_filename)
+
+    with pool.read() as conn:
+        row = conn.execute(
+            "SELECT hospital_system FROM universal_pdfs WHERE original_filename = ?",
+            (original_filename,),
+        ).fetchone()
+    hospital_system = row["hospital_system"] if row else None
+
+    field_mapping_string = pdf_utils.generate_field_mapping_string(pdf_path)
+    return chain1(pdf_path, field_mapping_string, hospital_system, rerun_stage=stage)
+
+
 if __name__ == "__main__":
-    # Connect to the database to get the original filename
-    DB_PATH = os.path.join(
-        os.path.dirname(os.path.dirname(__file__)), "conform.db"
-    )
+    # Run from the backend directory: python -m chains.chain1
+    import argparse
 
-    # Connect to the database
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    parser = argparse.ArgumentParser(description="Generate the HTML form for a PDF")
+    parser.add_argument("--template", help="Original filename of an uploaded template to reprocess")
+    parser.add_argument("--rerun-stage", choices=STAGES, help="Stage to recompute instead of resuming from its checkpoint")
+    args = parser.parse_args()
+
+    # The HTML cache and checkpoint tables come from the migrations
+    from migrations import migrate_database
+
+    migrate_database()
+
+    if args.template:
+        print(rerun_template_stage(args.template, args.rerun_stage))
+        raise SystemExit(0)
+
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
     # Query the universal_pdfs table for the first entry (for testing)
-    cursor.execute("SELECT original_filename FROM universal_pdfs LIMIT 1")
-    result = cursor.fetchone()
+    with pool.read() as conn:
+        result = conn.execute("SELECT original_filename FROM universal_pdfs LIMIT 1").fetchone()
     print(result)
     if result:
         # Use the original filename from the database
         original_filename = result["original_filename"]
-        pdf_form = pathlib.Path(f"../uploads/{original_filename}")
+        pdf_form = pathlib.Path(backend_dir, "uploads", original_filename)
     else:
         # Fallback to the test file if no entries in the database
-        pdf_form = pathlib.Path("../test_files/sterilization_form.pdf")
-
-    conn.close()
+        pdf_form = pathlib.Path(backend_dir, "test_files", "sterilization_form.pdf")
 
     mock_coordinates = """
     1: Page 1, I have asked for and received information about sterilization from Doctor or Clinic, (30, 664)
@@ -419,5 +502,5 @@ if __name__ == "__main__":
     32: Page 1, Physician's Signature, (312, 45)
     33: Page 1, Date Physician Signed, (493, 47)
     """
-    response = chain1(pdf_form, mock_coordinates)
+    response = chain1(pdf_form, mock_coordinates, rerun_stage=args.rerun_stage)
     print(response)
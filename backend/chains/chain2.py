@@ -1,19 +1,40 @@
 import os
-from dotenv import load_dotenv
-import anthropic
 import json
 import re
 import base64
 from pathlib import Path
 import traceback
+import uuid
 
-# Load environment variables
-load_dotenv()
+from starlette.concurrency import run_in_threadpool
 
-# Initialize Anthropic client
-client = anthropic.Anthropic(
-    api_key=os.getenv("ANTHROPIC_API_KEY"),
+from blob_store import put_blob, publish_blob
+from llm import llm_gateway
+from chains.cache import (
+    hash_text,
+    get_prefill_mapping,
+    put_prefill_mapping,
+    filled_cache_key,
+    get_cached_fill,
+    put_cached_fill,
 )
+from chains.prefill import (
+    MAPPER_VERSION,
+    extract_fields,
+    flatten_context,
+    derive_mapping,
+    apply_mapping,
+    mapping_prompt,
+    parse_mapping_reply,
+)
+
+# Version of learned mappings and cached fills (the gateway's tag keeps
+# output of the offline stub backend apart)
+MAPPING_VERSION = MAPPER_VERSION + llm_gateway.cache_tag
+
+# Ask the model about fields the prefill rules can't map (once per template)
+PREFILL_LLM_MAPPING = os.getenv("CONFORM_PREFILL_LLM_MAPPING", "1") == "1"
+
 
 def extract_html(text):
     """Extract HTML content from the response"""
@@ -41,45 +62,51 @@ def extract_html(text):
     print("No specific HTML format found, returning entire text")
     return text
 
-def stream_response(messages):
-    """Stream response and collect the full text"""
+MODEL = "claude-3-7-sonnet-20250219"
+
+
+def user_message(text):
+    """Messages for a single user turn"""
+    return [{"role": "user", "content": [{"type": "text", "text": text}]}]
+
+def stream_response(messages, max_tokens=50000):
+    """Generate a response through the LLM gateway and return its text"""
     print("Starting API call to Claude...")
-    full_text = ""
     try:
-        with client.messages.stream(
-            model="claude-3-7-sonnet-20250219",
-            max_tokens=50000,  # Increased to ensure we get complete HTML
+        full_text = llm_gateway.complete(
+            messages,
+            model=MODEL,
+            max_tokens=max_tokens,  # Large by default to ensure we get complete HTML
             temperature=0,
-            messages=messages
-        ) as stream:
-            for text in stream.text_stream:
-                full_text += text
-                # Print a dot every 100 characters to show progress
-                if len(full_text) % 100 == 0:
-                    print(".", end="", flush=True)
-        print()  # Newline after streaming completes
+        )
         print(f"Received response of length {len(full_text)}")
         return full_text
     except Exception as e:
         print(f"Error in API call: {str(e)}")
         raise
 
-def enhance_form_with_context(template_html: str, context_data):
-    """
-    Enhance an HTML form with context-aware prefilled values and dropdowns
-
-    Args:
-        template_html: HTML template form string
-        context_data: Dictionary with context about patient, doctor, practice, etc.
+async def astream_response(messages, max_tokens=50000):
+    """stream_response() for async callers: waits on the gateway without holding a thread"""
+    print("Starting API call to Claude...")
+    try:
+        full_text = await llm_gateway.acomplete(
+            messages,
+            model=MODEL,
+            max_tokens=max_tokens,
+            temperature=0,
+        )
+        print(f"Received response of length {len(full_text)}")
+        return full_text
+    except Exception as e:
+        print(f"Error in API call: {str(e)}")
+        raise
 
-    Returns:
-        Enhanced HTML form as a string
-    """
+def enhancement_prompt(template_html, context_data):
+    """Prompt asking the model to rewrite a form with context-aware values"""
     # Convert context_data to a formatted string
     context_str = json.dumps(context_data, indent=2)
 
-    print("Enhancing form with context...")
-    prompt = f"""You're going to enhance an HTML form with context-aware features.
+    return f"""You're going to enhance an HTML form with context-aware features.
 
 I'll provide you with:
 1. An HTML template form
@@ -105,18 +132,8 @@ CONTEXT DATA:
 Provide ONLY the modified HTML in your response. The HTML should be a complete, functional form.
 """
 
-    response_text = stream_response([
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompt
-                }
-            ]
-        }
-    ])
-
+def parse_enhanced_html(response_text):
+    """Pull the enhanced form out of the model's reply"""
     # Extract HTML from the response
     enhanced_html = extract_html(response_text)
     
@@ -134,13 +151,244 @@ Provide ONLY the modified HTML in your response. The HTML should be a complete,
         
     return enhanced_html
 
-def chain2(template_path, context_data):
+def enhance_form_with_context(template_html: str, context_data):
+    """
+    Enhance an HTML form with context-aware prefilled values and dropdowns
+
+    Args:
+        template_html: HTML template form string
+        context_data: Dictionary with context about patient, doctor, practice, etc.
+
+    Returns:
+        Enhanced HTML form as a string
+    """
+    print("Enhancing form with context...")
+    response_text = stream_response(user_message(enhancement_prompt(template_html, context_data)))
+    return parse_enhanced_html(response_text)
+
+async def aenhance_form_with_context(template_html, context_data):
+    """enhance_form_with_context() for async callers"""
+    print("Enhancing form with context...")
+    prompt = await run_in_threadpool(enhancement_prompt, template_html, context_data)
+    response_text = await astream_response(user_message(prompt))
+    return await run_in_threadpool(parse_enhanced_html, response_text)
+
+def suggest_field_mapping(fields, context_paths):
+    """
+    Ask the model to map fields the prefill rules couldn't.
+
+    Only the unmapped fields' descriptions and the context paths are sent,
+    and the reply is a small JSON object rather than a rewritten form.
+    """
+    print(f"Asking the model to map {len(fields)} unmapped fields...")
+    response_text = stream_response(user_message(mapping_prompt(fields, context_paths)), max_tokens=4000)
+    return parse_mapping_reply(response_text, fields, context_paths)
+
+async def asuggest_field_mapping(fields, context_paths):
+    """suggest_field_mapping() for async callers"""
+    print(f"Asking the model to map {len(fields)} unmapped fields...")
+    response_text = await astream_response(user_message(mapping_prompt(fields, context_paths)), max_tokens=4000)
+    return parse_mapping_reply(response_text, fields, context_paths)
+
+
+def rules_mapping(fields, context_data):
+    """Map what the keyword rules can; returns (mapping, unmapped fields, context paths)"""
+    context_paths = flatten_context(context_data)
+    mapping, unmapped = derive_mapping(fields, context_paths)
+    print(f"Prefill rules mapped {len(mapping)} of {len(fields)} fields")
+    return mapping, unmapped, context_paths
+
+
+def get_field_mapping(template_text, fields, context_data):
+    """
+    Return the template's field mapping, learning and caching it on first use.
+
+    The keyword rules map most fields; the model is only consulted for the
+    rest. A mapping is only cached once the model has answered, so a failed
+    call is retried by the next fill rather than leaving fields unmapped for good.
+
+    Returns:
+        tuple: (mapping, whether it is the template's learned mapping rather
+        than a rules-only stand-in after a failed model call)
+    """
+    template_hash = hash_text(template_text)
+    mapping = get_prefill_mapping(template_hash, MAPPING_VERSION)
+    if mapping is not None:
+        return mapping, True
+
+    mapping, unmapped, context_paths = rules_mapping(fields, context_data)
+    if unmapped and PREFILL_LLM_MAPPING:
+        try:
+            mapping.update(suggest_field_mapping(unmapped, context_paths))
+        except Exception as e:
+            print(f"Error mapping fields with the model, using the rules only: {str(e)}")
+            return mapping, False
+
+    put_prefill_mapping(template_hash, MAPPING_VERSION, mapping)
+    return mapping, True
+
+
+async def aget_field_mapping(template_text, fields, context_data):
+    """get_field_mapping() for async callers; the cache lookups run in the threadpool"""
+    template_hash = hash_text(template_text)
+    mapping = await run_in_threadpool(get_prefill_mapping, template_hash, MAPPING_VERSION)
+    if mapping is not None:
+        return mapping, True
+
+    mapping, unmapped, context_paths = await run_in_threadpool(rules_mapping, fields, context_data)
+    if unmapped and PREFILL_LLM_MAPPING:
+        try:
+            mapping.update(await asuggest_field_mapping(unmapped, context_paths))
+        except Exception as e:
+            print(f"Error mapping fields with the model, using the rules only: {str(e)}")
+            return mapping, False
+
+    await run_in_threadpool(put_prefill_mapping, template_hash, MAPPING_VERSION, mapping)
+    return mapping, True
+
+
+def prefill_form(template_html, context_data):
+    """
+    Prefill a form from context without rewriting it.
+
+    Values are stamped into the inputs the template's field mapping covers.
+    A template with no identifiable inputs falls back to the full model
+    rewrite in enhance_form_with_context.
+
+    Returns:
+        tuple: (prefilled HTML form as a string, whether it is worth caching)
+    """
+    fields = extract_fields(template_html)
+    if not fields:
+        print("No form fields found, falling back to the model")
+        return enhance_form_with_context(template_html, context_data), True
+
+    mapping, learned = get_field_mapping(template_html, fields, context_data)
+    filled_html, filled = apply_mapping(template_html, fields, mapping, context_data)
+    print(f"Prefilled {filled} of {len(fields)} fields")
+    return filled_html, learned
+
+
+async def aprefill_form(template_html, context_data):
+    """prefill_form() for async callers: HTML parsing runs in the threadpool, model calls on the loop"""
+    fields = await run_in_threadpool(extract_fields, template_html)
+    if not fields:
+        print("No form fields found, falling back to the model")
+        return await aenhance_form_with_context(template_html, context_data), True
+
+    mapping, learned = await aget_field_mapping(template_html, fields, context_data)
+    filled_html, filled = await run_in_threadpool(apply_mapping, template_html, fields, mapping, context_data)
+    print(f"Prefilled {filled} of {len(fields)} fields")
+    return filled_html, learned
+
+
+def filled_output_filename(template_name, patient_id=None, user_id=None):
+    """
+    Name of the file a fill is published as, next to its template.
+
+    Each (template, patient, user) has one file, which a re-fill replaces
+    atomically: fills for different patients never share a path, and
+    repeated fills don't leave a file behind per request.
+    """
+    stem = Path(template_name).stem
+    parts = [f"filled_{stem}"]
+    if patient_id is not None:
+        parts.append(f"p{patient_id}")
+    if user_id is not None:
+        parts.append(f"u{user_id}")
+    return "_".join(parts) + ".html"
+
+
+def filled_output_pattern(template_name=None, patient_id=None):
+    """Regex matching the published fills of a template and/or a patient (for cleanup)"""
+    stem = re.escape(Path(template_name).stem) if template_name else ".+"
+    patient = str(int(patient_id)) if patient_id is not None else r"\d+"
+    return re.compile(rf"filled_{stem}_p{patient}_u\d+\.html")
+
+
+def load_fill(template_path, context_data, template_text=None):
+    """
+    Read the template (unless the caller already has it) and look up a cached
+    fill of it for this context.
+
+    Returns:
+        tuple: (template_text, template_hash, cache_key, cached HTML hash or None)
+
+    Raises:
+        FileNotFoundError: The template file doesn't exist
+    """
+    if template_text is None:
+        template_file = Path(template_path)
+        if not template_file.exists():
+            raise FileNotFoundError(f"Template file not found: {template_path}")
+        template_text = template_file.read_text(encoding='utf-8')
+    print(f"Original template size: {len(template_text)} bytes")
+
+    template_hash = hash_text(template_text)
+    cache_key = filled_cache_key(template_hash, context_data, MAPPING_VERSION)
+    return template_text, template_hash, cache_key, get_cached_fill(cache_key)
+
+
+def check_filled_html(enhanced_html):
+    """Return why a generated form is unusable, or None if it looks valid"""
+    if not enhanced_html:
+        return "Received empty HTML response from API"
+    if len(enhanced_html) < 100:
+        return f"Received suspiciously short HTML response ({len(enhanced_html)} chars)"
+    return None
+
+
+def store_fill(enhanced_html, cacheable, cache_key, template_hash, patient_id=None, user_id=None):
+    """Save a generated form to the blob store and cache it; returns its blob hash"""
+    html_hash, _ = put_blob(enhanced_html)
+    # A fill from a stand-in mapping isn't cached, so the next one
+    # retries learning the mapping
+    if cacheable:
+        put_cached_fill(cache_key, template_hash, html_hash, patient_id, user_id)
+    return html_hash
+
+
+def publish_fill(template_path, html_hash, patient_id=None, user_id=None, request_id=None, cached=False):
+    """Publish a filled form next to its template and return chain2's result"""
+    # Create output filename
+    request_id = request_id or uuid.uuid4().hex
+    template_file = Path(template_path)
+    output_filename = filled_output_filename(template_file.name, patient_id, user_id)
+    output_dir = template_file.parent
+    output_path = output_dir / output_filename
+    
+    # Publish the enhanced HTML along with its gzip/brotli variants (as
+    # a link to the blob, renamed into place so readers never see a
+    # partial file)
+    publish_blob(html_hash, str(output_path))
+        
+    print(f"Enhanced HTML saved to {output_path} (request {request_id})")
+    
+    return {
+        "success": True,
+        "filled_template_path": str(output_path),
+        "filled_template_filename": output_filename,
+        "request_id": request_id,
+        "cached": cached
+    }
+
+
+def chain2(template_path, context_data, template_text=None, patient_id=None, user_id=None, request_id=None):
     """
     Process an HTML template with patient and doctor data to create a prefilled form.
+
+    A form already filled from the same template and context within
+    FILLED_CACHE_TTL is reused instead of being filled again.
     
     Args:
         template_path (str): Path to the HTML template file
         context_data (dict): Dictionary with context about patient, doctor, practice, etc.
+        template_text (str, optional): Template contents already in memory; read from
+            template_path when not given
+        patient_id, user_id (optional): Who the form is filled for, so the cached
+            form is dropped when the patient or user changes
+        request_id (str, optional): Identifies this fill in the result and logs
+            (a random one is used when not given)
         
     Returns:
         tuple: (success, enhanced_html_or_error_message)
@@ -148,55 +396,87 @@ def chain2(template_path, context_data):
     try:
         print(f"chain2 processing started for {template_path}")
         
-        # Read the template file
-        template_file = Path(template_path)
-        if not template_file.exists():
-            error_msg = f"Template file not found: {template_path}"
-            print(error_msg)
-            return False, error_msg
-            
-        template_text = template_file.read_text(encoding='utf-8')
-        print(f"Original template size: {len(template_text)} bytes")
-        
-        # Generate enhanced form
         try:
-            enhanced_html = enhance_form_with_context(template_text, context_data)
-            
-            # Verify that we got a valid HTML response
-            if not enhanced_html:
-                error_msg = "Received empty HTML response from API"
+            template_text, template_hash, cache_key, html_hash = load_fill(template_path, context_data, template_text)
+        except FileNotFoundError as e:
+            print(str(e))
+            return False, str(e)
+        cached = html_hash is not None
+
+        if cached:
+            print(f"Filled form cache hit ({cache_key[:12]})")
+        else:
+            # Generate the prefilled form
+            try:
+                enhanced_html, cacheable = prefill_form(template_text, context_data)
+            except Exception as e:
+                error_msg = f"Error processing template: {str(e)}"
                 print(error_msg)
+                print(f"Traceback: {traceback.format_exc()}")
                 return False, error_msg
                 
-            if len(enhanced_html) < 100:
-                error_msg = f"Received suspiciously short HTML response ({len(enhanced_html)} chars)"
+            # Verify that we got a valid HTML response
+            error_msg = check_filled_html(enhanced_html)
+            if error_msg:
                 print(error_msg)
                 return False, error_msg
-            
             print(f"Enhanced HTML size: {len(enhanced_html)} bytes")
-            
-        except Exception as e:
-            error_msg = f"Error processing template: {str(e)}"
-            print(error_msg)
-            print(f"Traceback: {traceback.format_exc()}")
-            return False, error_msg
+
+            html_hash = store_fill(enhanced_html, cacheable, cache_key, template_hash, patient_id, user_id)
         
-        # Create output filename
-        output_filename = f"filled_{template_file.name}"
-        output_dir = template_file.parent
-        output_path = output_dir / output_filename
+        return True, publish_fill(template_path, html_hash, patient_id, user_id, request_id, cached)
+    except Exception as e:
+        error_msg = f"Error in chain2 processing: {str(e)}"
+        print(error_msg)
+        print(f"Traceback: {traceback.format_exc()}")
+        return False, error_msg
+
+
+async def achain2(template_path, context_data, template_text=None, patient_id=None, user_id=None, request_id=None):
+    """
+    chain2() for async routes.
+
+    Model calls are awaited on the gateway without holding a thread, and the
+    template, cache and publishing work runs in the threadpool in short calls
+    between them. Cancelling the awaiting task abandons the fill.
+    """
+    try:
+        print(f"chain2 processing started for {template_path}")
         
-        # Save the enhanced HTML
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(enhanced_html)
-            
-        print(f"Enhanced HTML saved to {output_path}")
+        try:
+            template_text, template_hash, cache_key, html_hash = await run_in_threadpool(
+                load_fill, template_path, context_data, template_text
+            )
+        except FileNotFoundError as e:
+            print(str(e))
+            return False, str(e)
+        cached = html_hash is not None
+
+        if cached:
+            print(f"Filled form cache hit ({cache_key[:12]})")
+        else:
+            # Generate the prefilled form
+            try:
+                enhanced_html, cacheable = await aprefill_form(template_text, context_data)
+            except Exception as e:
+                error_msg = f"Error processing template: {str(e)}"
+                print(error_msg)
+                print(f"Traceback: {traceback.format_exc()}")
+                return False, error_msg
+                
+            # Verify that we got a valid HTML response
+            error_msg = check_filled_html(enhanced_html)
+            if error_msg:
+                print(error_msg)
+                return False, error_msg
+            print(f"Enhanced HTML size: {len(enhanced_html)} bytes")
+
+            html_hash = await run_in_threadpool(
+                store_fill, enhanced_html, cacheable, cache_key, template_hash, patient_id, user_id
+            )
         
-        return True, {
-            "success": True,
-            "filled_template_path": str(output_path),
-            "filled_template_filename": output_filename
-        }
+        result = await run_in_threadpool(publish_fill, template_path, html_hash, patient_id, user_id, request_id, cached)
+        return True, result
     except Exception as e:
         error_msg = f"Error in chain2 processing: {str(e)}"
         print(error_msg)
@@ -1,15 +1,8 @@
-import os
-from dotenv import load_dotenv
-import anthropic
 import pathlib
 import re
 import base64
 
-load_dotenv()
-
-client = anthropic.Anthropic(
-    api_key=os.getenv('ANTHROPIC_API_KEY'),
-)
+from llm import llm_gateway
 
 def get_pdf_base64(pdf_path):
     """Read PDF file and encode as base64"""
@@ -18,20 +11,13 @@ def get_pdf_base64(pdf_path):
 
 
 def stream_response(messages):
-    """Stream response and collect the full text"""
-    full_text = ""
-    with client.messages.stream(
+    """Generate a response through the LLM gateway and return its text"""
+    return llm_gateway.complete(
+        messages,
         model="claude-3-5-sonnet-latest",
         max_tokens=30000,
         temperature=1,
-        messages=messages
-    ) as stream:
-        for text in stream.text_stream:
-            full_text += text
-            # Optional: print progress
-            print(".", end="", flush=True)
-    print()  # Newline after streaming completes
-    return full_text
+    )
 
 def verify_typeform_html(html_content):
     """
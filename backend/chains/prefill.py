@@ -0,0 +1,448 @@
+"""
+Deterministic prefill for generated form templates.
+
+A template's inputs are matched to context paths such as "patient.name" or
+"doctor.name" once (derive_mapping); after that, filling the form for a
+patient is a single parse of the HTML that stamps values into the matching
+tags (apply_mapping), with no model call.
+"""
+import json
+import re
+from datetime import date
+from html import escape
+from html.parser import HTMLParser
+
+# Bump whenever the field extraction or rules below change, so mappings
+# learned by an older version are not reused
+MAPPER_VERSION = "prefill-v1"
+
+# Inputs whose value is free text (stamped into the value attribute)
+TEXT_TYPES = {"text", "email", "tel", "search", "url", "number", "date", ""}
+
+# Inputs that are ticked rather than typed into
+CHOICE_TYPES = {"checkbox", "radio"}
+
+# Inputs that never carry form data
+IGNORED_TYPES = {"submit", "button", "reset", "hidden", "image", "file", "password"}
+
+# Never prefilled: these must be completed by the person signing
+MANUAL = re.compile(r"signature|signed by|initials|witness")
+
+# Rules for text, date and select fields, tried in order against the field's
+# label, placeholder and surrounding text; the first match wins
+TEXT_RULES = [
+    (re.compile(r"date of birth|birth ?date|\bdob\b|\bborn\b"), "patient.dob"),
+    (re.compile(r"\bage\b"), "patient.age"),
+    (re.compile(r"(facility|practice|hospital|clinic)('s)? (street )?address"), "practice.address"),
+    (re.compile(r"(facility|practice|hospital|clinic)('s)? (tele)?phone"), "practice.phone"),
+    (re.compile(r"(procedure|operation|surgery) date|date of (the )?(procedure|operation|surgery)"), "procedure.date"),
+    (re.compile(r"cpt|procedure codes?"), "procedure.codes"),
+    (re.compile(r"specialty"), "doctor.specialty"),
+    (re.compile(r"licen[cs]e"), "doctor.license"),
+    (re.compile(r"\b(doctor|physician|clinician|surgeon|provider)\b|\bdr\b"), "doctor.name"),
+    (re.compile(r"\b(facility|practice|hospital)\b"), "practice.name"),
+    (re.compile(r"\bclinic\b"), "doctor.name"),
+    (re.compile(r"\b(operation|procedure|surgery)\b"), "procedure.type"),
+    (re.compile(r"e-?mail"), "patient.email"),
+    (re.compile(r"language"), "patient.preferred_language"),
+    (re.compile(r"ethnicity"), "patient.ethnicity"),
+    (re.compile(r"\brace\b"), "patient.race"),
+    (re.compile(r"\b(gender|sex)\b"), "patient.gender"),
+    (re.compile(r"medication"), "patient.medications"),
+    (re.compile(r"condition|diagnos"), "patient.conditions"),
+    (re.compile(r"address"), "patient.address"),
+    (re.compile(r"\bname\b"), "patient.name"),
+]
+
+# Rules for checkbox and radio groups, matched against the group's heading;
+# the option whose label equals the context value is ticked
+CHOICE_RULES = [
+    (re.compile(r"ethnicity"), "patient.ethnicity"),
+    (re.compile(r"\brace\b"), "patient.race"),
+    (re.compile(r"\b(gender|sex)\b"), "patient.gender"),
+    (re.compile(r"language"), "patient.preferred_language"),
+]
+
+PREFILL_NOTE = (
+    '<div class="prefill-note bg-blue-50 border border-blue-200 text-blue-800 '
+    'text-sm rounded-md p-3 m-4">Some fields have been prefilled from the patient '
+    'and provider records. Please review them before submitting.</div>'
+)
+
+_SPACE = re.compile(r"\s+")
+
+
+def _normalize(text):
+    return _SPACE.sub(" ", (text or "").replace("’", "'")).strip().lower()
+
+
+class FormField:
+    """An input, select or textarea in a template, with the text around it"""
+
+    def __init__(self, tag, attrs, start, end):
+        self.tag = tag
+        self.attrs = attrs
+        self.start = start  # offset of the start tag in the HTML
+        self.end = end  # offset just past the start tag
+        self.label = ""  # text of a <label for=...> pointing at the field
+        self.before = ""  # the last piece of text before the field
+        self.after = ""  # the first piece of text after the field
+        self.heading = ""  # the last text ending in ":" or "?" before the field
+        self.options = []  # (start, end, value, text) for each <option> of a select
+        self.content_end = None  # offset of </textarea>
+
+    @property
+    def id(self):
+        return self.attrs.get("id")
+
+    @property
+    def type(self):
+        if self.tag != "input":
+            return self.tag
+        return (self.attrs.get("type") or "text").lower()
+
+    @property
+    def is_choice(self):
+        return self.tag == "input" and self.type in CHOICE_TYPES
+
+    def describe(self):
+        """Short description of the field for the mapping prompt"""
+        parts = [f"type={self.type}"]
+        for name, text in (("label", self.label), ("placeholder", self.attrs.get("placeholder")),
+                           ("name", self.attrs.get("name")), ("before", self.before),
+                           ("after", self.after if self.is_choice else ""), ("heading", self.heading)):
+            if text:
+                parts.append(f"{name}={text[:80]!r}")
+        return ", ".join(parts)
+
+
+class _FieldParser(HTMLParser):
+    def __init__(self, html):
+        super().__init__(convert_charrefs=True)
+        self.line_offsets = [0]
+        # getpos() counts lines by "\n" only, so split the same way
+        for line in html.split("\n"):
+            self.line_offsets.append(self.line_offsets[-1] + len(line) + 1)
+        self.fields = []
+        self.labels = {}  # for= id -> label text
+        self.text_since_field = []
+        self.heading = ""
+        self.label_for = None
+        self.label_text = []
+        self.select = None
+        self.option = None
+        self.textarea = None
+
+    def _offsets(self):
+        line, column = self.getpos()
+        start = self.line_offsets[line - 1] + column
+        return start, start + len(self.get_starttag_text())
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name.lower(): value if value is not None else "" for name, value in attrs}
+
+        if tag == "label":
+            self.label_for = attrs.get("for")
+            self.label_text = []
+        elif tag == "option" and self.select is not None:
+            start, end = self._offsets()
+            self.option = [start, end, attrs.get("value"), []]
+        elif tag in ("input", "select", "textarea"):
+            field_type = (attrs.get("type") or "text").lower()
+            if tag == "input" and field_type in IGNORED_TYPES:
+                return
+            start, end = self._offsets()
+            field = FormField(tag, attrs, start, end)
+            field.heading = self.heading
+            if self.text_since_field:
+                field.before = self.text_since_field[-1]
+            if self.fields and not self.fields[-1].after and self.text_since_field:
+                self.fields[-1].after = self.text_since_field[0]
+            self.text_since_field = []
+            self.fields.append(field)
+            if tag == "select":
+                self.select = field
+            elif tag == "textarea":
+                self.textarea = field
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "label":
+            if self.label_for:
+                self.labels[self.label_for] = " ".join(self.label_text)
+            self.label_for = None
+        elif tag == "option" and self.option is not None:
+            start, end, value, text = self.option
+            text = " ".join(text)
+            self.select.options.append((start, end, text if value is None else value, text))
+            self.option = None
+        elif tag == "select":
+            self.select = None
+        elif tag == "textarea" and self.textarea is not None:
+            line, column = self.getpos()
+            self.textarea.content_end = self.line_offsets[line - 1] + column
+            self.textarea = None
+
+    def handle_data(self, data):
+        text = _SPACE.sub(" ", data).strip()
+        if not text:
+            return
+        if self.option is not None:
+            self.option[3].append(text)
+            return
+        if self.textarea is not None:
+            return
+        if self.label_for:
+            self.label_text.append(text)
+        self.text_since_field.append(text)
+        if text.endswith(":") or text.endswith("?"):
+            self.heading = text
+
+    def close(self):
+        super().close()
+        if self.fields and not self.fields[-1].after and self.text_since_field:
+            self.fields[-1].after = self.text_since_field[0]
+        for field in self.fields:
+            field.label = self.labels.get(field.id, "")
+
+
+def extract_fields(html):
+    """
+    Find the fillable fields of a template.
+
+    Returns:
+        list: FormField for each input, select and textarea with an id
+    """
+    parser = _FieldParser(html)
+    parser.feed(html)
+    parser.close()
+    return [field for field in parser.fields if field.id]
+
+
+def flatten_context(context_data, prefix=""):
+    """Flatten nested context into {"patient.name": "Jane Doe", ...} with string values"""
+    values = {}
+    for key, value in context_data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten_context(value, f"{path}."))
+        elif isinstance(value, (list, tuple)):
+            values[path] = ", ".join(str(item) for item in value)
+        elif value is None:
+            values[path] = ""
+        else:
+            values[path] = str(value)
+    return values
+
+
+def _match(rules, texts, paths):
+    for text in texts:
+        text = _normalize(text)
+        if not text:
+            continue
+        for pattern, path in rules:
+            if path in paths and pattern.search(text):
+                return path
+    return None
+
+
+def derive_mapping(fields, context_paths):
+    """
+    Match fields to context paths with the keyword rules.
+
+    Args:
+        fields: FormFields from extract_fields
+        context_paths: The paths context_data provides
+
+    Returns:
+        tuple: (mapping, unmapped) where mapping is {field id: entry} and
+        unmapped lists the fields no rule matched. An entry is
+        {"path": ...} for text fields, {"path": ..., "option": label} for a
+        checkbox or radio, and {"path": None} for fields left to the signer.
+    """
+    paths = set(context_paths)
+    mapping = {}
+    unmapped = []
+    for field in fields:
+        descriptions = [field.label, field.attrs.get("placeholder"), field.before,
+                        field.heading, field.attrs.get("name"), field.id]
+        if field.is_choice:
+            # The option's own label says nothing about what the group is
+            option = field.label or field.after
+            if MANUAL.search(_normalize(option) + " " + _normalize(field.heading)):
+                mapping[field.id] = {"path": None}
+                continue
+            path = _match(CHOICE_RULES, [field.heading, field.attrs.get("name"), field.before], paths)
+            if path:
+                mapping[field.id] = {"path": path, "option": option}
+            else:
+                unmapped.append(field)
+            continue
+        if field.tag == "input" and field.type not in TEXT_TYPES:
+            continue
+
+        if any(MANUAL.search(_normalize(text)) for text in descriptions[:3] if text):
+            mapping[field.id] = {"path": None}
+            continue
+        path = _match(TEXT_RULES, descriptions, paths)
+        if path:
+            mapping[field.id] = {"path": path}
+        else:
+            unmapped.append(field)
+    return mapping, unmapped
+
+
+def _set_attribute(tag_text, name, value=None):
+    """Set (or, with value False, remove) an attribute in a start tag"""
+    tag_text = re.sub(
+        rf"""\s{name}(\s*=\s*("[^"]*"|'[^']*'|[^\s"'>/]+))?(?=[\s/>])""",
+        "",
+        tag_text,
+        flags=re.IGNORECASE,
+    )
+    if value is False:
+        return tag_text
+    attribute = f" {name}" if value is None else f' {name}="{escape(value, quote=True)}"'
+    closing = "/>" if tag_text.endswith("/>") else ">"
+    return tag_text[:-len(closing)].rstrip() + attribute + closing
+
+
+def _fits(field, value):
+    """Whether a value can go into a field of its input type"""
+    if field.type == "date":
+        try:
+            date.fromisoformat(value[:10])
+        except ValueError:
+            return False
+        return True
+    if field.type == "number":
+        try:
+            float(value)
+        except ValueError:
+            return False
+    return True
+
+
+def _chosen(option, value):
+    wanted = {_normalize(part) for part in re.split(r"[,;]", value)}
+    return _normalize(option) in wanted
+
+
+def apply_mapping(html, fields, mapping, context_data, note=PREFILL_NOTE):
+    """
+    Fill a template by rewriting the start tags of its mapped fields.
+
+    Args:
+        html: The template HTML fields were extracted from
+        fields: FormFields from extract_fields
+        mapping: {field id: entry} from derive_mapping
+        context_data: Dictionary with context about patient, doctor, practice, etc.
+        note: HTML inserted at the top of the body when anything was filled
+
+    Returns:
+        tuple: (filled HTML, number of fields filled)
+    """
+    values = flatten_context(context_data)
+    edits = []  # (start, end, replacement)
+    filled = 0
+    chosen_groups = set()
+
+    for field in fields:
+        entry = mapping.get(field.id)
+        if not entry or not entry.get("path"):
+            continue
+        value = values.get(entry["path"], "").strip()
+        if not value:
+            continue
+        tag_text = html[field.start:field.end]
+
+        if field.is_choice:
+            if not _chosen(entry.get("option", ""), value):
+                continue
+            edits.append((field.start, field.end, _set_attribute(tag_text, "checked")))
+            if field.type == "radio" and field.attrs.get("name"):
+                chosen_groups.add(field.attrs["name"])
+        elif field.tag == "select":
+            matches = [_chosen(option_value, value) or _chosen(text, value)
+                       for _, _, option_value, text in field.options]
+            if not any(matches):
+                continue
+            for (start, end, _, _), selected in zip(field.options, matches):
+                edits.append((start, end, _set_attribute(html[start:end], "selected", None if selected else False)))
+        elif field.tag == "textarea":
+            if field.content_end is None:
+                continue
+            edits.append((field.end, field.content_end, escape(value, quote=False)))
+        else:
+            if not _fits(field, value):
+                continue
+            edits.append((field.start, field.end, _set_attribute(tag_text, "value", value[:10] if field.type == "date" else value)))
+        filled += 1
+
+    # A radio chosen from context replaces the group's default choice
+    for field in fields:
+        if field.type == "radio" and field.attrs.get("name") in chosen_groups and "checked" in field.attrs:
+            if not any(start == field.start for start, _, _ in edits):
+                edits.append((field.start, field.end, _set_attribute(html[field.start:field.end], "checked", False)))
+
+    if filled and note:
+        body = re.search(r"<body[^>]*>", html, re.IGNORECASE)
+        position = body.end() if body else 0
+        edits.append((position, position, note))
+
+    parts = []
+    cursor = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        parts.append(html[cursor:start])
+        parts.append(replacement)
+        cursor = end
+    parts.append(html[cursor:])
+    return "".join(parts), filled
+
+
+def mapping_prompt(fields, context_paths):
+    """Prompt asking the model to map the fields no rule matched"""
+    listing = "\n".join(f"- id={field.id}: {field.describe()}" for field in fields)
+    return f"""These inputs of a medical form could not be matched to the data we have.
+
+For each input, pick the context path whose value should be prefilled into it,
+or null if none fits (signatures, dates of signing, yes/no questions and
+anything the patient or clinician must answer themselves should be null).
+For a checkbox or radio, pick the path whose value is compared with the
+option's label.
+
+INPUTS:
+{listing}
+
+CONTEXT PATHS:
+{json.dumps(sorted(context_paths))}
+
+Reply with ONLY a JSON object mapping each input id to a context path or null.
+"""
+
+
+def parse_mapping_reply(text, fields, context_paths):
+    """Turn the model's reply into mapping entries, ignoring anything invalid"""
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        return {}
+    try:
+        reply = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    if not isinstance(reply, dict):
+        return {}
+
+    paths = set(context_paths)
+    mapping = {}
+    for field in fields:
+        path = reply.get(field.id)
+        if path is not None and path not in paths:
+            continue
+        if field.is_choice and path:
+            mapping[field.id] = {"path": path, "option": field.label or field.after}
+        else:
+            mapping[field.id] = {"path": path}
+    return mapping
@@ -0,0 +1,308 @@
+import asyncio
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Path to the main application database (overridable from the environment,
+# e.g. to point a benchmark at a scratch database)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("CONFORM_DB_PATH", os.path.join(BASE_DIR, "conform.db"))
+
+# Pragmas applied to every pooled connection. WAL lets readers run while the
+# writer commits, NORMAL sync is safe under WAL, and the cache/mmap sizes keep
+# the hot pages of conform.db in memory between requests.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # negative value = KiB, so ~16 MB per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+# Number of prepared statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Maximum number of reader connections kept open at once
+MAX_READERS = int(os.getenv("CONFORM_DB_MAX_READERS", "16"))
+
+# Seconds to wait for a free connection before giving up
+CHECKOUT_TIMEOUT = 30.0
+
+
+class ConnectionPool:
+    """
+    Pool of long-lived SQLite connections.
+
+    Readers are checked out from a bounded pool so concurrent requests can read
+    in parallel under WAL. All writes go through a single writer connection
+    guarded by a lock, which serializes writers inside the process instead of
+    letting them spin on SQLITE_BUSY.
+    """
+
+    def __init__(self, db_path, max_readers=MAX_READERS, pragmas=None):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+
+        self._idle_readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_count_lock = threading.Lock()
+
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "connectionsOpened": 0,
+            "readerCheckouts": 0,
+            "readerWaits": 0,
+            "readerWaitSeconds": 0.0,
+            "readersInUse": 0,
+            "writerAcquisitions": 0,
+            "writerWaitSeconds": 0.0,
+            "maxWriterWaitSeconds": 0.0,
+            "writerInUse": False,
+            "rollbacks": 0,
+        }
+
+    def _connect(self):
+        """Open a new connection and apply the pool pragmas"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            timeout=self.pragmas.get("busy_timeout", 5000) / 1000,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+        with self._stats_lock:
+            self._stats["connectionsOpened"] += 1
+        return conn
+
+    def _bump(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def acquire_reader(self):
+        """Check out a reader connection, opening a new one if the pool is not full"""
+        try:
+            conn = self._idle_readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._reader_count_lock:
+                if self._reader_count < self.max_readers:
+                    self._reader_count += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._reader_count_lock:
+                        self._reader_count -= 1
+                    raise
+            else:
+                start = time.monotonic()
+                conn = self._idle_readers.get(timeout=CHECKOUT_TIMEOUT)
+                self._bump("readerWaits")
+                self._bump("readerWaitSeconds", time.monotonic() - start)
+
+        self._bump("readerCheckouts")
+        self._bump("readersInUse")
+        return conn
+
+    def release_reader(self, conn):
+        """Return a reader connection to the pool"""
+        if conn.in_transaction:
+            conn.rollback()
+            self._bump("rollbacks")
+        self._bump("readersInUse", -1)
+        self._idle_readers.put(conn)
+
+    def acquire_writer(self):
+        """Take the single writer connection, waiting for other writers to finish"""
+        start = time.monotonic()
+        if not self._writer_lock.acquire(timeout=CHECKOUT_TIMEOUT):
+            raise TimeoutError("Timed out waiting for the database writer")
+        waited = time.monotonic() - start
+
+        try:
+            if self._writer is None:
+                self._writer = self._connect()
+        except Exception:
+            self._writer_lock.release()
+            raise
+
+        with self._stats_lock:
+            self._stats["writerAcquisitions"] += 1
+            self._stats["writerWaitSeconds"] += waited
+            self._stats["maxWriterWaitSeconds"] = max(self._stats["maxWriterWaitSeconds"], waited)
+            self._stats["writerInUse"] = True
+        return self._writer
+
+    def release_writer(self, conn):
+        """Roll back anything left uncommitted and hand the writer to the next caller"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+                self._bump("rollbacks")
+        finally:
+            with self._stats_lock:
+                self._stats["writerInUse"] = False
+            self._writer_lock.release()
+
+    @contextmanager
+    def read(self):
+        """Context manager yielding a pooled reader connection"""
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    @contextmanager
+    def write(self):
+        """
+        Context manager yielding the writer connection.
+
+        Commits when the block exits cleanly and rolls back if it raises.
+        """
+        conn = self.acquire_writer()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        finally:
+            self.release_writer(conn)
+
+    def stats(self):
+        """Return a snapshot of pool counters for monitoring"""
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot.update({
+            "dbPath": self.db_path,
+            "maxReaders": self.max_readers,
+            "readersOpen": self._reader_count,
+            "readersIdle": self._idle_readers.qsize(),
+            "writerOpen": self._writer is not None,
+            "statementCacheSize": STATEMENT_CACHE_SIZE,
+            "pragmas": self.pragmas,
+        })
+        return snapshot
+
+    def close_all(self):
+        """Close every idle connection (used at shutdown)"""
+        while True:
+            try:
+                conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._reader_count_lock:
+                self._reader_count -= 1
+
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+
+# Result of a single write statement run through AsyncDatabase.execute
+WriteResult = namedtuple("WriteResult", ["lastrowid", "rowcount"])
+
+
+class AsyncDatabase:
+    """
+    Async data-access layer over a ConnectionPool.
+
+    Every call checks out a pooled connection on a dedicated executor thread
+    and returns it as soon as the statement finishes, so async routes can
+    await database work without blocking the event loop or holding a
+    connection across other awaits.
+    """
+
+    def __init__(self, pool, max_workers=None):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or pool.max_readers + 1,
+            thread_name_prefix="conform-db",
+        )
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def fetchone(self, sql, params=()):
+        """Run a read query and return the first row (or None)"""
+        def work():
+            with self.pool.read() as conn:
+                return conn.execute(sql, params).fetchone()
+        return await self._run(work)
+
+    async def fetchall(self, sql, params=()):
+        """Run a read query and return every row"""
+        def work():
+            with self.pool.read() as conn:
+                return conn.execute(sql, params).fetchall()
+        return await self._run(work)
+
+    async def execute(self, sql, params=()):
+        """Run a single write statement on the writer connection and commit it"""
+        def work():
+            with self.pool.write() as conn:
+                cursor = conn.execute(sql, params)
+                return WriteResult(cursor.lastrowid, cursor.rowcount)
+        return await self._run(work)
+
+    async def read(self, fn, *args, **kwargs):
+        """Call fn(conn, *args, **kwargs) with a reader connection"""
+        def work():
+            with self.pool.read() as conn:
+                return fn(conn, *args, **kwargs)
+        return await self._run(work)
+
+    async def transaction(self, fn, *args, **kwargs):
+        """
+        Call fn(conn, *args, **kwargs) with the writer connection.
+
+        The transaction commits when fn returns and rolls back if it raises.
+        """
+        def work():
+            with self.pool.write() as conn:
+                return fn(conn, *args, **kwargs)
+        return await self._run(work)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+# Process-wide pool shared by every route and background worker
+pool = ConnectionPool(DB_PATH)
+
+# Async facade over the same pool for async routes
+async_db = AsyncDatabase(pool)
+
+
+# FastAPI dependencies
+def get_db():
+    """Yield a pooled reader connection for the duration of a request"""
+    conn = pool.acquire_reader()
+    try:
+        yield conn
+    finally:
+        pool.release_reader(conn)
+
+
+def get_async_db():
+    """Return the shared AsyncDatabase for async routes"""
+    return async_db
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+# Seconds a cached summary is served before it is rebuilt, which bounds how
+# stale it gets when another process (a job worker, the CLI) changes the data
+HEALTHCARE_SYSTEMS_TTL = float(os.getenv("CONFORM_HEALTHCARE_SYSTEMS_TTL", "60"))
+
+# Every healthcare system with its user and template counts in one pass: each
+# side is grouped once (over idx_users_hospital_system_id and the partial
+# idx_universal_pdfs_hospital_updated) and joined back to the systems
+SUMMARY_QUERY = '''
+SELECT hs.id, hs.name,
+       COALESCE(u.user_count, 0) AS user_count,
+       COALESCE(t.template_count, 0) AS template_count
+FROM healthcare_systems hs
+LEFT JOIN (
+    SELECT hospital_system_id, COUNT(*) AS user_count
+    FROM users
+    WHERE hospital_system_id IS NOT NULL
+    GROUP BY hospital_system_id
+) u ON u.hospital_system_id = hs.id
+LEFT JOIN (
+    SELECT hospital_system, COUNT(*) AS template_count
+    FROM universal_pdfs
+    WHERE html_filename IS NOT NULL
+    GROUP BY hospital_system
+) t ON t.hospital_system = hs.name
+ORDER BY hs.name
+'''
+
+
+def load_healthcare_systems(conn):
+    """Run the summary query and shape it for /api/healthcare-systems"""
+    return [
+        {
+            "id": row['id'],
+            "name": row['name'],
+            "userCount": row['user_count'],
+            "templateCount": row['template_count'],
+        }
+        for row in conn.execute(SUMMARY_QUERY).fetchall()
+    ]
+
+
+class HealthcareSystemsCache:
+    """
+    The healthcare system summary, cached until a write invalidates it or
+    the TTL runs out.
+
+    Writers in this process (signup, user updates, template generation and
+    deletion) call invalidate(); the TTL covers writes from other processes.
+    """
+
+    def __init__(self, ttl=HEALTHCARE_SYSTEMS_TTL):
+        self.ttl = ttl
+        self._systems = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, conn):
+        """Return the cached summary, loading it with conn on a miss"""
+        with self._lock:
+            if self._systems is not None and time.monotonic() < self._expires_at:
+                self._stats["hits"] += 1
+                return self._systems
+            self._stats["misses"] += 1
+            generation = self._generation
+
+        systems = load_healthcare_systems(conn)
+
+        with self._lock:
+            # Don't cache a result an invalidation raced with
+            if generation == self._generation:
+                self._systems = systems
+                self._expires_at = time.monotonic() + self.ttl
+        return systems
+
+    def invalidate(self):
+        with self._lock:
+            self._systems = None
+            self._generation += 1
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        """Return cache counters for monitoring"""
+        with self._lock:
+            return {**self._stats, "cached": self._systems is not None, "ttlSeconds": self.ttl}
+
+
+# Process-wide cache shared by the routes and chain1
+healthcare_systems_cache = HealthcareSystemsCache()
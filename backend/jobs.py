@@ -0,0 +1,379 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from db import DB_PATH, ConnectionPool, pool as default_pool
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Job kinds
+PDF_TO_HTML = "pdf_to_html"
+
+# Worker configuration (overridable from the environment)
+WORKER_COUNT = int(os.getenv("CONFORM_JOB_WORKERS", "2"))
+WORKER_MODE = os.getenv("CONFORM_JOB_WORKER_MODE", "thread")  # "thread" or "process"
+POLL_INTERVAL = float(os.getenv("CONFORM_JOB_POLL_INTERVAL", "1.0"))
+
+# A lease is extended every LEASE_SECONDS / 3 while a handler runs; if the
+# worker dies the job becomes claimable again once the lease expires.
+LEASE_SECONDS = 120.0
+
+# Retry backoff: BACKOFF_BASE * 2 ** (attempt - 1), capped at BACKOFF_MAX
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def ensure_jobs_table(conn):
+    """Create the jobs table and its indexes if they don't exist"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        job_key TEXT,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        priority INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_after REAL NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires_at REAL,
+        last_error TEXT,
+        result TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, priority DESC, run_after, id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_kind_key ON jobs(kind, job_key, id DESC)"
+    )
+
+
+def enqueue(conn, kind, payload, job_key=None, priority=0, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Add a job to the queue using the caller's (writer) connection.
+
+    Enqueueing on the caller's connection lets a route record its own rows and
+    the job in a single transaction.
+
+    Returns:
+        int: The new job ID
+    """
+    cursor = conn.execute(
+        """
+        INSERT INTO jobs (kind, job_key, payload, priority, max_attempts, run_after)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (kind, job_key, json.dumps(payload), priority, max_attempts, time.time()),
+    )
+    return cursor.lastrowid
+
+
+def get_latest_job(conn, kind, job_key):
+    """Return the most recent job for a kind/key pair as a dict, or None"""
+    row = conn.execute(
+        """
+        SELECT id, kind, job_key, status, priority, attempts, max_attempts,
+               last_error, created_at, updated_at, finished_at
+        FROM jobs
+        WHERE kind = ? AND job_key = ?
+        ORDER BY id DESC
+        LIMIT 1
+        """,
+        (kind, job_key),
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def claim_job(db_pool, worker_id, kinds):
+    """
+    Lease the next runnable job for this worker.
+
+    A job is runnable when it is queued and its backoff has elapsed, or when
+    it is running under a lease that has expired and has attempts left.
+    Higher priority first, then FIFO. Expired jobs that are out of attempts
+    (their worker crashed or hung on every try) are marked failed here, so a
+    poison job is never reclaimed forever.
+
+    Returns:
+        dict or None: The claimed job with its payload decoded
+    """
+    now = time.time()
+    placeholders = ",".join("?" for _ in kinds)
+
+    # Idle workers poll every POLL_INTERVAL; only take the writer when a
+    # reader sees something to claim or fail, so an empty queue costs
+    # request writes nothing
+    with db_pool.read() as conn:
+        pending = conn.execute(
+            f"""
+            SELECT 1 FROM jobs
+            WHERE kind IN ({placeholders})
+              AND ((status = ? AND run_after <= ?)
+                   OR (status = ? AND lease_expires_at < ?))
+            LIMIT 1
+            """,
+            (*kinds, QUEUED, now, RUNNING, now),
+        ).fetchone()
+    if not pending:
+        return None
+
+    with db_pool.write() as conn:
+        abandoned = conn.execute(
+            f"""
+            UPDATE jobs
+            SET status = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL,
+                updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE kind IN ({placeholders})
+              AND status = ? AND lease_expires_at < ? AND attempts >= max_attempts
+            """,
+            (FAILED, "Lease expired on the final attempt (worker crashed or hung)", *kinds, RUNNING, now),
+        ).rowcount
+        if abandoned:
+            print(f"Marked {abandoned} abandoned job(s) as failed")
+
+        row = conn.execute(
+            f"""
+            SELECT * FROM jobs
+            WHERE kind IN ({placeholders})
+              AND ((status = ? AND run_after <= ?)
+                   OR (status = ? AND lease_expires_at < ? AND attempts < max_attempts))
+            ORDER BY priority DESC, id
+            LIMIT 1
+            """,
+            (*kinds, QUEUED, now, RUNNING, now),
+        ).fetchone()
+        if not row:
+            return None
+
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = ?, attempts = attempts + 1, lease_owner = ?,
+                lease_expires_at = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (RUNNING, worker_id, now + LEASE_SECONDS, row["id"]),
+        )
+
+    job = dict(row)
+    job["attempts"] += 1
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+
+def extend_lease(db_pool, job_id, worker_id):
+    """Push out the lease on a job this worker still holds"""
+    with db_pool.write() as conn:
+        conn.execute(
+            "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+            (time.time() + LEASE_SECONDS, job_id, worker_id, RUNNING),
+        )
+
+
+def complete_job(db_pool, job_id, worker_id, result=None):
+    """Mark a job as succeeded"""
+    with db_pool.write() as conn:
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = ?, result = ?, lease_owner = NULL, lease_expires_at = NULL,
+                updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND lease_owner = ?
+            """,
+            (SUCCEEDED, json.dumps(result), job_id, worker_id),
+        )
+
+
+def fail_job(db_pool, job, worker_id, error):
+    """Requeue a failed job with exponential backoff, or mark it failed once out of attempts"""
+    if job["attempts"] < job["max_attempts"]:
+        delay = min(BACKOFF_BASE * 2 ** (job["attempts"] - 1), BACKOFF_MAX)
+        status, run_after = QUEUED, time.time() + delay
+    else:
+        status, run_after = FAILED, job["run_after"]
+
+    with db_pool.write() as conn:
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = ?, run_after = ?, last_error = ?, lease_owner = NULL,
+                lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN ? = ? THEN CURRENT_TIMESTAMP ELSE NULL END
+            WHERE id = ? AND lease_owner = ?
+            """,
+            (status, run_after, error, status, FAILED, job["id"], worker_id),
+        )
+    return status
+
+
+# Job handlers, keyed by kind. Each takes the decoded payload and returns a
+# JSON-serializable result, raising to signal failure.
+HANDLERS = {}
+
+
+def handler(kind):
+    """Decorator registering a job handler for a kind"""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+@handler(PDF_TO_HTML)
+def convert_pdf_to_html(payload):
+    """Generate the HTML form for an uploaded PDF with chain1 (optionally rerunning one stage)"""
+    # Imported lazily so worker processes only pay for these when they run a job
+    import pdf_utils
+    from chains.chain1 import chain1
+
+    pdf_path = payload["pdf_path"]
+    hospital_system = payload.get("hospital_system")
+    rerun_stage = payload.get("rerun_stage")
+
+    print(f"Generating field mapping string for {pdf_path}")
+    field_mapping_string = pdf_utils.generate_field_mapping_string(pdf_path)
+    print(f"Field mapping string generated:\n{field_mapping_string}")
+
+    if not chain1(pdf_path, field_mapping_string, hospital_system, rerun_stage=rerun_stage):
+        raise RuntimeError(f"chain1 failed for {os.path.basename(pdf_path)}")
+    return {"originalFilename": os.path.basename(pdf_path)}
+
+
+def run_worker(db_pool, worker_id, kinds, stop_event, poll_interval=POLL_INTERVAL):
+    """Claim and run jobs until stop_event is set"""
+    print(f"Job worker {worker_id} started for {kinds}")
+    while not stop_event.is_set():
+        try:
+            job = claim_job(db_pool, worker_id, kinds)
+        except Exception as e:
+            print(f"Job worker {worker_id} failed to claim a job: {str(e)}")
+            job = None
+
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        print(f"Job worker {worker_id} running job {job['id']} ({job['kind']}, attempt {job['attempts']})")
+
+        # Keep the lease alive while the handler runs
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(LEASE_SECONDS / 3):
+                try:
+                    extend_lease(db_pool, job["id"], worker_id)
+                except Exception as e:
+                    print(f"Job worker {worker_id} failed to extend lease on job {job['id']}: {str(e)}")
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+        try:
+            result = HANDLERS[job["kind"]](job["payload"])
+            done.set()
+            complete_job(db_pool, job["id"], worker_id, result)
+            print(f"Job {job['id']} succeeded")
+        except Exception as e:
+            done.set()
+            print(f"Job {job['id']} raised: {str(e)}")
+            print(f"Traceback: {traceback.format_exc()}")
+            try:
+                status = fail_job(db_pool, job, worker_id, str(e))
+                print(f"Job {job['id']} is now {status}")
+            except Exception as update_error:
+                print(f"Job worker {worker_id} could not record failure of job {job['id']}: {str(update_error)}")
+        finally:
+            heartbeat_thread.join()
+
+    print(f"Job worker {worker_id} stopped")
+
+
+def _run_worker_process(worker_id, kinds, stop_event, poll_interval):
+    """Entry point for process-mode workers, which need their own connection pool"""
+    run_worker(ConnectionPool(DB_PATH), worker_id, kinds, stop_event, poll_interval)
+
+
+class JobWorkerPool:
+    """
+    A set of job workers running as threads or processes.
+
+    Several pools (for example one per uvicorn worker, or a standalone
+    `python jobs.py`) can share the same queue; leasing ensures each job is
+    run by one worker at a time.
+    """
+
+    def __init__(self, size=WORKER_COUNT, mode=WORKER_MODE, kinds=None, poll_interval=POLL_INTERVAL):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown job worker mode: {mode}")
+        self.size = size
+        self.mode = mode
+        self.kinds = list(kinds or HANDLERS.keys())
+        self.poll_interval = poll_interval
+        self._workers = []
+        self._stop_event = None
+
+    def start(self):
+        if self._workers or self.size <= 0:
+            return
+
+        prefix = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        if self.mode == "thread":
+            self._stop_event = threading.Event()
+            for i in range(self.size):
+                worker = threading.Thread(
+                    target=run_worker,
+                    args=(default_pool, f"{prefix}-t{i}", self.kinds, self._stop_event, self.poll_interval),
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+        else:
+            ctx = multiprocessing.get_context("spawn")
+            self._stop_event = ctx.Event()
+            for i in range(self.size):
+                worker = ctx.Process(
+                    target=_run_worker_process,
+                    args=(f"{prefix}-p{i}", self.kinds, self._stop_event, self.poll_interval),
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+        print(f"Started {self.size} job workers ({self.mode} mode)")
+
+    def stop(self, timeout=5.0):
+        if not self._workers:
+            return
+        self._stop_event.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+
+if __name__ == "__main__":
+    # Run a standalone worker pool against the shared queue
+    from migrations import migrate_database
+
+    migrate_database()
+
+    workers = JobWorkerPool()
+    workers.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        workers.stop()
@@ -0,0 +1,455 @@
+"""
+Shared gateway for model calls.
+
+Every chain sends its requests through the process-wide llm_gateway. The
+gateway runs an event loop on a background thread that owns a single
+AsyncAnthropic client, so all calls reuse one connection pool, and a
+semaphore per model bounds how many generations are in flight at once.
+
+The chains run in threadpools and job workers, so they call the blocking
+complete(); async code awaits acomplete(). Either way the thread that asked
+only waits on a future, and the generation itself is one task on the
+gateway loop, which is what lets one worker keep dozens going.
+
+Generations come from a backend chosen by CONFORM_LLM_BACKEND: "anthropic"
+(the default) or "stub", a deterministic offline backend for benchmarks
+and tests that replays recorded responses and otherwise synthesizes one.
+Record responses for it with CONFORM_LLM_RECORD_DIR and replay them with
+CONFORM_LLM_STUB_DIR.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+import uuid
+
+from dotenv import load_dotenv
+
+try:
+    import anthropic
+except ImportError:  # optional with CONFORM_LLM_BACKEND=stub (e.g. on an offline box)
+    anthropic = None
+
+load_dotenv()
+
+# Generations in flight per model, per process (overridable from the environment)
+LLM_MAX_CONCURRENCY = int(os.getenv("CONFORM_LLM_MAX_CONCURRENCY", "8"))
+
+# Seconds a single generation may run once it has a slot, and to connect
+LLM_TIMEOUT = float(os.getenv("CONFORM_LLM_TIMEOUT", "900"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("CONFORM_LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("CONFORM_LLM_MAX_RETRIES", "2"))
+
+# Backend serving generations: "anthropic" or "stub"
+LLM_BACKEND = os.getenv("CONFORM_LLM_BACKEND", "anthropic")
+
+# Directory every response is saved to (by request key), for later replay
+LLM_RECORD_DIR = os.getenv("CONFORM_LLM_RECORD_DIR")
+
+# Recorded responses the stub replays, and the latency it simulates per call
+LLM_STUB_DIR = os.getenv("CONFORM_LLM_STUB_DIR")
+LLM_STUB_LATENCY = float(os.getenv("CONFORM_LLM_STUB_LATENCY", "0"))
+
+# How often blocked callers check their cancel token, and routes check for
+# a disconnected client
+CANCEL_POLL_INTERVAL = 0.5
+
+
+class LLMTimeout(Exception):
+    """A generation ran past LLM_TIMEOUT"""
+
+
+class LLMCancelled(Exception):
+    """The caller gave up on a generation, e.g. because its client disconnected"""
+
+
+class CancelToken:
+    """Set by whoever is waiting on the work to abandon its model calls"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+async def run_cancellable(request, func, *args):
+    """
+    Await a coroutine function as a task, cancelling it (and with it the
+    model calls it is awaiting) if the client disconnects.
+
+    Args:
+        request: The route's Request, polled for a disconnect
+        func: The coroutine function (e.g. achain2) and its args
+
+    Returns:
+        Whatever func returns
+
+    Raises:
+        LLMCancelled: The client disconnected first
+    """
+    task = asyncio.ensure_future(func(*args))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=CANCEL_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                print("Client disconnected, cancelling its model calls")
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise LLMCancelled("Client disconnected")
+    finally:
+        task.cancel()
+
+
+def request_key(model, messages, max_tokens):
+    """Hex digest identifying a request, used to name recorded responses"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "max_tokens": max_tokens},
+        sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnthropicBackend:
+    """Generations from the Anthropic Messages API"""
+
+    name = "anthropic"
+
+    def __init__(self, timeout, connect_timeout, max_retries):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self._client = None
+
+    def _get_client(self):
+        # Only called on the gateway loop, so the client's connections stay on it
+        if self._client is None:
+            if anthropic is None:
+                raise RuntimeError("The anthropic package is required for the anthropic LLM backend")
+            self._client = anthropic.AsyncAnthropic(
+                api_key=os.getenv("ANTHROPIC_API_KEY"),
+                timeout=anthropic.Timeout(self.timeout, connect=self.connect_timeout),
+                max_retries=self.max_retries,
+            )
+        return self._client
+
+    async def generate(self, messages, model, max_tokens, options):
+        parts = []
+        async with self._get_client().messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            messages=messages,
+            **options,
+        ) as stream:
+            async for text in stream.text_stream:
+                parts.append(text)
+        return "".join(parts)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+# "<key>: Page <n>, <field name>, (<x>, <y>)" lines of a PDF field mapping
+_FIELD_LINE = re.compile(r"^\s*(\d+): Page (\d+), (.*), \((-?\d+), (-?\d+)\)\s*$", re.MULTILINE)
+_HTML_BLOCK = re.compile(r"<!DOCTYPE html.*?</html>|<html.*?</html>|<form.*?</form>", re.DOTALL | re.IGNORECASE)
+
+
+class StubBackend:
+    """
+    Deterministic offline generations.
+
+    A response recorded for the same request (in replay_dir) is returned as
+    is. Otherwise one is synthesized from the prompt: HTML in the prompt is
+    returned unchanged (a faithful "rewrite"), a PDF field mapping becomes a
+    plain form with one input per field, a request for JSON gets "{}", and
+    anything else gets a short fixed reply.
+    """
+
+    name = "stub"
+
+    def __init__(self, replay_dir=LLM_STUB_DIR, latency=LLM_STUB_LATENCY):
+        self.replay_dir = replay_dir
+        self.latency = latency
+
+    async def generate(self, messages, model, max_tokens, options):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.replay_dir:
+            path = os.path.join(self.replay_dir, f"{request_key(model, messages, max_tokens)}.txt")
+            # Read off the gateway loop so a replay doesn't stall other calls
+            recorded = await asyncio.get_running_loop().run_in_executor(None, _read_recording, path)
+            if recorded is not None:
+                return recorded
+        return synthesize_response(_prompt_text(messages))
+
+    async def close(self):
+        pass
+
+
+def _read_recording(path):
+    """A recorded response, or None if there isn't one"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _prompt_text(messages):
+    """The text blocks of the messages, joined"""
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+            continue
+        for block in content or []:
+            if block.get("type") == "text":
+                parts.append(block.get("text", ""))
+    return "\n".join(parts)
+
+
+def synthesize_response(prompt):
+    """Build the stub's reply to a prompt (see StubBackend)"""
+    match = _HTML_BLOCK.search(prompt)
+    if match:
+        return f"```html\n{match.group(0)}\n```"
+
+    fields = _FIELD_LINE.findall(prompt)
+    if fields:
+        return f"```html\n{synthesize_form(fields)}\n```"
+
+    if "json" in prompt.lower():
+        return "{}"
+    return f"Stub response to a {len(prompt)}-character prompt."
+
+
+def synthesize_form(fields):
+    """A minimal Tailwind form with one labelled input per (key, page, name, x, y) field"""
+    rows = []
+    for key, _, name, _, _ in fields:
+        input_type = "date" if re.search(r"\bdate\b", name, re.IGNORECASE) else "text"
+        label = html.escape(name.strip())
+        rows.append(
+            f'    <div class="mb-4">\n'
+            f'      <label for="{key}" class="block mb-1">{label}</label>\n'
+            f'      <input id="{key}" type="{input_type}" class="w-full p-2 border border-gray-300 rounded-md">\n'
+            f'    </div>'
+        )
+    return (
+        '<!DOCTYPE html>\n<html>\n<head>\n  <meta charset="utf-8">\n'
+        '  <script src="https://cdn.tailwindcss.com"></script>\n</head>\n<body class="p-8">\n'
+        '  <form id="typeform" action="http://localhost:6969/send_form" method="post">\n'
+        + "\n".join(rows)
+        + '\n    <button type="submit" class="bg-green-600 text-white px-4 py-2 rounded-md">Submit</button>\n'
+        '  </form>\n</body>\n</html>'
+    )
+
+
+# Backends selectable with CONFORM_LLM_BACKEND
+BACKENDS = {
+    AnthropicBackend.name: AnthropicBackend,
+    StubBackend.name: StubBackend,
+}
+
+
+class LLMGateway:
+    """
+    Process-wide entry point for model calls.
+
+    The loop thread and client are created on first use, and again after a
+    fork (job workers in process mode inherit the module but not the thread).
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, timeout=LLM_TIMEOUT,
+                 connect_timeout=LLM_CONNECT_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                 backend=LLM_BACKEND, record_dir=LLM_RECORD_DIR):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown LLM backend {backend!r}. Available: {', '.join(BACKENDS)}")
+        if backend == AnthropicBackend.name and anthropic is None:
+            print("The anthropic package is not installed; model calls will fail (set CONFORM_LLM_BACKEND=stub to run offline)")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backend_name = backend
+        self.record_dir = record_dir
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._backend = None
+        self._semaphores = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True).start()
+                self._loop = loop
+                self._pid = os.getpid()
+                self._backend = None
+                self._semaphores = {}
+            return self._loop
+
+    @property
+    def cache_tag(self):
+        """
+        Suffix for the version of anything cached from generations, so output
+        of the stub is never served once the real backend is back.
+        """
+        return "" if self.backend_name == AnthropicBackend.name else f"+{self.backend_name}"
+
+    def _get_backend(self):
+        # Only called on the gateway loop, so a backend's connections stay on it
+        if self._backend is None:
+            if self.backend_name == AnthropicBackend.name:
+                self._backend = AnthropicBackend(self.timeout, self.connect_timeout, self.max_retries)
+            else:
+                self._backend = BACKENDS[self.backend_name]()
+        return self._backend
+
+    def _record(self, messages, model, max_tokens, text):
+        # Runs in the loop's executor: file I/O here would otherwise stall
+        # every generation in flight on the gateway loop
+        try:
+            os.makedirs(self.record_dir, exist_ok=True)
+            path = os.path.join(self.record_dir, f"{request_key(model, messages, max_tokens)}.txt")
+            tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error recording {model} response: {str(e)}")
+
+    def _count(self, model, counter, delta=1):
+        with self._stats_lock:
+            model_stats = self._stats.setdefault(model, {
+                "waiting": 0, "inFlight": 0, "completed": 0,
+                "failed": 0, "cancelled": 0, "timeouts": 0,
+            })
+            model_stats[counter] += delta
+
+    async def _generate(self, messages, model, max_tokens, options):
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            semaphore = self._semaphores[model] = asyncio.Semaphore(self.max_concurrency)
+
+        self._count(model, "waiting")
+        acquired = False
+        try:
+            async with semaphore:
+                acquired = True
+                self._count(model, "waiting", -1)
+                self._count(model, "inFlight")
+                try:
+                    text = await asyncio.wait_for(
+                        self._get_backend().generate(messages, model, max_tokens, options), self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    self._count(model, "timeouts")
+                    raise LLMTimeout(f"{model} generation timed out after {self.timeout:.0f}s")
+                finally:
+                    self._count(model, "inFlight", -1)
+        except asyncio.CancelledError:
+            self._count(model, "cancelled")
+            raise
+        except Exception:
+            self._count(model, "failed")
+            raise
+        finally:
+            if not acquired:
+                self._count(model, "waiting", -1)
+
+        self._count(model, "completed")
+        if self.record_dir:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._record, messages, model, max_tokens, text
+            )
+        return text
+
+    def _submit(self, messages, model, max_tokens, options):
+        options = {name: value for name, value in options.items() if value is not None}
+        return asyncio.run_coroutine_threadsafe(
+            self._generate(messages, model, max_tokens, options), self._ensure_loop()
+        )
+
+    def complete(self, messages, *, model, max_tokens, temperature=None, thinking=None,
+                 cancel_token=None):
+        """
+        Generate a response and return its text, blocking the calling thread.
+
+        Args:
+            messages: Messages API messages
+            model: Model name
+            max_tokens: Output token limit
+            temperature, thinking: Passed through when given
+            cancel_token: CancelToken to abandon the call with, if any
+
+        Raises:
+            LLMTimeout, LLMCancelled, or the API's own errors
+        """
+        future = self._submit(messages, model, max_tokens,
+                              {"temperature": temperature, "thinking": thinking})
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                if future.done():
+                    raise
+                if cancel_token is not None and cancel_token.cancelled:
+                    future.cancel()
+                    raise LLMCancelled(f"{model} generation cancelled")
+
+    async def acomplete(self, messages, *, model, max_tokens, temperature=None, thinking=None):
+        """complete() for async callers; cancelling the awaiting task cancels the generation"""
+        future = self._submit(messages, model, max_tokens,
+                              {"temperature": temperature, "thinking": thinking})
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def close(self):
+        """Close the backend's connections and stop the loop thread"""
+        with self._lock:
+            loop, backend = self._loop, self._backend
+            self._loop = None
+            self._backend = None
+        if loop is None or self._pid != os.getpid():
+            return
+        if backend is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(backend.close(), loop).result(timeout=5)
+            except Exception as e:
+                print(f"Error closing LLM backend: {str(e)}")
+        loop.call_soon_threadsafe(loop.stop)
+
+    def stats(self):
+        """Return per-model counters for monitoring"""
+        with self._stats_lock:
+            models = {model: dict(counters) for model, counters in self._stats.items()}
+        return {
+            "backend": self.backend_name,
+            "maxConcurrency": self.max_concurrency,
+            "timeoutSeconds": self.timeout,
+            "models": models,
+        }
+
+
+# Process-wide gateway shared by all chains
+llm_gateway = LLMGateway()
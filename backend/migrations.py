@@ -0,0 +1,425 @@
+import os
+import sqlite3
+
+import jobs
+from blob_store import migrate_universal_pdfs_html
+from db import pool
+
+# Hospital systems seeded into healthcare_systems on a new database
+HOSPITAL_SYSTEMS = [
+    "Kaiser Permanente", "HCA Healthcare", "CommonSpirit", "Advocate Health",
+    "Ascension", "Providence", "UPMC", "Trinity Health", "Tenet Healthcare",
+    "Mass General Brigham", "University of California Medical Centers", "Mayo Clinic",
+    "AdventHealth", "Northwell Health", "Sutter Health", "Intermountain Healthcare",
+    "Corewell Health", "Cleveland Clinic", "Universal Health Services",
+    "Baylor Scott & White", "Banner Health", "Community Health Systems",
+    "Sentara Health", "Bon Secours Mercy Health", "New York and Presbyterian",
+    "SSM Health", "Penn Medicine", "Jefferson Health", "Northwestern Medicine",
+    "IU Health", "NYU Langone", "RWJ Barnabas Health", "Mercy Health",
+    "Christus Health", "Novant Health", "Memorial Hermann", "Johns Hopkins",
+    "Beth Israel Lahey", "Stanford Health Care", "Hackensack Meridian Health",
+    "Henry Ford Health", "MedStar Health", "Geisinger", "Montefiore Health",
+    "UCHealth (Colorado)", "Cedars-Sinai", "Memorial Sloan Kettering",
+    "Fairview Health Services", "Piedmont Healthcare", "Sanford Health",
+    "Vanderbilt University Medical Ctr", "U-M Health / Sparrow Health",
+    "BJC HealthCare", "Ochsner Health", "Yale New Haven", "UT Houston MD Anderson",
+    "Orlando Health", "Prisma Health", "UNC Health", "OhioHealth",
+    "Texas Health Resources", "Duke University Health", "Inova Health",
+    "Presbyterian Healthcare", "Endeavor Health", "BayCare Health System",
+    "Emory Healthcare", "Ohio State University Wexner", "Allina Health",
+    "University of Maryland Medical System", "Sharp HealthCare", "Allegheny Health",
+    "UnityPoint Health", "Scripps Health", "Lehigh Valley Health Network",
+    "OSF HealthCare", "UAB Medicine", "Penn State Health", "Atlantic Health System",
+    "Froedtert Health", "Norton Healthcare", "Medical University of South Carolina",
+    "Mount Sinai", "St. Luke's Health Network", "RUSH University Medical Center",
+    "ProMedica", "Dana-Farber Cancer Institute", "HonorHealth", "Marshfield Health Clinic",
+    "ChristianaCare", "Cone Health", "Essentia Health", "Parkview Health",
+    "Tampa General Hospital", "Tufts Medicine", "OU Health", "Ballad Health",
+    "Methodist Health System", "UC Health (Cincinnati)", "Premier Health",
+    "Penn Highlands Healthcare", "Main Line Health", "Baptist Health",
+    "Miami Public Health Trust", "Aspirus Health", "Tower Health",
+    "Keck Medical Center of USC", "Summa Health", "Bellin Gundersen Health",
+    "El Camino Health", "ThedaCare", "AtlantiCare", "Adventist Health"
+]
+
+
+def _columns(conn, table):
+    return [column[1] for column in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _add_column(conn, table, column, definition):
+    """Add a column unless an older version of the schema already has it"""
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        return True
+    return False
+
+
+def baseline(conn):
+    """
+    The schema init_db and ensure_db_schema used to build on every start.
+
+    Databases created before migrations existed went through several
+    versions of those functions, so this only creates what is missing.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        healthcare_title TEXT,
+        hospital_system TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS uploaded_pdfs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        original_filename TEXT NOT NULL,
+        is_fillable BOOLEAN,
+        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        patient_id INTEGER,
+        patient_name TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (patient_id) REFERENCES patients(id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        email TEXT,
+        date_of_birth TEXT,
+        gender TEXT,
+        age TEXT,
+        conditions TEXT,
+        medications TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS healthcare_systems (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS universal_pdfs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        original_filename TEXT UNIQUE NOT NULL,
+        html_hash TEXT,
+        html_size INTEGER,
+        html_filename TEXT,
+        hospital_system TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        healthcare_system_id INTEGER
+    )
+    ''')
+    _add_column(conn, "universal_pdfs", "html_filename", "TEXT")
+    _add_column(conn, "universal_pdfs", "hospital_system", "TEXT")
+
+    # Kept for the foreign keys of filled_forms
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pdfs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        patient_id INTEGER,
+        original_filename TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS filled_forms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        patient_id INTEGER NOT NULL,
+        pdf_id INTEGER NOT NULL,
+        filled_data TEXT,
+        filled_filename TEXT,
+        filled_pdf_filename TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (patient_id) REFERENCES patients (id),
+        FOREIGN KEY (pdf_id) REFERENCES pdfs (id)
+    )
+    ''')
+    _add_column(conn, "filled_forms", "filled_pdf_filename", "TEXT")
+
+    # healthcare_templates was replaced by universal_pdfs
+    conn.execute("DROP TABLE IF EXISTS healthcare_templates")
+
+    if conn.execute("SELECT COUNT(*) FROM healthcare_systems").fetchone()[0] == 0:
+        conn.executemany(
+            "INSERT INTO healthcare_systems (name) VALUES (?)",
+            [(system,) for system in HOSPITAL_SYSTEMS],
+        )
+
+    # Link users to their healthcare system
+    if _add_column(conn, "users", "hospital_system_id", "INTEGER"):
+        conn.execute('''
+        UPDATE users SET hospital_system_id = (
+            SELECT id FROM healthcare_systems
+            WHERE name = users.hospital_system
+        )
+        ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_hospital_system_id ON users(hospital_system_id)")
+
+    # The jobs table used by the background workers
+    jobs.ensure_jobs_table(conn)
+
+
+def template_html_blobs(conn):
+    """Move universal_pdfs.html_content into the blob store"""
+    migrate_universal_pdfs_html(conn)
+
+
+def hot_path_indexes(conn):
+    """
+    Indexes for the per-user list queries, plus universal_pdfs.html_basename
+    so templates are looked up by file name without a LIKE '%/name' scan.
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_uploaded_pdfs_user_date ON uploaded_pdfs(user_id, upload_date)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_uploaded_pdfs_patient ON uploaded_pdfs(patient_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_forms_user_created ON filled_forms(user_id, created_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_forms_patient_created ON filled_forms(patient_id, created_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_patients_user ON patients(user_id)"
+    )
+    # Partial index: only templates with generated HTML are ever listed
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_universal_pdfs_hospital_updated
+        ON universal_pdfs(hospital_system, updated_at)
+        WHERE html_filename IS NOT NULL
+        """
+    )
+
+    _add_column(conn, "universal_pdfs", "html_basename", "TEXT")
+    rows = conn.execute(
+        "SELECT id, html_filename FROM universal_pdfs WHERE html_filename IS NOT NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE universal_pdfs SET html_basename = ? WHERE id = ?",
+        [(os.path.basename(row[1]), row[0]) for row in rows],
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_universal_pdfs_html_basename ON universal_pdfs(html_basename)"
+    )
+
+
+def chain_cache_tables(conn):
+    """The generated-HTML cache and stage checkpoints chain1 used to create lazily"""
+    # Entries used to hold the HTML inline; the cache is disposable, so an
+    # old-style table is dropped rather than migrated
+    if "html" in _columns(conn, "html_cache"):
+        conn.execute("DROP TABLE html_cache")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS html_cache (
+        cache_key TEXT PRIMARY KEY,
+        pdf_hash TEXT NOT NULL,
+        prompt_version TEXT NOT NULL,
+        html_hash TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        hit_count INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_accessed REAL NOT NULL
+    )
+    ''')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_html_cache_last_accessed ON html_cache(last_accessed)"
+    )
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stage_checkpoints (
+        pdf_hash TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        prompt_version TEXT NOT NULL,
+        input_hash TEXT NOT NULL,
+        output TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (pdf_hash, stage, prompt_version)
+    )
+    ''')
+
+
+def link_users_to_healthcare_systems(conn):
+    """Set users.hospital_system_id for users signed up before signup filled it in"""
+    conn.execute('''
+    UPDATE users SET hospital_system_id = (
+        SELECT id FROM healthcare_systems
+        WHERE name = users.hospital_system
+    )
+    WHERE hospital_system_id IS NULL
+    ''')
+
+
+def pagination_indexes(conn):
+    """Indexes matching the keyset order of the paginated list endpoints"""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_universal_pdfs_created ON universal_pdfs(created_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_hospital_system_name ON users(hospital_system_id, name)"
+    )
+
+
+def prefill_mappings(conn):
+    """Field-to-context mappings chain2 learns once per template"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS prefill_mappings (
+        template_hash TEXT NOT NULL,
+        mapper_version TEXT NOT NULL,
+        mapping TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (template_hash, mapper_version)
+    )
+    ''')
+
+
+def filled_output_cache(conn):
+    """Prefilled forms chain2 produced, keyed by template and context"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS filled_output_cache (
+        cache_key TEXT PRIMARY KEY,
+        template_hash TEXT NOT NULL,
+        patient_id INTEGER,
+        user_id INTEGER,
+        html_hash TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    ''')
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_output_cache_patient ON filled_output_cache(patient_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_output_cache_user ON filled_output_cache(user_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_output_cache_template ON filled_output_cache(template_hash)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_filled_output_cache_expires ON filled_output_cache(expires_at)"
+    )
+
+
+# Applied in order; append new migrations, never edit or reorder applied ones
+MIGRATIONS = [
+    (1, "baseline", baseline),
+    (2, "template_html_blobs", template_html_blobs),
+    (3, "hot_path_indexes", hot_path_indexes),
+    (4, "chain_cache_tables", chain_cache_tables),
+    (5, "link_users_to_healthcare_systems", link_users_to_healthcare_systems),
+    (6, "pagination_indexes", pagination_indexes),
+    (7, "prefill_mappings", prefill_mappings),
+    (8, "filled_output_cache", filled_output_cache),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    """Return the highest applied migration version (0 for a new database)"""
+    try:
+        return conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # No schema_version table yet
+        return 0
+
+
+def pending_migrations(conn):
+    """Return the (version, name, function) entries not yet applied"""
+    version = current_version(conn)
+    return [entry for entry in MIGRATIONS if entry[0] > version]
+
+
+def migrate(conn):
+    """
+    Apply every pending migration, each in its own transaction.
+
+    An up-to-date database costs a single query. Each migration takes the
+    write lock (BEGIN IMMEDIATE) and rechecks the version, so several
+    processes starting at once apply it exactly once.
+
+    Args:
+        conn: The writer connection
+
+    Returns:
+        list: Versions applied
+    """
+    if not pending_migrations(conn):
+        return []
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    applied = []
+    for number, name, migration in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if number <= current_version(conn):
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, name) VALUES (?, ?)", (number, name)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {number}: {name}")
+        applied.append(number)
+    return applied
+
+
+def migrate_database():
+    """Bring conform.db up to date using the pool's writer connection"""
+    with pool.write() as conn:
+        return migrate(conn)
+
+
+if __name__ == "__main__":
+    # Run from the backend directory: python migrations.py [--status]
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Apply pending conform.db schema migrations")
+    parser.add_argument("--status", action="store_true", help="Show the schema version and pending migrations without applying them")
+    args = parser.parse_args()
+
+    if args.status:
+        with pool.read() as conn:
+            version = current_version(conn)
+            pending = pending_migrations(conn)
+        print(f"Schema version {version} (latest {LATEST_VERSION})")
+        for number, name, _ in pending:
+            print(f"  pending {number}: {name}")
+    else:
+        applied = migrate_database()
+        print(f"Applied {len(applied)} migrations; schema version {LATEST_VERSION}")
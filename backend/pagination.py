@@ -0,0 +1,113 @@
+import base64
+import json
+import os
+
+from fastapi import HTTPException
+
+# Page sizes for list endpoints (overridable from the environment)
+DEFAULT_PAGE_LIMIT = int(os.getenv("CONFORM_DEFAULT_PAGE_LIMIT", "100"))
+MAX_PAGE_LIMIT = int(os.getenv("CONFORM_MAX_PAGE_LIMIT", "500"))
+
+
+class Page:
+    """
+    Keyset pagination for one list query.
+
+    The cursor is the sort key of the last row on the previous page, so each
+    page is an index range scan that starts where the last one stopped
+    instead of an OFFSET that re-reads every earlier row.
+
+    A request with neither limit nor cursor is unpaged and gets every row,
+    so existing clients that never follow nextCursor still see all of them.
+
+    Args:
+        limit: Requested page size (defaults to DEFAULT_PAGE_LIMIT when only a
+            cursor is given, capped at MAX_PAGE_LIMIT)
+        cursor: nextCursor from the previous page, if any
+        fields: Comma-separated response keys to return (all if omitted)
+        allowed_fields: Keys the endpoint can return, for validating fields
+    """
+
+    def __init__(self, limit=None, cursor=None, fields=None, allowed_fields=()):
+        if limit is None and cursor:
+            limit = DEFAULT_PAGE_LIMIT
+        if limit is not None and limit < 1:
+            raise HTTPException(status_code=400, detail="limit must be at least 1")
+        self.limit = None if limit is None else min(limit, MAX_PAGE_LIMIT)
+        self.after = decode_cursor(cursor) if cursor else None
+        self.fields = parse_fields(fields, allowed_fields)
+
+    def where(self, columns, descending=True, after=None):
+        """
+        SQL condition (and its parameters) selecting rows after the cursor.
+
+        columns is the ORDER BY key, ending in a unique column such as the
+        id, e.g. ("f.created_at", "f.id"); the query must order by the same
+        columns in the same direction. Pass after (a sort key) to start after
+        another row instead, e.g. the last one streamed so far.
+        """
+        if after is None:
+            after = self.after
+        if after is None:
+            return "1", ()
+        if len(after) != len(columns):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        operator = "<" if descending else ">"
+        return f"({', '.join(columns)}) {operator} ({', '.join('?' * len(columns))})", tuple(after)
+
+    @property
+    def fetch_size(self):
+        """Rows to fetch: one extra shows whether there is another page (-1, no LIMIT, if unpaged)"""
+        if self.limit is None:
+            return -1
+        return self.limit + 1
+
+    def finish(self, rows, key):
+        """
+        Trim the extra row and build the cursor for the next page.
+
+        Args:
+            rows: Rows fetched with LIMIT fetch_size
+            key: Function returning a row's sort key (matching the where() columns)
+
+        Returns:
+            tuple: (rows on this page, nextCursor or None)
+        """
+        if self.limit is None or len(rows) <= self.limit:
+            return rows, None
+        rows = rows[:self.limit]
+        return rows, encode_cursor(key(rows[-1]))
+
+    def project(self, item):
+        """Keep only the requested fields of a response item"""
+        if self.fields is None:
+            return item
+        return {name: value for name, value in item.items() if name in self.fields}
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def parse_fields(fields, allowed_fields):
+    """Parse a fields= parameter, rejecting names the endpoint doesn't return"""
+    if not fields:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(allowed_fields)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}. Available: {', '.join(allowed_fields)}"
+        )
+    return requested
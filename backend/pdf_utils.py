@@ -1,28 +1,417 @@
+import io
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
 from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    BooleanObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+    TextStringObject,
+)
 
-def list_pdf_text_fields(pdf_path):
+# Number of parsed PDFs kept in memory (overridable from the environment)
+PDF_CACHE_MAX_ENTRIES = int(os.getenv("CONFORM_PDF_CACHE_MAX_ENTRIES", "64"))
+
+# A widget annotation on a page. field_type is the PDF /FT name ("/Tx", "/Btn",
+# "/Ch", "/Sig") and export_values lists the "on" states of checkboxes and radios.
+FormField = namedtuple("FormField", ["page_number", "name", "rect", "field_type", "export_values"])
+
+
+class ParsedForm:
     """
-    Lists all text fields from an AcroForm PDF, including page number, field name, and coordinates.
+    A PDF parsed once: its reader, widget annotations and AcroForm fields.
 
-    Returns:
-        List of tuples [(page_number, field_name, (x1, y1, x2, y2)), ...]
+    PdfReader resolves objects lazily from its stream, so anything that walks
+    the reader (such as copying its pages into a writer) must hold `lock`.
     """
+
+    def __init__(self, path, reader, fields, form_fields):
+        self.path = path
+        self.reader = reader
+        self.fields = fields
+        self.form_fields = form_fields
+        self.page_count = len(reader.pages)
+        self.lock = threading.Lock()
+        self._fill_plan = None
+
+    @property
+    def text_fields(self):
+        """Fields in the [(page_number, field_name, (x1, y1, x2, y2)), ...] shape used by chain1 and fill_pdf"""
+        return [(field.page_number, field.name, field.rect) for field in self.fields]
+
+    @property
+    def is_fillable(self):
+        return bool(self.form_fields)
+
+
+_form_cache = OrderedDict()
+_form_cache_lock = threading.Lock()
+_form_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _inherited(annot_obj, key):
+    """Look up a field attribute on a widget or, failing that, on its parent field"""
+    if key in annot_obj:
+        return annot_obj[key]
+    parent = annot_obj.get("/Parent")
+    if parent is not None:
+        return parent.get_object().get(key)
+    return None
+
+
+def _annotations(page):
+    """Return a page's annotation references (resolving an indirect /Annots array)"""
+    return page["/Annots"] if "/Annots" in page else []
+
+
+def _export_values(annot_obj):
+    """Return the "on" appearance states of a checkbox or radio widget"""
+    if "/AP" not in annot_obj:
+        return ()
+    appearance = annot_obj["/AP"]
+    states = appearance["/N"] if "/N" in appearance else {}
+    return tuple(str(state) for state in states if state != "/Off")
+
+
+def _parse_form(pdf_path):
+    """Parse a PDF into a ParsedForm"""
     reader = PdfReader(pdf_path)
-    text_fields = []
+    fields = []
+    # Fields whose widgets are unnamed kids of a named parent (radio groups,
+    # fields shown in several places), keyed by the parent's name
+    groups = OrderedDict()
 
     for page_num, page in enumerate(reader.pages, start=1):  # Start pages at 1
-        if "/Annots" in page:
-            for annot in page["/Annots"]:
-                annot_obj = annot.get_object()
-                if "/T" in annot_obj:  # Form field
-                    field_name = annot_obj["/T"]
-                    rect = annot_obj["/Rect"]  # Bounding box [x1, y1, x2, y2]
+        for annot in _annotations(page):
+            annot_obj = annot.get_object()
+            if "/T" in annot_obj:  # Form field
+                field_name = annot_obj["/T"]
+                rect = annot_obj["/Rect"]  # Bounding box [x1, y1, x2, y2]
+
+                # Convert coordinates to integers (if necessary)
+                x1, y1, x2, y2 = map(int, rect)
+
+                field_type = _inherited(annot_obj, "/FT")
+                export_values = _export_values(annot_obj) if field_type == "/Btn" else ()
+
+                fields.append(FormField(
+                    page_num, field_name, (x1, y1, x2, y2),
+                    str(field_type) if field_type else None, export_values,
+                ))
+            elif "/Parent" in annot_obj and "/T" in annot_obj["/Parent"]:
+                group = groups.setdefault(annot_obj["/Parent"]["/T"], (page_num, annot_obj, []))
+                group[2].extend(_export_values(annot_obj))
+
+    # Grouped fields go after the named widgets so existing field indexes don't shift
+    for field_name, (page_num, annot_obj, export_values) in groups.items():
+        x1, y1, x2, y2 = map(int, annot_obj["/Rect"])
+        field_type = _inherited(annot_obj, "/FT")
+        fields.append(FormField(
+            page_num, field_name, (x1, y1, x2, y2),
+            str(field_type) if field_type else None,
+            tuple(dict.fromkeys(export_values)) if field_type == "/Btn" else (),
+        ))
+
+    return ParsedForm(pdf_path, reader, fields, reader.get_fields() or {})
+
+
+def get_parsed_form(pdf_path):
+    """
+    Return the parsed form for a PDF, parsing it only if it is new or has changed.
+
+    Entries are keyed by absolute path and validated against the file's mtime
+    and size, so uploads, fills and mapping generation share one parse.
+
+    Args:
+        pdf_path (str): Path to the PDF file
+
+    Returns:
+        ParsedForm: The parsed form
+    """
+    path = os.path.abspath(pdf_path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _form_cache_lock:
+        entry = _form_cache.get(path)
+        if entry is not None and entry[0] == version:
+            _form_cache.move_to_end(path)
+            _form_cache_stats["hits"] += 1
+            return entry[1]
+        _form_cache_stats["misses"] += 1
+
+    # Parse outside the lock so other PDFs aren't held up
+    form = _parse_form(path)
+
+    with _form_cache_lock:
+        _form_cache[path] = (version, form)
+        _form_cache.move_to_end(path)
+        while len(_form_cache) > PDF_CACHE_MAX_ENTRIES:
+            _form_cache.popitem(last=False)
+            _form_cache_stats["evictions"] += 1
+    return form
+
+
+def invalidate_parsed_form(pdf_path=None):
+    """Drop one PDF (or every PDF) from the parse cache"""
+    with _form_cache_lock:
+        if pdf_path is None:
+            _form_cache.clear()
+        else:
+            _form_cache.pop(os.path.abspath(pdf_path), None)
+
+
+def parsed_form_cache_stats():
+    """Return parse cache counters for monitoring"""
+    with _form_cache_lock:
+        return {**_form_cache_stats, "entries": len(_form_cache), "maxEntries": PDF_CACHE_MAX_ENTRIES}
+
+
+# Field flag bits (PDF 32000-1, table 226)
+FF_RADIO = 1 << 15
+FF_PUSHBUTTON = 1 << 16
+
+# Submitted values that tick a checkbox which has a single "on" state
+CHECKED_VALUES = {"true", "yes", "y", "on", "1", "x", "checked"}
 
-                    # Convert coordinates to integers (if necessary)
-                    x1, y1, x2, y2 = map(int, rect)
+# An object in a compiled template: where it lives and what it holds
+PlanRef = namedtuple("PlanRef", ["idnum", "generation", "obj"])
+PlanWidget = namedtuple("PlanWidget", ["ref", "page_number", "export_values"])
+# parent is the field dictionary when the widgets are its unnamed kids, else None
+PlanField = namedtuple("PlanField", ["name", "field_type", "flags", "parent", "widgets"])
 
-                    # Append tuple (page number, field name, coordinates)
-                    text_fields.append((page_num, field_name, (x1, y1, x2, y2)))
+
+def _button_state(value, export_values, radio):
+    """Map a submitted value onto one of a button widget's appearance states"""
+    text = str(value).strip()
+    for export in export_values:
+        if export.lstrip("/") == text.lstrip("/"):
+            return export
+    if not radio and text.lower() in CHECKED_VALUES:
+        return export_values[0] if export_values else "/Yes"
+    return "/Off"
+
+
+class FillPlan:
+    """
+    A template compiled once for repeated fills.
+
+    Compiling copies the template's pages into a writer, adds an AcroForm,
+    and saves the result as a standalone PDF with a classic xref table. It
+    also indexes every field by name (and by page) with the objects that hold
+    its value. A fill is then an incremental update: the compiled bytes plus
+    new revisions of only the objects whose values were supplied. No pages
+    are copied and no annotations are scanned per fill.
+    """
+
+    def __init__(self, form):
+        self.source_path = form.path
+        self.field_mapping = extract_field_mapping(form.text_fields)
+        self.base_pdf, self.fields, self.pages, self._trailer, self._prev_xref = self._compile(form)
+
+    @staticmethod
+    def _compile(form):
+        writer = PdfWriter()
+        for page in form.reader.pages:
+            writer.add_page(page)
+
+        # add_page drops /Parent from everything it copies, which detaches
+        # radio buttons and other kid widgets from their fields; relink them
+        for source_page, page in zip(form.reader.pages, writer.pages):
+            for source_ref, annot_ref in zip(_annotations(source_page), _annotations(page)):
+                source_obj = source_ref.get_object()
+                if "/Parent" in source_obj:
+                    annot_ref.get_object()[NameObject("/Parent")] = source_obj.raw_get("/Parent").clone(writer)
+
+        # Register every field in the writer's AcroForm so viewers (and
+        # PdfReader.get_fields) see the output as a fillable form
+        fields = ArrayObject()
+        seen = set()
+        for page in writer.pages:
+            for annot_ref in _annotations(page):
+                annot_obj = annot_ref.get_object()
+                field_ref = annot_ref
+                if "/T" not in annot_obj and "/Parent" in annot_obj:
+                    field_ref = annot_obj.raw_get("/Parent")
+                if field_ref.idnum not in seen:
+                    seen.add(field_ref.idnum)
+                    fields.append(field_ref)
+
+        acroform = DictionaryObject({
+            NameObject("/Fields"): fields,
+            NameObject("/NeedAppearances"): BooleanObject(True),
+        })
+        source_root = form.reader.trailer["/Root"]
+        if "/AcroForm" in source_root:
+            source_acroform = source_root["/AcroForm"]
+            for key in ("/DA", "/DR", "/Q"):
+                if key in source_acroform:
+                    acroform[NameObject(key)] = source_acroform.raw_get(key).clone(writer)
+        writer._root_object[NameObject("/AcroForm")] = writer._add_object(acroform)
+
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        base_pdf = buffer.getvalue()
+
+        # Re-read the compiled PDF to index its fields by name and by page
+        compiled = PdfReader(io.BytesIO(base_pdf))
+        fields = {}
+        pages = {}
+        for page_num, page in enumerate(compiled.pages, start=1):
+            for annot_ref in _annotations(page):
+                annot_obj = annot_ref.get_object()
+                if "/T" in annot_obj:
+                    name, parent = annot_obj["/T"], None
+                elif "/Parent" in annot_obj and "/T" in annot_obj["/Parent"]:
+                    parent_ref = annot_obj.raw_get("/Parent")
+                    name = annot_obj["/Parent"]["/T"]
+                    parent = PlanRef(parent_ref.idnum, parent_ref.generation, parent_ref.get_object())
+                else:
+                    continue
+
+                field = fields.get(name)
+                if field is None:
+                    field_type = _inherited(annot_obj, "/FT")
+                    field = fields[name] = PlanField(
+                        name, str(field_type) if field_type else None,
+                        int(_inherited(annot_obj, "/Ff") or 0), parent, [],
+                    )
+                field.widgets.append(PlanWidget(
+                    PlanRef(annot_ref.idnum, annot_ref.generation, annot_obj),
+                    page_num, _export_values(annot_obj),
+                ))
+                page_fields = pages.setdefault(page_num, [])
+                if name not in page_fields:
+                    page_fields.append(name)
+
+        trailer = DictionaryObject({NameObject("/Size"): compiled.trailer["/Size"]})
+        for key in ("/Root", "/Info", "/ID"):
+            if key in compiled.trailer:
+                trailer[NameObject(key)] = compiled.trailer.raw_get(key)
+
+        prev_xref = int(base_pdf[base_pdf.rindex(b"startxref") + len(b"startxref"):].split()[0])
+        return base_pdf, fields, pages, trailer, prev_xref
+
+    def fields_on_page(self, page_number):
+        """Names of the fields with a widget on a page (1-based)"""
+        return self.pages.get(page_number, [])
+
+    def _revisions(self, field, value):
+        """Return (ref, new object) pairs that set value on a field"""
+        if field.field_type == "/Sig" or field.flags & FF_PUSHBUTTON:
+            return []
+
+        revisions = []
+        if field.field_type == "/Btn":
+            # Checkboxes and radios take a name from their appearance states:
+            # the matching widget shows its "on" state and the rest show /Off
+            radio = bool(field.flags & FF_RADIO)
+            states = [_button_state(value, widget.export_values, radio) for widget in field.widgets]
+            for widget, state in zip(field.widgets, states):
+                obj = DictionaryObject(widget.ref.obj)
+                obj[NameObject("/AS")] = NameObject(state)
+                if field.parent is None:
+                    obj[NameObject("/V")] = NameObject(state)
+                revisions.append((widget.ref, obj))
+            field_value = NameObject(next((state for state in states if state != "/Off"), "/Off"))
+        else:
+            field_value = TextStringObject(str(value))
+            if field.parent is None:
+                for widget in field.widgets:
+                    obj = DictionaryObject(widget.ref.obj)
+                    obj[NameObject("/V")] = field_value
+                    revisions.append((widget.ref, obj))
+
+        if field.parent is not None:
+            obj = DictionaryObject(field.parent.obj)
+            obj[NameObject("/V")] = field_value
+            revisions.append((field.parent, obj))
+        return revisions
+
+    def fill(self, json_data):
+        """
+        Fill the template with index-keyed (or name-keyed) values.
+
+        Every page is filled in one pass. Fields with no supplied value keep
+        the template's own value.
+
+        Returns:
+            bytes: The filled PDF
+        """
+        field_values = rename_json_keys(json_data, self.field_mapping)
+
+        revisions = {}
+        for name, value in field_values.items():
+            field = self.fields.get(name)
+            if field is None:
+                continue
+            for ref, obj in self._revisions(field, value):
+                revisions[ref.idnum] = (ref.generation, obj)
+
+        if not revisions:
+            return self.base_pdf
+
+        out = io.BytesIO()
+        out.write(self.base_pdf)
+        if not self.base_pdf.endswith(b"\n"):
+            out.write(b"\n")
+
+        offsets = {}
+        for idnum, (generation, obj) in revisions.items():
+            offsets[idnum] = (out.tell(), generation)
+            out.write(f"{idnum} {generation} obj\n".encode())
+            obj.write_to_stream(out, None)
+            out.write(b"\nendobj\n")
+
+        xref_offset = out.tell()
+        out.write(b"xref\n")
+        idnums = sorted(offsets)
+        start = 0
+        while start < len(idnums):
+            # Consecutive object numbers share an xref subsection
+            end = start
+            while end + 1 < len(idnums) and idnums[end + 1] == idnums[end] + 1:
+                end += 1
+            out.write(f"{idnums[start]} {end - start + 1}\n".encode())
+            for idnum in idnums[start:end + 1]:
+                offset, generation = offsets[idnum]
+                out.write(f"{offset:010d} {generation:05d} n\r\n".encode())
+            start = end + 1
+
+        trailer = DictionaryObject(self._trailer)
+        trailer[NameObject("/Prev")] = NumberObject(self._prev_xref)
+        out.write(b"trailer\n")
+        trailer.write_to_stream(out, None)
+        out.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        return out.getvalue()
+
+
+def get_fill_plan(pdf_path):
+    """
+    Return the compiled fill plan for a template, compiling it on first use.
+
+    The plan lives on the cached ParsedForm, so it is rebuilt whenever the
+    template file changes.
+    """
+    form = get_parsed_form(pdf_path)
+    with form.lock:
+        if form._fill_plan is None:
+            form._fill_plan = FillPlan(form)
+        return form._fill_plan
+
+
+def list_pdf_text_fields(pdf_path):
+    """
+    Lists all text fields from an AcroForm PDF, including page number, field name, and coordinates.
+
+    Returns:
+        List of tuples [(page_number, field_name, (x1, y1, x2, y2)), ...]
+    """
+    text_fields = get_parsed_form(pdf_path).text_fields
 
     if not text_fields:
         print("No form text fields found or PDF does not have AcroForm text fields.")
@@ -58,7 +447,7 @@ def rename_json_keys(json_data, field_mapping):
 
 def fill_pdf(input_pdf, output_pdf, json_data):
     """
-    Extracts field mapping, renames JSON keys, and fills a PDF with the mapped values.
+    Fills a PDF form with index-keyed values using the template's compiled fill plan.
 
     Args:
         input_pdf (str): Path to input PDF file.
@@ -68,27 +457,11 @@ def fill_pdf(input_pdf, output_pdf, json_data):
     Saves:
         A new PDF with the form fields filled.
     """
-    # Step 1: Extract field names from the PDF
-    text_fields = list_pdf_text_fields(input_pdf)
-    # Step 2: Create mapping of index → field name
-    field_mapping = extract_field_mapping(text_fields)
-    # Step 3: Rename JSON keys using the mapping
-    field_values = rename_json_keys(json_data, field_mapping)
-    print(field_values)
-    # Step 4: Read and write the PDF with updated values
-    reader = PdfReader(input_pdf)
-    writer = PdfWriter()
-
-    for page in reader.pages:
-        writer.add_page(page)
-
-    form_fields = reader.get_fields()
-
-    if form_fields:
-        writer.update_page_form_field_values(writer.pages[0], {k: field_values.get(k, v) for k, v in form_fields.items()})
+    plan = get_fill_plan(input_pdf)
+    filled = plan.fill(json_data)
 
     with open(output_pdf, "wb") as out:
-        writer.write(out)
+        out.write(filled)
     
     print(f"Saved filled PDF to '{output_pdf}'")
 
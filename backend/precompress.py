@@ -0,0 +1,201 @@
+"""
+Pre-compressed variants of generated HTML.
+
+Each HTML file under html_outputs can have "<name>.html.br" and
+"<name>.html.gz" siblings, written when the HTML is written. A variant
+carries its source's mtime, which is how readers tell that it is current.
+Routes and the /html_outputs mount send the best variant the client
+accepts, so a view costs no compression CPU.
+
+Backfill variants for files written before this existed:
+    python precompress.py [directory]
+"""
+import gzip
+import os
+import re
+import sys
+import uuid
+
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are written
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HTML_OUTPUT_DIR = os.path.join(BASE_DIR, "html_outputs")
+
+# Content codings in order of preference, with the suffix of their variant file
+ENCODINGS = (["br"] if brotli else []) + ["gzip"]
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Files worth pre-compressing
+COMPRESSIBLE_EXTENSIONS = (".html",)
+
+
+def compress(data, encoding):
+    """Compress bytes with the slowest, smallest setting (it happens once per write)"""
+    if encoding == "br":
+        return brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+    # mtime=0 keeps the output byte-identical for identical input
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def variant_path(path, encoding):
+    return path + SUFFIXES[encoding]
+
+
+def _write_atomic(path, data, mtime_ns=None):
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, path)
+
+
+def write_variants(path, data, mtime_ns):
+    """
+    Write every compressed variant of a file's content.
+
+    Args:
+        path: Path of the uncompressed file the variants belong to
+        data (bytes): Its content
+        mtime_ns: The mtime it has (or will have) on disk
+    """
+    for encoding in ENCODINGS:
+        _write_atomic(variant_path(path, encoding), compress(data, encoding), mtime_ns)
+
+
+def publish_html(path, html):
+    """
+    Write an HTML file together with its compressed variants.
+
+    The variants are written first and the HTML is renamed into place last,
+    so once the file is visible its variants are already there, and a
+    reader never sees a partially written file.
+    """
+    data = html.encode("utf-8") if isinstance(html, str) else html
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    write_variants(path, data, os.stat(tmp_path).st_mtime_ns)
+    os.replace(tmp_path, path)
+
+
+def precompress_file(path):
+    """Write the variants for an existing file"""
+    with open(path, "rb") as f:
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        data = f.read()
+    write_variants(path, data, mtime_ns)
+
+
+def remove_variants(path):
+    """Delete a file's variants (all codings, including ones no longer written)"""
+    for suffix in SUFFIXES.values():
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def fresh_variants(path, stat_result):
+    """
+    Return {encoding: (variant path, variant stat)} for the variants that
+    match the file's current version.
+    """
+    variants = {}
+    for encoding in ENCODINGS:
+        candidate = variant_path(path, encoding)
+        try:
+            variant_stat = os.stat(candidate)
+        except FileNotFoundError:
+            continue
+        if variant_stat.st_mtime_ns == stat_result.st_mtime_ns:
+            variants[encoding] = (candidate, variant_stat)
+    return variants
+
+
+def negotiate(accept_encoding, available):
+    """
+    Pick the content coding to send.
+
+    Args:
+        accept_encoding: The request's Accept-Encoding header (may be None)
+        available: Codings there is a variant for
+
+    Returns:
+        The most preferred available coding the client accepts, or None for
+        the uncompressed file
+    """
+    if not accept_encoding or not available:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        weights[coding] = quality
+
+    best = None
+    for encoding in ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves a current pre-compressed variant when the client accepts one"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        full_path = os.fspath(full_path)
+        if not full_path.endswith(COMPRESSIBLE_EXTENSIONS):
+            return super().file_response(full_path, stat_result, scope, status_code)
+
+        accept_encoding = None
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+
+        variants = fresh_variants(full_path, stat_result)
+        encoding = negotiate(accept_encoding, variants)
+        if encoding is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+        else:
+            path, variant_stat = variants[encoding]
+            response = super().file_response(path, variant_stat, scope, status_code)
+            if response.status_code != 304:
+                response.headers["content-type"] = "text/html; charset=utf-8"
+                response.headers["content-encoding"] = encoding
+        response.headers["vary"] = "Accept-Encoding"
+        return response
+
+
+if __name__ == "__main__":
+    root = sys.argv[1] if len(sys.argv) > 1 else HTML_OUTPUT_DIR
+    count = 0
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            stat_result = os.stat(path)
+            if len(fresh_variants(path, stat_result)) < len(ENCODINGS):
+                precompress_file(path)
+                count += 1
+    print(f"Pre-compressed {count} files under {root} ({', '.join(ENCODINGS)})")
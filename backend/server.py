@@ -1,23 +1,39 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, BackgroundTasks, Response
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Any
 import sqlite3
 import os
 from datetime import datetime, timedelta
 import re
-import PyPDF2
+from pdf_utils import get_parsed_form, parsed_form_cache_stats
 import json
 import shutil
-from chains.chain1 import chain1
+from chains.chain1 import chain1, STAGES as CHAIN1_STAGES
+import jobs
+from streaming import iter_zip, file_response, bytes_response
+from template_cache import template_cache
+from healthcare_systems import healthcare_systems_cache
+from pagination import Page, encode_cursor
+from precompress import PrecompressedStaticFiles, remove_variants
+from blob_store import put_blob, read_blob_text, BlobCollector
+from chains.cache import invalidate_cached_fills
+from chains.chain2 import filled_output_pattern
+from migrations import migrate_database, current_version, LATEST_VERSION
+from db import DB_PATH, pool, async_db, AsyncDatabase, get_db, get_async_db
+from llm import llm_gateway, run_cancellable
 import pathlib
 import time
 import threading
 import traceback
 import uuid
 import base64
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import closing
 
 # Create the FastAPI app
@@ -38,7 +54,10 @@ app.add_middleware(
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
 HTML_OUTPUT_DIR = os.path.join(BASE_DIR, "html_outputs")
-DB_PATH = os.path.join(BASE_DIR, "conform.db")
+
+# Generated HTML is per-user (permission checked) and must be revalidated on
+# every use; an unchanged file is answered with a 304
+HTML_CACHE_CONTROL = "private, no-cache"
 
 # Create directories if they don't exist
 os.makedirs(UPLOADS_DIR, exist_ok=True)
@@ -47,220 +66,57 @@ os.makedirs(os.path.join(HTML_OUTPUT_DIR, "filled_pdfs"), exist_ok=True)
 
 # Mount the directories to make files accessible
 app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
-app.mount("/html_outputs", StaticFiles(directory=HTML_OUTPUT_DIR), name="html_outputs")
-
-# Database setup
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
-
-# Initialize database
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        healthcare_title TEXT,
-        hospital_system TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create uploaded_pdfs table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS uploaded_pdfs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        filename TEXT NOT NULL,
-        original_filename TEXT NOT NULL,
-        is_fillable BOOLEAN,
-        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        patient_id INTEGER,
-        patient_name TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (patient_id) REFERENCES patients(id)
-    )
-    ''')
-    
-    # Create patients table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        user_id INTEGER NOT NULL,
-        email TEXT,
-        date_of_birth TEXT,
-        gender TEXT,
-        age TEXT,
-        conditions TEXT,
-        medications TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-    
-    # Create healthcare_systems table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS healthcare_systems (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create universal_pdfs table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS universal_pdfs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        original_filename TEXT UNIQUE NOT NULL,
-        html_content TEXT,
-        html_filename TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        healthcare_system_id INTEGER
-    )
-    ''')
-    
-    # Drop healthcare_templates table if it exists
-    cursor.execute("DROP TABLE IF EXISTS healthcare_templates")
-    
-    # Populate healthcare_systems table with data from hospitalSystems.js if empty
-    cursor.execute("SELECT COUNT(*) FROM healthcare_systems")
-    count = cursor.fetchone()[0]
-    
-    if count == 0:
-        # Import the hospital systems from the JavaScript file
-        # This is a simplified approach - in production, you'd want to parse the JS file
-        hospital_systems = [
-            "Kaiser Permanente", "HCA Healthcare", "CommonSpirit", "Advocate Health",
-            "Ascension", "Providence", "UPMC", "Trinity Health", "Tenet Healthcare",
-            "Mass General Brigham", "University of California Medical Centers", "Mayo Clinic",
-            "AdventHealth", "Northwell Health", "Sutter Health", "Intermountain Healthcare",
-            "Corewell Health", "Cleveland Clinic", "Universal Health Services",
-            "Baylor Scott & White", "Banner Health", "Community Health Systems",
-            "Sentara Health", "Bon Secours Mercy Health", "New York and Presbyterian",
-            "SSM Health", "Penn Medicine", "Jefferson Health", "Northwestern Medicine",
-            "IU Health", "NYU Langone", "RWJ Barnabas Health", "Mercy Health",
-            "Christus Health", "Novant Health", "Memorial Hermann", "Johns Hopkins",
-            "Beth Israel Lahey", "Stanford Health Care", "Hackensack Meridian Health",
-            "Henry Ford Health", "MedStar Health", "Geisinger", "Montefiore Health",
-            "UCHealth (Colorado)", "Cedars-Sinai", "Memorial Sloan Kettering",
-            "Fairview Health Services", "Piedmont Healthcare", "Sanford Health",
-            "Vanderbilt University Medical Ctr", "U-M Health / Sparrow Health",
-            "BJC HealthCare", "Ochsner Health", "Yale New Haven", "UT Houston MD Anderson",
-            "Orlando Health", "Prisma Health", "UNC Health", "OhioHealth",
-            "Texas Health Resources", "Duke University Health", "Inova Health",
-            "Presbyterian Healthcare", "Endeavor Health", "BayCare Health System",
-            "Emory Healthcare", "Ohio State University Wexner", "Allina Health",
-            "University of Maryland Medical System", "Sharp HealthCare", "Allegheny Health",
-            "UnityPoint Health", "Scripps Health", "Lehigh Valley Health Network",
-            "OSF HealthCare", "UAB Medicine", "Penn State Health", "Atlantic Health System",
-            "Froedtert Health", "Norton Healthcare", "Medical University of South Carolina",
-            "Mount Sinai", "St. Luke's Health Network", "RUSH University Medical Center",
-            "ProMedica", "Dana-Farber Cancer Institute", "HonorHealth", "Marshfield Health Clinic",
-            "ChristianaCare", "Cone Health", "Essentia Health", "Parkview Health",
-            "Tampa General Hospital", "Tufts Medicine", "OU Health", "Ballad Health",
-            "Methodist Health System", "UC Health (Cincinnati)", "Premier Health",
-            "Penn Highlands Healthcare", "Main Line Health", "Baptist Health",
-            "Miami Public Health Trust", "Aspirus Health", "Tower Health",
-            "Keck Medical Center of USC", "Summa Health", "Bellin Gundersen Health",
-            "El Camino Health", "ThedaCare", "AtlantiCare", "Adventist Health"
-        ]
-        
-        for system in hospital_systems:
-            cursor.execute("INSERT INTO healthcare_systems (name) VALUES (?)", (system,))
-    
-    # Update the users table to reference healthcare_systems
-    cursor.execute("PRAGMA table_info(users)")
-    columns = cursor.fetchall()
-    column_names = [column[1] for column in columns]
-    
-    # If hospital_system_id doesn't exist, add it
-    if 'hospital_system_id' not in column_names:
-        cursor.execute('ALTER TABLE users ADD COLUMN hospital_system_id INTEGER')
-        cursor.execute('CREATE INDEX idx_users_hospital_system_id ON users(hospital_system_id)')
-        
-        # Update existing users to link to their healthcare system
-        cursor.execute('''
-        UPDATE users SET hospital_system_id = (
-            SELECT id FROM healthcare_systems 
-            WHERE name = users.hospital_system
-        )
-        ''')
-    
-    conn.commit()
-    cursor.close()
-    print("Connected to the SQLite database")
-
-# Call init_db at startup
-init_db()
-
-# Dictionary to track processing status
-processing_status: Dict[str, bool] = {}
-
-# Background task to process PDF
-def process_pdf_background(pdf_path: str, hospital_system: str):
-    """Process a PDF in the background and generate HTML"""
-    # Extract the original filename from the path
-    original_filename = os.path.basename(pdf_path)
-    
-    try:
-        print(f"Starting background processing for {original_filename}")
-        
-        # Import the pdf_utils module
-        import pdf_utils
-        
-        # Generate the field mapping string
-        print(f"Generating field mapping string for {pdf_path}")
-        field_mapping_string = pdf_utils.generate_field_mapping_string(pdf_path)
-        print(f"Field mapping string generated:\n{field_mapping_string}")
-        
-        # Import chain1 function to ensure it's available
-        print("Importing chain1 function...")
-        try:
-            from chains.chain1 import chain1 as process_chain
-            print("Successfully imported chain1 function")
-        except ImportError as e:
-            print(f"ERROR importing chain1: {str(e)}")
-            processing_status[original_filename] = True
-            return
-        
-        # Process the PDF with chain1
-        print(f"Calling chain1 function with pdf_path={pdf_path}, field_mapping_string={field_mapping_string}, hospital_system={hospital_system}")
-        result = process_chain(pdf_path, field_mapping_string, hospital_system)
-        # Update processing status
-        processing_status[original_filename] = True
-        
-        print(f"Background processing completed for {original_filename}, result: {result}")
-        print(f"===== FINISHED BACKGROUND PROCESSING =====")
-    except Exception as e:
-        print(f"===== ERROR IN BACKGROUND PROCESSING =====")
-        print(f"Error type: {type(e).__name__}")
-        print(f"Error message: {str(e)}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
-        print(f"===== END ERROR REPORT =====")
-        # Mark as completed even on error to prevent endless waiting
-        processing_status[original_filename] = True
+# Generated HTML is served from its pre-compressed variants when the client accepts them
+app.mount("/html_outputs", PrecompressedStaticFiles(directory=HTML_OUTPUT_DIR), name="html_outputs")
+
+@app.on_event("startup")
+def apply_migrations():
+    """Apply pending schema migrations before the server takes requests"""
+    applied = migrate_database()
+    print(f"Connected to the SQLite database ({len(applied)} migrations applied)")
+
+@app.on_event("shutdown")
+def close_db_pool():
+    """Close pooled database connections when the server stops"""
+    async_db.shutdown()
+    pool.close_all()
+
+# Workers that run queued jobs (PDF-to-HTML conversion) from the jobs table
+job_workers = jobs.JobWorkerPool()
+
+@app.on_event("startup")
+def start_job_workers():
+    """Start the job worker pool when the server starts"""
+    job_workers.start()
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    """Stop the job worker pool when the server stops"""
+    job_workers.stop()
+
+# Sweeps blobs that no template, cache entry or published file uses any more
+blob_collector = BlobCollector(pool)
+
+@app.on_event("startup")
+def start_blob_collector():
+    """Start the blob garbage collector when the server starts"""
+    blob_collector.start()
+
+@app.on_event("shutdown")
+def stop_blob_collector():
+    """Stop the blob garbage collector when the server stops"""
+    blob_collector.stop()
+
+@app.on_event("shutdown")
+def close_llm_gateway():
+    """Close the model client's connections when the server stops"""
+    llm_gateway.close()
 
 # Function to check if a PDF is fillable
 def is_pdf_fillable(file_path):
     try:
-        with open(file_path, 'rb') as f:
-            pdf = PyPDF2.PdfReader(f)
-            # Check if the PDF has form fields
-            fields = pdf.get_fields()
-            # Return True if fields is not None and not empty
-            return fields is not None and len(fields) > 0
+        # Parsed once and shared with field mapping generation and fills
+        return get_parsed_form(file_path).is_fillable
     except Exception as e:
         print(f"Error checking if PDF is fillable: {e}")
         return False
@@ -294,18 +150,22 @@ class UserResponse(BaseModel):
 
 # Routes
 @app.post("/api/signup")
-def signup(user: UserSignup, db: sqlite3.Connection = Depends(get_db)):
+def signup(user: UserSignup):
     if not all([user.name, user.email, user.healthcareTitle, user.hospitalSystem]):
         raise HTTPException(status_code=400, detail="All fields are required")
     
-    cursor = db.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO users (name, email, healthcare_title, hospital_system) VALUES (?, ?, ?, ?)",
-            (user.name, user.email, user.healthcareTitle, user.hospitalSystem)
-        )
-        db.commit()
-        user_id = cursor.lastrowid
+        # Keep the writer only for the insert
+        with pool.write() as db:
+            cursor = db.execute(
+                """
+                INSERT INTO users (name, email, healthcare_title, hospital_system, hospital_system_id)
+                VALUES (?, ?, ?, ?, (SELECT id FROM healthcare_systems WHERE name = ?))
+                """,
+                (user.name, user.email, user.healthcareTitle, user.hospitalSystem, user.hospitalSystem)
+            )
+            user_id = cursor.lastrowid
+        healthcare_systems_cache.invalidate()
         return {"message": "User registered successfully", "userId": user_id}
     except sqlite3.IntegrityError as e:
         if "UNIQUE constraint failed" in str(e):
@@ -342,38 +202,42 @@ def login(user: UserLogin, db: sqlite3.Connection = Depends(get_db)):
 def update_user(
     user_id: int, 
     user_data: UserSignup, 
-    db: sqlite3.Connection = Depends(get_db)
 ):
-    cursor = db.cursor()
-    
-    # Check if user exists
-    cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    if not cursor.fetchone():
-        raise HTTPException(status_code=404, detail="User not found")
-    
     try:
-        cursor.execute(
-            """
-            UPDATE users 
-            SET name = ?, email = ?, healthcare_title = ?, hospital_system = ? 
-            WHERE id = ?
-            """,
-            (
-                user_data.name, 
-                user_data.email, 
-                user_data.healthcareTitle, 
-                user_data.hospitalSystem, 
-                user_id
+        # Keep the writer only for the row changes
+        with pool.write() as db:
+            cursor = db.cursor()
+            
+            # Check if user exists
+            cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="User not found")
+            
+            cursor.execute(
+                """
+                UPDATE users 
+                SET name = ?, email = ?, healthcare_title = ?, hospital_system = ?,
+                    hospital_system_id = (SELECT id FROM healthcare_systems WHERE name = ?)
+                WHERE id = ?
+                """,
+                (
+                    user_data.name, 
+                    user_data.email, 
+                    user_data.healthcareTitle, 
+                    user_data.hospitalSystem, 
+                    user_data.hospitalSystem, 
+                    user_id
+                )
             )
-        )
-        db.commit()
-        
-        # Get updated user data
-        cursor.execute(
-            "SELECT id, name, email, healthcare_title, hospital_system FROM users WHERE id = ?",
-            (user_id,)
-        )
-        updated_user = cursor.fetchone()
+            invalidate_cached_fills(user_id=user_id, conn=db)
+            
+            # Get updated user data
+            cursor.execute(
+                "SELECT id, name, email, healthcare_title, hospital_system FROM users WHERE id = ?",
+                (user_id,)
+            )
+            updated_user = cursor.fetchone()
+        healthcare_systems_cache.invalidate()
         
         return {
             "message": "User updated successfully",
@@ -390,25 +254,58 @@ def update_user(
             raise HTTPException(status_code=409, detail="Email already registered")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Write an uploaded file to disk, replacing any existing copy
+def save_upload_file(source, file_path):
+    # Create the uploads directory if it doesn't exist
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    
+    # If the file already exists, remove it first
+    if os.path.exists(file_path):
+        os.remove(file_path)
+        print(f"Removed existing file: {file_path}")
+    
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(source, f)
+
+# Delete files (and any precompressed variants) once the rows that pointed at
+# them are committed, so disk I/O never runs while holding the writer
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+            print(f"Deleted file: {path}")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting file {path}: {str(e)}")
+        remove_variants(path)
+
+# Delete the forms chain2 published (filled_<template>_p<patient>_u<user>.html)
+# that match a pattern, from the given output directories
+def remove_published_fills(pattern, directories):
+    paths = []
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        paths.extend(os.path.join(directory, name) for name in names if pattern.fullmatch(name))
+    remove_files(paths)
+    for path in paths:
+        template_cache.invalidate(os.path.basename(path))
+
 # Endpoint to upload a PDF
 @app.post("/api/upload-pdf")
 async def upload_pdf(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     user_id: int = Form(...),
+    adb: AsyncDatabase = Depends(get_async_db),
 ):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
         # Verify the user exists and get full name and hospital system
-        cursor.execute("SELECT name, hospital_system FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
+        user = await adb.fetchone("SELECT name, hospital_system FROM users WHERE id = ?", (user_id,))
         
         if not user:
-            conn.close()
             raise HTTPException(status_code=404, detail="User not found")
         
         hospital_system = user['hospital_system']
@@ -419,86 +316,67 @@ async def upload_pdf(
         # Use the original filename without modification
         original_filename = file.filename
         
-        # Create the uploads directory if it doesn't exist
-        os.makedirs(UPLOADS_DIR, exist_ok=True)
-        
-        # Write the file to disk with the original filename
+        # Write the file to disk with the original filename, off the event loop
         file_path = os.path.join(UPLOADS_DIR, original_filename)
+        await run_in_threadpool(save_upload_file, file.file, file_path)
         
-        # If the file already exists, remove it first
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"Removed existing file: {file_path}")
-        
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(file.file, f)
-        
-        # Check if this PDF already exists in the universal_pdfs table
-        cursor.execute(
-            "SELECT id, html_filename, hospital_system FROM universal_pdfs WHERE original_filename = ?",
+        # Delete the HTML of any existing template for this PDF. This runs before
+        # the job that regenerates it is queued (so its new output is never the
+        # one removed) and outside the write transaction (so disk I/O doesn't
+        # hold up other writers)
+        existing_pdf = await adb.fetchone(
+            "SELECT html_filename, hospital_system FROM universal_pdfs WHERE original_filename = ?",
             (original_filename,)
         )
-        existing_pdf = cursor.fetchone()
-        
-        # If the template already exists, delete the old HTML file and database record
-        if existing_pdf:
-            # Delete the old HTML file if it exists
-            if existing_pdf['html_filename']:
-                # Try to delete from the hospital system directory first
-                if existing_pdf['hospital_system']:
-                    safe_hospital_system = re.sub(r'[^\w\s-]', '', existing_pdf['hospital_system']).strip().replace(' ', '_')
-                    hospital_html_path = os.path.join(HTML_OUTPUT_DIR, safe_hospital_system, existing_pdf['html_filename'])
-                    if os.path.exists(hospital_html_path):
-                        os.remove(hospital_html_path)
-                        print(f"Deleted old HTML file from hospital system directory: {hospital_html_path}")
-                
-                # Also check the root directory
-                root_html_path = os.path.join(HTML_OUTPUT_DIR, existing_pdf['html_filename'])
-                if os.path.exists(root_html_path):
-                    os.remove(root_html_path)
-                    print(f"Deleted old HTML file from root directory: {root_html_path}")
+        if existing_pdf and existing_pdf['html_filename']:
+            stale_paths = []
+            if existing_pdf['hospital_system']:
+                safe_hospital_system = re.sub(r'[^\w\s-]', '', existing_pdf['hospital_system']).strip().replace(' ', '_')
+                stale_paths.append(os.path.join(HTML_OUTPUT_DIR, safe_hospital_system, existing_pdf['html_filename']))
+            stale_paths.append(os.path.join(HTML_OUTPUT_DIR, existing_pdf['html_filename']))
+            await run_in_threadpool(remove_files, stale_paths)
+            template_cache.invalidate(existing_pdf['html_filename'])
+        
+        def record_upload(db):
+            cursor = db.cursor()
             
-            # Delete the old record from the universal_pdfs table
-            cursor.execute("DELETE FROM universal_pdfs WHERE id = ?", (existing_pdf['id'],))
-            print(f"Deleted old template record for: {original_filename}")
-        
-        has_html = False
-        
-        # Insert the PDF into the database with the original filename as both original_filename and filename
-        cursor.execute(
-            """
-            INSERT INTO pdfs (user_id, original_filename, filename, upload_date)
-            VALUES (?, ?, ?, datetime('now'))
-            """,
-            (user_id, original_filename, original_filename)
-        )
-        
-        pdf_id = cursor.lastrowid
-        conn.commit()
-        
-        # Start processing in the background
-        processing_started = False
-        html_generated = False
-        
-        try:
-            # Get the full path to the uploaded PDF
-            pdf_path = os.path.join(UPLOADS_DIR, original_filename)
-            
-            # Make sure the file exists
-            if not os.path.exists(pdf_path):
-                raise Exception(f"PDF file not found at {pdf_path}")
+            # Check if this PDF already exists in the universal_pdfs table
+            cursor.execute(
+                "SELECT id FROM universal_pdfs WHERE original_filename = ?",
+                (original_filename,)
+            )
+            existing_pdf = cursor.fetchone()
             
-            # Initialize processing status
-            processing_status[original_filename] = False
+            # If the template already exists, delete the old database record
+            if existing_pdf:
+                cursor.execute("DELETE FROM universal_pdfs WHERE id = ?", (existing_pdf['id'],))
+                print(f"Deleted old template record for: {original_filename}")
             
-            # Start processing in the background
-            background_tasks.add_task(process_pdf_background, pdf_path, hospital_system)
+            # Insert the PDF into the database with the original filename as both original_filename and filename
+            cursor.execute(
+                """
+                INSERT INTO pdfs (user_id, original_filename, filename, upload_date)
+                VALUES (?, ?, ?, datetime('now'))
+                """,
+                (user_id, original_filename, original_filename)
+            )
+            pdf_id = cursor.lastrowid
             
-            processing_started = True
-            print(f"Started background processing for {original_filename}")
-        except Exception as e:
-            print(f"Error starting background processing: {str(e)}")
-            # Even if there's an error, we'll still return success for the upload
+            # Queue HTML generation in the same transaction so the job can't be lost
+            job_id = jobs.enqueue(
+                db,
+                jobs.PDF_TO_HTML,
+                {"pdf_path": file_path, "hospital_system": hospital_system},
+                job_key=original_filename,
+            )
+            return pdf_id, job_id
+        
+        pdf_id, job_id = await adb.transaction(record_upload)
+        healthcare_systems_cache.invalidate()
+        print(f"Queued HTML generation job {job_id} for {original_filename}")
+        
+        processing_started = True
+        html_generated = False
         
         # Return success response
         return {
@@ -520,30 +398,39 @@ async def upload_pdf(
         print(f"Error uploading PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to upload PDF: {str(e)}")
 
+# Fields returned by /api/user/{user_id}/pdfs (for fields=)
+USER_PDF_FIELDS = ("id", "filename", "originalFilename", "uploadDate", "url", "patientId", "patientName")
+
 # Endpoint to get all uploaded PDFs for a user with patient information
 @app.get("/api/user/{user_id}/pdfs")
-def get_user_pdfs(user_id: int):
+def get_user_pdfs(
+    user_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: sqlite3.Connection = Depends(get_db)
+):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        page = Page(limit, cursor, fields, USER_PDF_FIELDS)
+        after, after_params = page.where(("p.upload_date", "p.id"))
         
         # Modified query to include patient information using LEFT JOIN
-        cursor.execute(
-            """
+        rows = db.execute(
+            f"""
             SELECT p.id, p.filename, p.original_filename, p.upload_date, 
                    pat.id as patient_id, pat.name as patient_name
             FROM uploaded_pdfs p
             LEFT JOIN patients pat ON p.patient_id = pat.id
-            WHERE p.user_id = ?
-            ORDER BY p.upload_date DESC
+            WHERE p.user_id = ? AND {after}
+            ORDER BY p.upload_date DESC, p.id DESC
+            LIMIT ?
             """,
-            (user_id,)
-        )
+            (user_id, *after_params, page.fetch_size)
+        ).fetchall()
+        rows, next_cursor = page.finish(rows, lambda row: (row['upload_date'], row['id']))
         
         pdfs = []
-        for row in cursor.fetchall():
+        for row in rows:
             pdf_data = {
                 "id": row[0],
                 "filename": row[1],
@@ -557,13 +444,12 @@ def get_user_pdfs(user_id: int):
                 pdf_data["patientId"] = row[4]
                 pdf_data["patientName"] = row[5]
             
-            pdfs.append(pdf_data)
+            pdfs.append(page.project(pdf_data))
         
-        conn.close()
-        return {"pdfs": pdfs}
+        return {"pdfs": pdfs, "nextCursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching user PDFs: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch PDFs: {str(e)}")
 
@@ -571,73 +457,74 @@ def get_user_pdfs(user_id: int):
 @app.delete("/api/pdfs/{pdf_id}")
 def delete_pdf(pdf_id: int):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get the PDF information before deleting
-        cursor.execute(
-            """
-            SELECT filename, user_id
-            FROM uploaded_pdfs
-            WHERE id = ?
-            """,
-            (pdf_id,)
-        )
-        
-        pdf_info = cursor.fetchone()
-        if not pdf_info:
-            conn.close()
-            raise HTTPException(status_code=404, detail="PDF not found")
-        
-        # Get the file path
-        file_path = os.path.join(UPLOADS_DIR, pdf_info['filename'])
+        # Keep the writer only for the row change; the file goes once it's committed
+        with pool.write() as db:
+            cursor = db.cursor()
+            
+            # Get the PDF information before deleting
+            cursor.execute(
+                """
+                SELECT filename, user_id
+                FROM uploaded_pdfs
+                WHERE id = ?
+                """,
+                (pdf_id,)
+            )
+            
+            pdf_info = cursor.fetchone()
+            if not pdf_info:
+                raise HTTPException(status_code=404, detail="PDF not found")
+            
+            # Delete the database record
+            cursor.execute(
+                """
+                DELETE FROM uploaded_pdfs
+                WHERE id = ?
+                """,
+                (pdf_id,)
+            )
         
         # Delete the file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"Deleted file: {file_path}")
+        remove_files([os.path.join(UPLOADS_DIR, pdf_info['filename'])])
         
-        # Delete the database record
-        cursor.execute(
-            """
-            DELETE FROM uploaded_pdfs
-            WHERE id = ?
-            """,
-            (pdf_id,)
-        )
-        conn.commit()
-        
-        conn.close()
         return {"message": "PDF deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error deleting PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to delete PDF: {str(e)}")
 
+# Fields returned by /api/user/{user_id}/patients (for fields=)
+PATIENT_FIELDS = ("id", "name", "email", "dateOfBirth", "gender", "age", "conditions", "medications", "createdAt")
+
 # Get patients for a user
 @app.get("/api/user/{user_id}/patients")
-def get_user_patients(user_id: int):
+def get_user_patients(
+    user_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: sqlite3.Connection = Depends(get_db)
+):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        page = Page(limit, cursor, fields, PATIENT_FIELDS)
+        after, after_params = page.where(("id",), descending=False)
         
-        cursor.execute(
-            """
+        rows = db.execute(
+            f"""
             SELECT id, name, email, date_of_birth, gender, age, 
                    conditions, medications, created_at 
-            FROM patients WHERE user_id = ?
+            FROM patients WHERE user_id = ? AND {after}
+            ORDER BY id
+            LIMIT ?
             """, 
-            (user_id,)
-        )
+            (user_id, *after_params, page.fetch_size)
+        ).fetchall()
+        rows, next_cursor = page.finish(rows, lambda row: (row['id'],))
         
         patients = []
-        for row in cursor.fetchall():
-            patients.append({
+        for row in rows:
+            patients.append(page.project({
                 "id": row[0],
                 "name": row[1],
                 "email": row[2],
@@ -647,19 +534,18 @@ def get_user_patients(user_id: int):
                 "conditions": row[6],
                 "medications": row[7],
                 "createdAt": row[8]
-            })
+            }))
         
-        conn.close()
-        return {"patients": patients}
+        return {"patients": patients, "nextCursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching patients: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch patients: {str(e)}")
 
 # Add a new patient
 @app.post("/api/patients")
-async def add_patient(request: Request):
+async def add_patient(request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         # Get request body
         data = await request.json()
@@ -669,20 +555,12 @@ async def add_patient(request: Request):
         if not user_id or not name:
             raise HTTPException(status_code=400, detail="User ID and name are required")
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute(
+        result = await adb.execute(
             "INSERT INTO patients (name, user_id) VALUES (?, ?)",
             (name, user_id)
         )
-        conn.commit()
         
-        patient_id = cursor.lastrowid
-        
-        conn.close()
+        patient_id = result.lastrowid
         
         return {
             "patient": {
@@ -691,14 +569,12 @@ async def add_patient(request: Request):
             }
         }
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error adding patient: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to add patient: {str(e)}")
 
 # Assign a patient to a PDF
 @app.post("/api/pdfs/{pdf_id}/patient")
-async def assign_patient_to_pdf(pdf_id: int, request: Request):
+async def assign_patient_to_pdf(pdf_id: int, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         # Get request body
         data = await request.json()
@@ -707,56 +583,48 @@ async def assign_patient_to_pdf(pdf_id: int, request: Request):
         if not patient_id:
             raise HTTPException(status_code=400, detail="Patient ID is required")
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # Look up the patient, PDF and doctor on a reader
+        def load_names(db):
+            cursor = db.cursor()
         
-        # Get the patient name
-        cursor.execute(
-            "SELECT name FROM patients WHERE id = ?",
-            (patient_id,)
-        )
-        patient = cursor.fetchone()
-        
-        if not patient:
-            conn.close()
-            raise HTTPException(status_code=404, detail="Patient not found")
+            # Get the patient name
+            cursor.execute(
+                "SELECT name FROM patients WHERE id = ?",
+                (patient_id,)
+            )
+            patient = cursor.fetchone()
         
-        patient_name = patient[0].replace(' ', '_')
+            if not patient:
+                raise HTTPException(status_code=404, detail="Patient not found")
         
-        # Get the current PDF filename
-        cursor.execute(
-            "SELECT filename, user_id FROM uploaded_pdfs WHERE id = ?",
-            (pdf_id,)
-        )
-        pdf_info = cursor.fetchone()
+            # Get the current PDF filename
+            cursor.execute(
+                "SELECT filename, user_id FROM uploaded_pdfs WHERE id = ?",
+                (pdf_id,)
+            )
+            pdf_info = cursor.fetchone()
         
-        if not pdf_info:
-            conn.close()
-            raise HTTPException(status_code=404, detail="PDF not found")
+            if not pdf_info:
+                raise HTTPException(status_code=404, detail="PDF not found")
         
-        current_filename = pdf_info[0]
-        user_id = pdf_info[1]
+            # Get the doctor's name
+            cursor.execute(
+                "SELECT name FROM users WHERE id = ?",
+                (pdf_info[1],)
+            )
+            doctor = cursor.fetchone()
+            return patient[0].replace(' ', '_'), pdf_info[0], doctor[0].replace(' ', '_')
         
-        # Get the doctor's name
-        cursor.execute(
-            "SELECT name FROM users WHERE id = ?",
-            (user_id,)
-        )
-        doctor = cursor.fetchone()
-        doctor_name = doctor[0].replace(' ', '_')
+        patient_name, current_filename, doctor_name = await adb.read(load_names)
         
         # Extract the upload number from the current filename
         match = re.search(r'custom_upload(\d+)_', current_filename)
         if not match:
             # If the filename doesn't match the expected pattern, just update the patient ID
-            cursor.execute(
+            await adb.execute(
                 "UPDATE uploaded_pdfs SET patient_id = ? WHERE id = ?",
                 (patient_id, pdf_id)
             )
-            conn.commit()
-            conn.close()
             return {"success": True}
         
         upload_number = match.group(1)
@@ -764,27 +632,37 @@ async def assign_patient_to_pdf(pdf_id: int, request: Request):
         # Create the new filename with patient name
         new_filename = f"custom_upload{upload_number}_{doctor_name}_{patient_name}.pdf"
         
-        # Rename the file
+        # Rename the file before taking the writer, so no disk I/O runs while holding it
         old_path = os.path.join(UPLOADS_DIR, current_filename)
         new_path = os.path.join(UPLOADS_DIR, new_filename)
-        
-        if os.path.exists(old_path):
-            os.rename(old_path, new_path)
+        renamed = False
+        if old_path != new_path and os.path.exists(old_path):
+            await run_in_threadpool(os.rename, old_path, new_path)
+            renamed = True
             print(f"Renamed file from {old_path} to {new_path}")
         
-        # Update the database with the new filename and patient ID
-        cursor.execute(
-            "UPDATE uploaded_pdfs SET filename = ?, patient_id = ? WHERE id = ?",
-            (new_filename, patient_id, pdf_id)
-        )
-        conn.commit()
+        # Update the record, unless it changed since it was read
+        def update_pdf(db):
+            cursor = db.execute(
+                "UPDATE uploaded_pdfs SET filename = ?, patient_id = ? WHERE id = ? AND filename = ?",
+                (new_filename, patient_id, pdf_id, current_filename)
+            )
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=409, detail="PDF was changed or deleted concurrently")
         
-        conn.close()
+        try:
+            await adb.transaction(update_pdf)
+        except Exception:
+            # Put the file back under the name the database still has
+            if renamed:
+                await run_in_threadpool(os.rename, new_path, old_path)
+                print(f"Restored file name {old_path} after a failed update")
+            raise
         
         return {"success": True, "newFilename": new_filename}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error assigning patient to PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to assign patient: {str(e)}")
 
@@ -792,55 +670,49 @@ async def assign_patient_to_pdf(pdf_id: int, request: Request):
 @app.delete("/api/patients/{patient_id}")
 def delete_patient(patient_id: int):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # First, get the patient name for the response message
-        cursor.execute("SELECT name FROM patients WHERE id = ?", (patient_id,))
-        patient = cursor.fetchone()
-        
-        if not patient:
-            conn.close()
-            raise HTTPException(status_code=404, detail="Patient not found")
-        
-        patient_name = patient['name']
-        
-        # Get all PDFs associated with this patient
-        cursor.execute("SELECT id, filename FROM uploaded_pdfs WHERE patient_id = ?", (patient_id,))
-        associated_pdfs = cursor.fetchall()
-        
-        # Delete the patient's PDFs from the filesystem
-        for pdf in associated_pdfs:
-            pdf_path = os.path.join(UPLOADS_DIR, pdf['filename'])
-            try:
-                if os.path.exists(pdf_path):
-                    os.remove(pdf_path)
-                    print(f"Deleted PDF file: {pdf_path}")
-            except Exception as e:
-                print(f"Error deleting PDF file {pdf_path}: {str(e)}")
-        
-        # Delete the patient's PDFs from the database
-        cursor.execute("DELETE FROM uploaded_pdfs WHERE patient_id = ?", (patient_id,))
-        deleted_pdfs_count = cursor.rowcount
-        print(f"Deleted {deleted_pdfs_count} PDFs associated with patient {patient_id}")
-        
-        # Now delete the patient
-        cursor.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
-        
-        affected_rows = cursor.rowcount
-        print(f"Deleted patient {patient_id}, affected rows: {affected_rows}")
+        # Keep the writer only for the row changes; the files go once they're committed
+        with pool.write() as db:
+            cursor = db.cursor()
+            
+            # First, get the patient name for the response message
+            cursor.execute("SELECT name FROM patients WHERE id = ?", (patient_id,))
+            patient = cursor.fetchone()
+            
+            if not patient:
+                raise HTTPException(status_code=404, detail="Patient not found")
+            
+            patient_name = patient['name']
+            
+            # Get all PDFs associated with this patient
+            cursor.execute("SELECT id, filename FROM uploaded_pdfs WHERE patient_id = ?", (patient_id,))
+            associated_pdfs = cursor.fetchall()
+            
+            # Delete the patient's PDFs from the database
+            cursor.execute("DELETE FROM uploaded_pdfs WHERE patient_id = ?", (patient_id,))
+            deleted_pdfs_count = cursor.rowcount
+            print(f"Deleted {deleted_pdfs_count} PDFs associated with patient {patient_id}")
+            
+            # Now delete the patient
+            cursor.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+            
+            affected_rows = cursor.rowcount
+            print(f"Deleted patient {patient_id}, affected rows: {affected_rows}")
+            
+            # Forms prefilled for the patient are no longer valid
+            invalidate_cached_fills(patient_id=patient_id, conn=db)
         
-        # Commit the changes and close the connection
-        conn.commit()
-        conn.close()
+        # Delete the patient's PDFs and prefilled forms from the filesystem
+        remove_files([os.path.join(UPLOADS_DIR, pdf['filename']) for pdf in associated_pdfs])
+        output_dirs = [HTML_OUTPUT_DIR] + [entry.path for entry in os.scandir(HTML_OUTPUT_DIR) if entry.is_dir()]
+        remove_published_fills(filled_output_pattern(patient_id=patient_id), output_dirs)
         
         return {
             "success": True, 
             "message": f"Patient '{patient_name}' deleted successfully",
             "deletedPdfsCount": deleted_pdfs_count
         }
+    except HTTPException:
+        raise
     except Exception as e:
         # Detailed error logging
         import traceback
@@ -848,91 +720,84 @@ def delete_patient(patient_id: int):
         print(f"Error deleting patient: {str(e)}")
         print(f"Error details: {error_details}")
         
-        if 'conn' in locals():
-            conn.close()
-        
         raise HTTPException(status_code=500, detail=f"Failed to delete patient: {str(e)}")
 
 # Update the create_patient endpoint to handle the new fields
 @app.post("/api/user/{user_id}/patients")
-async def create_patient(user_id: int, request: Request):
+async def create_patient(user_id: int, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         # Get request body
         data = await request.json()
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # Verify the user and insert the patient in one transaction
+        def insert_patient(db):
+            cursor = db.cursor()
         
-        # Verify the user exists
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
+            # Verify the user exists
+            cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+            user = cursor.fetchone()
         
-        if not user:
-            conn.close()
-            raise HTTPException(status_code=404, detail="User not found")
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
         
-        # Insert the new patient
-        cursor.execute(
-            """
-            INSERT INTO patients (name, user_id, email, date_of_birth, gender, age, conditions, medications)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                data.get('name', ''),
-                user_id,
-                data.get('email', ''),
-                data.get('date_of_birth', ''),
-                data.get('gender', ''),
-                data.get('age', ''),
-                data.get('conditions', ''),
-                data.get('medications', '')
+            # Insert the new patient
+            cursor.execute(
+                """
+                INSERT INTO patients (name, user_id, email, date_of_birth, gender, age, conditions, medications)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    data.get('name', ''),
+                    user_id,
+                    data.get('email', ''),
+                    data.get('date_of_birth', ''),
+                    data.get('gender', ''),
+                    data.get('age', ''),
+                    data.get('conditions', ''),
+                    data.get('medications', '')
+                )
             )
-        )
-        conn.commit()
         
-        # Get the ID of the newly inserted patient
-        patient_id = cursor.lastrowid
+            # Get the ID of the newly inserted patient
+            patient_id = cursor.lastrowid
         
-        # Get the patient information
-        cursor.execute(
-            """
-            SELECT id, name, user_id, email, date_of_birth, gender, age, conditions, medications, created_at
-            FROM patients
-            WHERE id = ?
-            """,
-            (patient_id,)
-        )
+            # Get the patient information
+            cursor.execute(
+                """
+                SELECT id, name, user_id, email, date_of_birth, gender, age, conditions, medications, created_at
+                FROM patients
+                WHERE id = ?
+                """,
+                (patient_id,)
+            )
         
-        patient = cursor.fetchone()
-        conn.close()
+            patient = cursor.fetchone()
         
-        # Return the patient data
-        return {
-            "success": True,
-            "patient": {
-                "id": patient[0],
-                "name": patient[1],
-                "userId": patient[2],
-                "email": patient[3],
-                "dateOfBirth": patient[4],
-                "gender": patient[5],
-                "age": patient[6],
-                "conditions": patient[7],
-                "medications": patient[8],
-                "createdAt": patient[9]
+            # Return the patient data
+            return {
+                "success": True,
+                "patient": {
+                    "id": patient[0],
+                    "name": patient[1],
+                    "userId": patient[2],
+                    "email": patient[3],
+                    "dateOfBirth": patient[4],
+                    "gender": patient[5],
+                    "age": patient[6],
+                    "conditions": patient[7],
+                    "medications": patient[8],
+                    "createdAt": patient[9]
+                }
             }
-        }
+        
+        return await adb.transaction(insert_patient)
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error creating patient: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create patient: {str(e)}")
 
 # Fix the associate_pdf_with_patient endpoint to handle SQLite thread issues
 @app.post("/api/pdfs/{pdf_id}/patient")
-async def associate_pdf_with_patient(pdf_id: int, request: Request):
+async def associate_pdf_with_patient(pdf_id: int, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         # Get request body
         data = await request.json()
@@ -943,111 +808,84 @@ async def associate_pdf_with_patient(pdf_id: int, request: Request):
         
         patient_id = data['patient_id']
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        # Update the PDF in one transaction
+        def associate_patient(db):
+            cursor = db.cursor()
         
-        # Update the PDF to associate it with the patient
-        cursor.execute(
-            "UPDATE uploaded_pdfs SET patient_id = ? WHERE id = ?",
-            (patient_id, pdf_id)
-        )
-        conn.commit()
+            # Update the PDF to associate it with the patient
+            cursor.execute(
+                "UPDATE uploaded_pdfs SET patient_id = ? WHERE id = ?",
+                (patient_id, pdf_id)
+            )
+        
+            # Check if the update was successful
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="PDF not found")
         
-        # Check if the update was successful
-        if cursor.rowcount == 0:
-            conn.close()
-            raise HTTPException(status_code=404, detail="PDF not found")
+            return {"success": True}
         
-        conn.close()
-        return {"success": True}
+        return await adb.transaction(associate_patient)
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error associating PDF with patient: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to associate PDF with patient: {str(e)}")
 
 # Get all healthcare systems
 @app.get("/api/healthcare-systems")
-def get_healthcare_systems():
+def get_healthcare_systems(db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT id, name FROM healthcare_systems ORDER BY name
-        ''')
-        
-        systems = []
-        for row in cursor.fetchall():
-            # Get count of users in this system
-            cursor.execute('''
-            SELECT COUNT(*) as user_count FROM users WHERE hospital_system_id = ?
-            ''', (row['id'],))
-            user_count = cursor.fetchone()['user_count']
-            
-            # Get count of templates for this system
-            cursor.execute('''
-            SELECT COUNT(*) as template_count FROM healthcare_templates WHERE healthcare_system_id = ?
-            ''', (row['id'],))
-            template_count = cursor.fetchone()['template_count']
-            
-            systems.append({
-                "id": row['id'],
-                "name": row['name'],
-                "userCount": user_count,
-                "templateCount": template_count
-            })
-        
-        conn.close()
-        return {"healthcareSystems": systems}
+        # One grouped query, cached until users or templates change
+        return {"healthcareSystems": healthcare_systems_cache.get(db)}
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching healthcare systems: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch healthcare systems: {str(e)}")
 
+# Fields returned by /api/healthcare-systems/{system_id}/users (for fields=)
+HEALTHCARE_SYSTEM_USER_FIELDS = ("id", "name", "email", "healthcareTitle", "createdAt")
+
 # Get users for a specific healthcare system
 @app.get("/api/healthcare-systems/{system_id}/users")
-def get_healthcare_system_users(system_id: int):
+def get_healthcare_system_users(
+    system_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: sqlite3.Connection = Depends(get_db)
+):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        page = Page(limit, cursor, fields, HEALTHCARE_SYSTEM_USER_FIELDS)
+        after, after_params = page.where(("name", "id"), descending=False)
         
-        cursor.execute('''
+        rows = db.execute(f'''
         SELECT id, name, email, healthcare_title, created_at 
         FROM users 
-        WHERE hospital_system_id = ?
-        ORDER BY name
-        ''', (system_id,))
+        WHERE hospital_system_id = ? AND {after}
+        ORDER BY name, id
+        LIMIT ?
+        ''', (system_id, *after_params, page.fetch_size)).fetchall()
+        rows, next_cursor = page.finish(rows, lambda row: (row['name'], row['id']))
         
         users = []
-        for row in cursor.fetchall():
-            users.append({
+        for row in rows:
+            users.append(page.project({
                 "id": row['id'],
                 "name": row['name'],
                 "email": row['email'],
                 "healthcareTitle": row['healthcare_title'],
                 "createdAt": row['created_at']
-            })
+            }))
         
-        conn.close()
-        return {"users": users}
+        return {"users": users, "nextCursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching healthcare system users: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch healthcare system users: {str(e)}")
 
 # Get templates for a specific healthcare system
 @app.get("/api/healthcare-systems/{system_id}/templates")
-def get_healthcare_system_templates(system_id: int):
+def get_healthcare_system_templates(system_id: int, db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         cursor.execute('''
         SELECT id, template_name, created_at, updated_at 
@@ -1065,21 +903,16 @@ def get_healthcare_system_templates(system_id: int):
                 "updatedAt": row['updated_at']
             })
         
-        conn.close()
         return {"templates": templates}
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching healthcare system templates: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch healthcare system templates: {str(e)}")
 
 # Get a specific template
 @app.get("/api/healthcare-templates/{template_id}")
-def get_healthcare_template(template_id: int):
+def get_healthcare_template(template_id: int, db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         cursor.execute('''
         SELECT id, healthcare_system_id, template_name, template_content, created_at, updated_at 
@@ -1099,8 +932,6 @@ def get_healthcare_template(template_id: int):
         
         system = cursor.fetchone()
         
-        conn.close()
-        
         return {
             "template": {
                 "id": template['id'],
@@ -1113,14 +944,12 @@ def get_healthcare_template(template_id: int):
             }
         }
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching healthcare template: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch healthcare template: {str(e)}")
 
 # Create a new template
 @app.post("/api/healthcare-systems/{system_id}/templates")
-async def create_healthcare_template(system_id: int, request: Request):
+async def create_healthcare_template(system_id: int, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         data = await request.json()
         
@@ -1130,80 +959,73 @@ async def create_healthcare_template(system_id: int, request: Request):
         template_name = data['name']
         template_content = data['content']
         
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # Validate and insert the template in one transaction
+        def insert_template(db):
+            cursor = db.cursor()
         
-        # Check if the healthcare system exists
-        cursor.execute("SELECT id FROM healthcare_systems WHERE id = ?", (system_id,))
-        system = cursor.fetchone()
+            # Check if the healthcare system exists
+            cursor.execute("SELECT id FROM healthcare_systems WHERE id = ?", (system_id,))
+            system = cursor.fetchone()
         
-        if not system:
-            conn.close()
-            raise HTTPException(status_code=404, detail="Healthcare system not found")
+            if not system:
+                raise HTTPException(status_code=404, detail="Healthcare system not found")
         
-        # Check if a template with this name already exists for this system
-        cursor.execute(
-            "SELECT id FROM healthcare_templates WHERE healthcare_system_id = ? AND template_name = ?", 
-            (system_id, template_name)
-        )
-        existing = cursor.fetchone()
+            # Check if a template with this name already exists for this system
+            cursor.execute(
+                "SELECT id FROM healthcare_templates WHERE healthcare_system_id = ? AND template_name = ?", 
+                (system_id, template_name)
+            )
+            existing = cursor.fetchone()
         
-        if existing:
-            conn.close()
-            raise HTTPException(status_code=400, detail="A template with this name already exists for this healthcare system")
+            if existing:
+                raise HTTPException(status_code=400, detail="A template with this name already exists for this healthcare system")
         
-        # Create the new template
-        cursor.execute(
-            '''
-            INSERT INTO healthcare_templates 
-            (healthcare_system_id, template_name, template_content) 
-            VALUES (?, ?, ?)
-            ''',
-            (system_id, template_name, template_content)
-        )
+            # Create the new template
+            cursor.execute(
+                '''
+                INSERT INTO healthcare_templates 
+                (healthcare_system_id, template_name, template_content) 
+                VALUES (?, ?, ?)
+                ''',
+                (system_id, template_name, template_content)
+            )
         
-        conn.commit()
         
-        # Get the newly created template
-        template_id = cursor.lastrowid
-        cursor.execute(
-            "SELECT id, template_name, created_at, updated_at FROM healthcare_templates WHERE id = ?", 
-            (template_id,)
-        )
+            # Get the newly created template
+            template_id = cursor.lastrowid
+            cursor.execute(
+                "SELECT id, template_name, created_at, updated_at FROM healthcare_templates WHERE id = ?", 
+                (template_id,)
+            )
         
-        template = cursor.fetchone()
-        conn.close()
+            template = cursor.fetchone()
         
-        return {
-            "success": True,
-            "template": {
-                "id": template['id'],
-                "name": template['template_name'],
-                "createdAt": template['created_at'],
-                "updatedAt": template['updated_at']
+            return {
+                "success": True,
+                "template": {
+                    "id": template['id'],
+                    "name": template['template_name'],
+                    "createdAt": template['created_at'],
+                    "updatedAt": template['updated_at']
+                }
             }
-        }
+        
+        return await adb.transaction(insert_template)
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error creating healthcare template: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create healthcare template: {str(e)}")
 
 # Get files for a specific patient
 @app.get("/api/patient/{patient_id}/files")
-def get_patient_files(patient_id: int):
+def get_patient_files(patient_id: int, db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # First check if the patient exists
         cursor.execute("SELECT name FROM patients WHERE id = ?", (patient_id,))
         patient = cursor.fetchone()
         
         if not patient:
-            conn.close()
             raise HTTPException(status_code=404, detail="Patient not found")
         
         patient_name = patient['name']
@@ -1242,17 +1064,14 @@ def get_patient_files(patient_id: int):
                             "url": f"/uploads/{row['filename']}"
                         })
         
-        conn.close()
         return {"files": files}
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching patient files: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch patient files: {str(e)}")
 
 # Add or update HTML content for a universal PDF
 @app.post("/api/universal-pdfs")
-async def add_universal_pdf(request: Request):
+async def add_universal_pdf(request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         data = await request.json()
         
@@ -1260,71 +1079,70 @@ async def add_universal_pdf(request: Request):
             raise HTTPException(status_code=400, detail="Missing required fields: original_filename and html_content")
         
         original_filename = data['original_filename']
-        html_content = data['html_content']
         
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # The HTML goes to the blob store; the row only records its hash
+        html_hash, html_size = await run_in_threadpool(put_blob, data['html_content'])
         
-        # Check if this PDF already exists in the universal_pdfs table
-        cursor.execute(
-            "SELECT id FROM universal_pdfs WHERE original_filename = ?", 
-            (original_filename,)
-        )
-        existing = cursor.fetchone()
+        # Insert or update the record in one transaction
+        def upsert_universal_pdf(db):
+            cursor = db.cursor()
         
-        if existing:
-            # Update existing record
-            cursor.execute(
-                '''
-                UPDATE universal_pdfs 
-                SET html_content = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE original_filename = ?
-                ''',
-                (html_content, original_filename)
-            )
-            pdf_id = existing['id']
-        else:
-            # Insert new record
+            # Check if this PDF already exists in the universal_pdfs table
             cursor.execute(
-                '''
-                INSERT INTO universal_pdfs 
-                (original_filename, html_content) 
-                VALUES (?, ?)
-                ''',
-                (original_filename, html_content)
+                "SELECT id FROM universal_pdfs WHERE original_filename = ?", 
+                (original_filename,)
             )
-            pdf_id = cursor.lastrowid
+            existing = cursor.fetchone()
         
-        conn.commit()
-        conn.close()
+            if existing:
+                # Update existing record
+                cursor.execute(
+                    '''
+                    UPDATE universal_pdfs 
+                    SET html_hash = ?, html_size = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE original_filename = ?
+                    ''',
+                    (html_hash, html_size, original_filename)
+                )
+                pdf_id = existing['id']
+            else:
+                # Insert new record
+                cursor.execute(
+                    '''
+                    INSERT INTO universal_pdfs 
+                    (original_filename, html_hash, html_size) 
+                    VALUES (?, ?, ?)
+                    ''',
+                    (original_filename, html_hash, html_size)
+                )
+                pdf_id = cursor.lastrowid
         
-        return {
-            "success": True,
-            "message": "Universal PDF saved successfully",
-            "id": pdf_id
-        }
+        
+            return {
+                "success": True,
+                "message": "Universal PDF saved successfully",
+                "id": pdf_id
+            }
+        
+        return await adb.transaction(upsert_universal_pdf)
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error saving universal PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to save universal PDF: {str(e)}")
 
 # Get HTML content for a universal PDF by original filename
 @app.get("/api/universal-pdfs/{original_filename}")
-def get_universal_pdf(original_filename: str):
+def get_universal_pdf(original_filename: str, db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         cursor.execute(
-            "SELECT id, original_filename, html_content, created_at, updated_at FROM universal_pdfs WHERE original_filename = ?",
+            "SELECT id, original_filename, html_hash, created_at, updated_at FROM universal_pdfs WHERE original_filename = ?",
             (original_filename,)
         )
         
         pdf = cursor.fetchone()
-        conn.close()
         
         if not pdf:
             raise HTTPException(status_code=404, detail="Universal PDF not found")
@@ -1332,206 +1150,147 @@ def get_universal_pdf(original_filename: str):
         return {
             "id": pdf['id'],
             "original_filename": pdf['original_filename'],
-            "html_content": pdf['html_content'],
+            "html_content": read_blob_text(pdf['html_hash']),
             "created_at": pdf['created_at'],
             "updated_at": pdf['updated_at']
         }
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching universal PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch universal PDF: {str(e)}")
 
+# Fields returned by /api/universal-pdfs (for fields=)
+UNIVERSAL_PDF_FIELDS = ("id", "original_filename", "created_at", "updated_at")
+
 # Get all universal PDFs
 @app.get("/api/universal-pdfs")
-def get_all_universal_pdfs():
+def get_all_universal_pdfs(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: sqlite3.Connection = Depends(get_db)
+):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT id, original_filename, created_at, updated_at FROM universal_pdfs ORDER BY created_at DESC"
-        )
+        page = Page(limit, cursor, fields, UNIVERSAL_PDF_FIELDS)
+        after, after_params = page.where(("created_at", "id"))
+        
+        rows = db.execute(
+            f"""
+            SELECT id, original_filename, created_at, updated_at FROM universal_pdfs
+            WHERE {after}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+            """,
+            (*after_params, page.fetch_size)
+        ).fetchall()
+        rows, next_cursor = page.finish(rows, lambda row: (row['created_at'], row['id']))
         
         pdfs = []
-        for row in cursor.fetchall():
-            pdfs.append({
+        for row in rows:
+            pdfs.append(page.project({
                 "id": row['id'],
                 "original_filename": row['original_filename'],
                 "created_at": row['created_at'],
                 "updated_at": row['updated_at']
-            })
+            }))
         
-        conn.close()
-        return {"pdfs": pdfs}
+        return {"pdfs": pdfs, "nextCursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         print(f"Error fetching universal PDFs: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch universal PDFs: {str(e)}")
 
 # Endpoint to check if HTML has been generated for a PDF
 @app.get("/api/check-html/{original_filename}")
-def check_html_readiness(original_filename: str, user_id: int):
+def check_html_readiness(original_filename: str, user_id: int, db: sqlite3.Connection = Depends(get_db)):
     try:
-        # Check if the file is still being processed
-        if original_filename in processing_status:
-            # If processing is complete
-            if processing_status[original_filename]:
-                # Remove from tracking dict to free memory
-                del processing_status[original_filename]
-                
-                # Check if HTML was actually generated
-                conn = sqlite3.connect(DB_PATH)
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                cursor.execute(
-                    "SELECT html_filename FROM universal_pdfs WHERE original_filename = ?",
-                    (original_filename,)
-                )
-                
-                result = cursor.fetchone()
-                conn.close()
-                
-                if result and result['html_filename']:
-                    return {"htmlGenerated": True, "htmlFilename": result['html_filename']}
-                else:
-                    return {"htmlGenerated": False, "error": "HTML generation failed"}
-            else:
-                # Still processing
-                return {"htmlGenerated": False, "processing": True}
+        # Check the latest conversion job for this file
+        job = jobs.get_latest_job(db, jobs.PDF_TO_HTML, original_filename)
+        
+        if job and job['status'] in (jobs.QUEUED, jobs.RUNNING):
+            # Still processing (or waiting to retry)
+            return {"htmlGenerated": False, "processing": True, "jobStatus": job['status'], "attempts": job['attempts']}
+        
+        # Check if HTML was actually generated
+        cursor = db.cursor()
+        
+        cursor.execute(
+            "SELECT html_filename FROM universal_pdfs WHERE original_filename = ?",
+            (original_filename,)
+        )
+        
+        result = cursor.fetchone()
+        
+        if result and result['html_filename']:
+            return {"htmlGenerated": True, "htmlFilename": result['html_filename']}
+        elif job:
+            return {"htmlGenerated": False, "error": job['last_error'] or "HTML generation failed", "jobStatus": job['status']}
         else:
-            # Check if it's already in the database
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                "SELECT html_filename FROM universal_pdfs WHERE original_filename = ?",
-                (original_filename,)
-            )
-            
-            result = cursor.fetchone()
-            conn.close()
-            
-            if result and result['html_filename']:
-                return {"htmlGenerated": True, "htmlFilename": result['html_filename']}
-            else:
-                return {"htmlGenerated": False, "error": "Not found or processing not started"}
+            return {"htmlGenerated": False, "error": "Not found or processing not started"}
     except Exception as e:
         print(f"Error checking HTML readiness: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to check HTML readiness: {str(e)}")
 
-# Add this function to server.py
-def ensure_db_schema():
-    """Ensure the database schema is up to date with all required columns"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Create users table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        healthcare_title TEXT,
-        hospital_system TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create pdfs table if it doesn't exist
-    # Note: We're keeping patient_id for backward compatibility, but it will be NULL for new uploads
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS pdfs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        patient_id INTEGER,
-        original_filename TEXT NOT NULL,
-        filename TEXT NOT NULL,
-        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (patient_id) REFERENCES patients (id)
-    )
-    ''')
-    
-    # Create patients table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS patients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        user_id INTEGER NOT NULL,
-        email TEXT,
-        date_of_birth TEXT,
-        gender TEXT,
-        age TEXT,
-        conditions TEXT,
-        medications TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-    
-    # Create universal_pdfs table if it doesn't exist
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS universal_pdfs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        original_filename TEXT UNIQUE NOT NULL,
-        html_content TEXT,
-        html_filename TEXT,
-        hospital_system TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create filled_forms table to track completed forms assigned to patients
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS filled_forms (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        patient_id INTEGER NOT NULL,
-        pdf_id INTEGER NOT NULL,
-        filled_data TEXT,
-        filled_filename TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (patient_id) REFERENCES patients (id),
-        FOREIGN KEY (pdf_id) REFERENCES pdfs (id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
+# Admin endpoint to rerun a single chain1 stage for a template
+@app.post("/api/admin/templates/{original_filename}/rerun-stage")
+async def rerun_template_stage(original_filename: str, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
+    try:
+        data = await request.json()
+        stage = data.get('stage')
+        
+        if stage not in CHAIN1_STAGES:
+            raise HTTPException(status_code=400, detail=f"stage must be one of: {', '.join(CHAIN1_STAGES)}")
+        
+        template = await adb.fetchone(
+            "SELECT hospital_system FROM universal_pdfs WHERE original_filename = ?",
+            (original_filename,)
+        )
+        
+        if not template:
+            raise HTTPException(status_code=404, detail="Template not found")
+        
+        pdf_path = os.path.join(UPLOADS_DIR, original_filename)
+        if not os.path.exists(pdf_path):
+            raise HTTPException(status_code=404, detail=f"PDF file not found: {original_filename}")
+        
+        # Queue the rerun; earlier stages resume from their checkpoints
+        job_id = await adb.transaction(
+            jobs.enqueue,
+            jobs.PDF_TO_HTML,
+            {"pdf_path": pdf_path, "hospital_system": template['hospital_system'], "rerun_stage": stage},
+            job_key=original_filename,
+            priority=int(data.get('priority', 0)),
+        )
+        
+        return {"success": True, "jobId": job_id, "stage": stage}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error queueing stage rerun: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to queue stage rerun: {str(e)}")
 
-# Call this function during server startup
-ensure_db_schema()
 
 # Run the server with uvicorn
 
 
 @app.get("/api/debug/html-content/{original_filename}")
-def debug_html_content(original_filename: str):
+def debug_html_content(original_filename: str, db: sqlite3.Connection = Depends(get_db)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         cursor.execute(
-            "SELECT html_content, html_filename FROM universal_pdfs WHERE original_filename = ?",
+            "SELECT html_hash, html_size, html_filename FROM universal_pdfs WHERE original_filename = ?",
             (original_filename,)
         )
         
         result = cursor.fetchone()
-        conn.close()
         
         if not result:
             return {"error": "No record found", "filename": original_filename}
         
-        html_content = result['html_content']
+        html_hash = result['html_hash']
         html_filename = result['html_filename']
         
         # Check if the HTML file exists
@@ -1541,8 +1300,9 @@ def debug_html_content(original_filename: str):
         return {
             "filename": original_filename,
             "html_filename": html_filename,
-            "has_html_content": html_content is not None,
-            "html_content_length": len(html_content) if html_content else 0,
+            "has_html_content": html_hash is not None,
+            "html_content_length": result['html_size'] or 0,
+            "html_hash": html_hash,
             "file_exists": file_exists,
             "file_path": html_path
         }
@@ -1557,52 +1317,50 @@ async def add_cors_headers_for_html(request, call_next):
         response.headers["Access-Control-Allow-Origin"] = "*"
     return response
 
-@app.get("/api/html-content/{original_filename}")
-def get_html_content(original_filename: str, user_id: int):
+@app.api_route("/api/html-content/{original_filename}", methods=["GET", "HEAD"])
+def get_html_content(original_filename: str, user_id: int, request: Request, db: sqlite3.Connection = Depends(get_db)):
     try:
-        # Get the user's hospital system
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT hospital_system FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        hospital_system = user['hospital_system']
+        # Look up the user's hospital system and the template in one query
+        cursor = db.cursor()
         
-        # Get the HTML filename from the database
         cursor.execute(
-            "SELECT html_filename, hospital_system FROM universal_pdfs WHERE original_filename = ?",
-            (original_filename,)
+            """
+            SELECT u.hospital_system AS user_hospital_system, up.html_filename, up.hospital_system
+            FROM users u
+            LEFT JOIN universal_pdfs up ON up.original_filename = ?
+            WHERE u.id = ?
+            """,
+            (original_filename, user_id)
         )
         
         pdf = cursor.fetchone()
-        conn.close()
         
         if not pdf:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        hospital_system = pdf['user_hospital_system']
+        
+        if pdf['html_filename'] is None:
             raise HTTPException(status_code=404, detail=f"HTML record not found for: {original_filename}")
         
         # Check if the hospital system matches
         if pdf['hospital_system'] != hospital_system:
             raise HTTPException(status_code=403, detail="You don't have permission to access this template")
         
-        # Construct the full path to the HTML file
-        html_path = os.path.join(HTML_OUTPUT_DIR, pdf['html_filename'])
+        # Serve the HTML from the in-memory template cache
+        template = template_cache.get(pdf['hospital_system'], pdf['html_filename'])
         
-        # Check if the HTML file exists
-        if not os.path.exists(html_path):
+        if template is None:
             raise HTTPException(status_code=404, detail=f"HTML file not found: {pdf['html_filename']}")
         
-        # Read the HTML file
-        with open(html_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
-        
-        # Return the HTML content with the correct content type
-        return Response(content=html_content, media_type="text/html")
+        # Templates only change when chain1 reruns, so let clients keep a copy
+        # and revalidate it with a conditional request
+        return bytes_response(
+            request, template.html, template.etag, template.last_modified, template.mtime,
+            media_type="text/html", cache_control=HTML_CACHE_CONTROL, variants=template.variants
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching HTML content: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch HTML content: {str(e)}")
@@ -1629,7 +1387,6 @@ def create_hospital_system_directories():
                 js_content = f.read()
             
             # Extract the array content using a simple regex
-            import re
             match = re.search(r'\[\s*"([^"]*)"(?:\s*,\s*"([^"]*)")*\s*\]', js_content, re.DOTALL)
             if match:
                 # Extract all the hospital systems from the regex match
@@ -1658,18 +1415,17 @@ def create_hospital_system_directories():
         print(f"Error creating hospital system directories: {str(e)}")
         return False
 
-# Call this function during server startup
-create_hospital_system_directories()
+@app.on_event("startup")
+def create_hospital_system_directories_at_startup():
+    """Create the hospital system directories once the server starts"""
+    create_hospital_system_directories()
 
 @app.get("/api/user/{user_id}/templates")
-def get_user_templates(user_id: int):
+def get_user_templates(user_id: int, db: sqlite3.Connection = Depends(get_db)):
     try:
         print(f"Fetching templates for user ID: {user_id}")
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Check if the user exists
         cursor.execute("SELECT id, name, email, hospital_system FROM users WHERE id = ?", (user_id,))
@@ -1677,7 +1433,6 @@ def get_user_templates(user_id: int):
         
         if not user:
             print(f"User with ID {user_id} not found")
-            conn.close()
             # Return empty templates instead of raising an error
             return {
                 "hospitalSystem": "Unknown",
@@ -1690,7 +1445,6 @@ def get_user_templates(user_id: int):
         
         if not hospital_system:
             print(f"User with ID {user_id} has no hospital system")
-            conn.close()
             return {
                 "hospitalSystem": "None",
                 "templates": [],
@@ -1762,43 +1516,50 @@ def get_user_templates(user_id: int):
             "error": str(e)
         }
 
+# Fields returned by /api/user/{user_id}/filled-forms (for fields=)
+FILLED_FORM_FIELDS = (
+    "id", "userId", "patientId", "pdfId", "filledData", "filledFilename",
+    "createdAt", "patientName", "originalFilename"
+)
+
 @app.get("/api/user/{user_id}/filled-forms")
-def get_user_filled_forms(user_id: int):
+def get_user_filled_forms(
+    user_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: sqlite3.Connection = Depends(get_db)
+):
     try:
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        page = Page(limit, cursor, fields, FILLED_FORM_FIELDS)
+        after, after_params = page.where(("f.created_at", "f.id"))
         
         # Verify the user exists
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
+        user = db.execute("SELECT id FROM users WHERE id = ?", (user_id,)).fetchone()
         
         if not user:
-            conn.close()
             raise HTTPException(status_code=404, detail="User not found")
         
-        # Get all filled forms for this user
-        cursor.execute(
-            """
+        # Get this page of filled forms for this user
+        forms = db.execute(
+            f"""
             SELECT f.id, f.user_id, f.patient_id, f.pdf_id, f.filled_data, 
                    f.filled_filename, f.created_at, p.name as patient_name,
                    u.original_filename
             FROM filled_forms f
             LEFT JOIN patients p ON f.patient_id = p.id
             LEFT JOIN uploaded_pdfs u ON f.pdf_id = u.id
-            WHERE f.user_id = ?
-            ORDER BY f.created_at DESC
+            WHERE f.user_id = ? AND {after}
+            ORDER BY f.created_at DESC, f.id DESC
+            LIMIT ?
             """,
-            (user_id,)
-        )
-        
-        forms = cursor.fetchall()
-        conn.close()
+            (user_id, *after_params, page.fetch_size)
+        ).fetchall()
+        forms, next_cursor = page.finish(forms, lambda form: (form['created_at'], form['id']))
         
         # Convert to a list of dictionaries
         filled_forms = [
-            {
+            page.project({
                 "id": form['id'],
                 "userId": form['user_id'],
                 "patientId": form['patient_id'],
@@ -1808,13 +1569,16 @@ def get_user_filled_forms(user_id: int):
                 "createdAt": form['created_at'],
                 "patientName": form['patient_name'],
                 "originalFilename": form['original_filename']
-            }
+            })
             for form in forms
         ]
         
         return {
-            "filledForms": filled_forms
+            "filledForms": filled_forms,
+            "nextCursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching filled forms: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch filled forms: {str(e)}")
@@ -1824,42 +1588,48 @@ def delete_template(template_filename: str, user_id: int):
     try:
         print(f"Deleting template: {template_filename} for user ID: {user_id}")
         
-        # Create a new database connection for this request
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get the user's hospital system
-        cursor.execute("SELECT hospital_system FROM users WHERE id = ?", (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        hospital_system = user['hospital_system']
-        print(f"User's hospital system: {hospital_system}")
-        
-        # Get the template to verify it belongs to the user's hospital system
-        cursor.execute(
-            "SELECT id, html_filename, hospital_system FROM universal_pdfs WHERE original_filename = ?",
-            (template_filename,)
-        )
-        
-        template = cursor.fetchone()
-        
-        if not template:
-            print(f"Template not found: {template_filename}")
-            conn.close()
-            raise HTTPException(status_code=404, detail="Template not found")
-        
-        print(f"Found template: ID={template['id']}, hospital_system={template['hospital_system']}")
+        # Keep the writer only for the row change; the files go once it's committed
+        with pool.write() as db:
+            cursor = db.cursor()
+            
+            # Get the user's hospital system
+            cursor.execute("SELECT hospital_system FROM users WHERE id = ?", (user_id,))
+            user = cursor.fetchone()
+            
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            
+            hospital_system = user['hospital_system']
+            print(f"User's hospital system: {hospital_system}")
+            
+            # Get the template to verify it belongs to the user's hospital system
+            cursor.execute(
+                "SELECT id, html_filename, hospital_system FROM universal_pdfs WHERE original_filename = ?",
+                (template_filename,)
+            )
+            
+            template = cursor.fetchone()
+            
+            if not template:
+                print(f"Template not found: {template_filename}")
+                raise HTTPException(status_code=404, detail="Template not found")
+            
+            print(f"Found template: ID={template['id']}, hospital_system={template['hospital_system']}")
+            
+            # Verify the template belongs to the user's hospital system or has no hospital system
+            if template['hospital_system'] and template['hospital_system'] != hospital_system:
+                print(f"Permission denied: Template belongs to {template['hospital_system']}, user is from {hospital_system}")
+                raise HTTPException(status_code=403, detail="You don't have permission to delete this template")
+            
+            # Delete the template from the database
+            cursor.execute(
+                "DELETE FROM universal_pdfs WHERE id = ?",
+                (template['id'],)
+            )
+            
+            print(f"Deleted template from database: ID={template['id']}, original_filename={template_filename}")
         
-        # Verify the template belongs to the user's hospital system or has no hospital system
-        if template['hospital_system'] and template['hospital_system'] != hospital_system:
-            print(f"Permission denied: Template belongs to {template['hospital_system']}, user is from {hospital_system}")
-            conn.close()
-            raise HTTPException(status_code=403, detail="You don't have permission to delete this template")
+        healthcare_systems_cache.invalidate()
         
         # Delete the HTML file if it exists
         if template['html_filename']:
@@ -1872,29 +1642,24 @@ def delete_template(template_filename: str, user_id: int):
             # Also check the root HTML directory as a fallback
             root_html_path = os.path.join(HTML_OUTPUT_DIR, template['html_filename'])
             
-            # Try to delete from the hospital system directory first
             if os.path.exists(hospital_html_path):
-                os.remove(hospital_html_path)
-                print(f"Deleted HTML file from hospital system directory: {hospital_html_path}")
-            # If not found there, try the root directory
+                remove_files([hospital_html_path])
             elif os.path.exists(root_html_path):
-                os.remove(root_html_path)
-                print(f"Deleted HTML file from root directory: {root_html_path}")
+                remove_files([root_html_path])
             else:
                 print(f"HTML file not found at either location: {hospital_html_path} or {root_html_path}")
-        
-        # Delete the template from the database
-        cursor.execute(
-            "DELETE FROM universal_pdfs WHERE id = ?",
-            (template['id'],)
-        )
-        
-        print(f"Deleted template from database: ID={template['id']}, original_filename={template_filename}")
-        
-        conn.commit()
-        conn.close()
+            
+            template_cache.invalidate(template['html_filename'])
+            
+            # Forms filled from the template are published next to it
+            remove_published_fills(
+                filled_output_pattern(template_name=template['html_filename']),
+                [os.path.dirname(hospital_html_path), HTML_OUTPUT_DIR]
+            )
         
         return {"success": True, "message": f"Template '{template_filename}' deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error deleting template: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to delete template: {str(e)}")
@@ -1938,19 +1703,16 @@ def debug_directory_contents():
         return {"error": str(e)}
 
 @app.get("/api/debug/user-hospital-system/{user_id}")
-def debug_user_hospital_system(user_id: int):
+def debug_user_hospital_system(user_id: int, db: sqlite3.Connection = Depends(get_db)):
     """Debug endpoint to check a user's hospital system"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get the user's hospital system
         cursor.execute("SELECT id, name, email, hospital_system FROM users WHERE id = ?", (user_id,))
         user = cursor.fetchone()
         
         if not user:
-            conn.close()
             return {"error": "User not found", "user_id": user_id}
         
         hospital_system = user['hospital_system']
@@ -1969,8 +1731,6 @@ def debug_user_hospital_system(user_id: int):
         if dir_exists:
             files = [f for f in os.listdir(hospital_dir) if f.endswith('.html')]
         
-        conn.close()
-        
         return {
             "user_id": user['id'],
             "user_name": user['name'],
@@ -1991,12 +1751,10 @@ def test_endpoint():
     return {"status": "ok", "message": "API is working"}
 
 @app.get("/api/debug/database")
-def debug_database():
+def debug_database(db: sqlite3.Connection = Depends(get_db)):
     """Debug endpoint to check the database and tables"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Check if the users table exists
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
@@ -2016,11 +1774,11 @@ def debug_database():
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         tables = [table['name'] for table in cursor.fetchall()]
         
-        conn.close()
-        
         return {
             "database_path": DB_PATH,
             "database_exists": os.path.exists(DB_PATH),
+            "schema_version": current_version(db),
+            "latest_schema_version": LATEST_VERSION,
             "tables": tables,
             "users_table_exists": users_table_exists,
             "universal_pdfs_table_exists": universal_pdfs_table_exists,
@@ -2030,6 +1788,36 @@ def debug_database():
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/api/debug/db-pool")
+def debug_db_pool():
+    """Debug endpoint exposing connection pool statistics for monitoring"""
+    return pool.stats()
+
+@app.get("/api/debug/pdf-cache")
+def debug_pdf_cache():
+    """Debug endpoint exposing parsed PDF cache statistics"""
+    return parsed_form_cache_stats()
+
+@app.get("/api/debug/template-cache")
+def debug_template_cache():
+    """Debug endpoint exposing template HTML cache statistics"""
+    return template_cache.stats()
+
+@app.get("/api/debug/healthcare-systems-cache")
+def debug_healthcare_systems_cache():
+    """Debug endpoint exposing healthcare system summary cache statistics"""
+    return healthcare_systems_cache.stats()
+
+@app.get("/api/debug/blob-store")
+def debug_blob_store():
+    """Debug endpoint exposing blob garbage collector counters"""
+    return blob_collector.stats()
+
+@app.get("/api/debug/llm")
+def debug_llm():
+    """Debug endpoint exposing LLM gateway concurrency and outcome counters"""
+    return llm_gateway.stats()
+
 @app.get("/api/user/{user_id}/templates-test")
 def get_user_templates_test(user_id: int):
     """Simple test endpoint to verify the templates API is working"""
@@ -2048,19 +1836,20 @@ def root():
         "endpoints": [
             "/api/test",
             "/api/debug/database",
+            "/api/debug/db-pool",
+            "/api/debug/pdf-cache",
+            "/api/debug/template-cache",
+            "/api/debug/blob-store",
+            "/api/debug/llm",
             "/api/debug/directory-contents",
             "/api/user/{user_id}/templates",
             "/api/user/{user_id}/filled-forms"
         ]
     }
 
-# Add this after the other global variables
-# Lock for the fill-template endpoint to prevent concurrent calls
-fill_template_locks = {}
-
 # Endpoint to fill a form template with patient and doctor data
 @app.post("/api/fill-template")
-async def fill_template(request: Request):
+async def fill_template(request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     try:
         # Parse the request body
         data = await request.json()
@@ -2073,236 +1862,164 @@ async def fill_template(request: Request):
         if not template_filename or not patient_id or not user_id:
             raise HTTPException(status_code=400, detail="Missing required fields: template_filename, patient_id, or user_id")
         
-        # Create a unique lock key for this template and patient
-        lock_key = f"{template_filename}_{patient_id}_{user_id}"
+        # Identifies this fill in the response and logs
+        request_id = data.get("request_id") or uuid.uuid4().hex
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", str(request_id)):
+            raise HTTPException(status_code=400, detail="request_id must be 1-64 letters, digits, '-' or '_'")
         
-        # Check if there's already a lock for this template and patient
-        if lock_key in fill_template_locks:
-            print(f"fill_template - Another request is already processing this template for this patient. Lock key: {lock_key}")
-            raise HTTPException(status_code=409, detail="Another request is already processing this template for this patient. Please wait and try again.")
+        # Get patient data
+        patient_data = await adb.fetchone(
+            """
+            SELECT * FROM patients WHERE id = ?
+            """,
+            (patient_id,)
+        )
         
-        # Create a lock for this template and patient
-        fill_template_locks[lock_key] = threading.Lock()
+        if not patient_data:
+            raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
         
-        try:
-            # Acquire the lock
-            fill_template_locks[lock_key].acquire()
-            
-            # Connect to the database
-            conn = sqlite3.connect(DB_PATH)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            # Get patient data
-            cursor.execute(
-                """
-                SELECT * FROM patients WHERE id = ?
-                """,
-                (patient_id,)
-            )
-            patient_data = cursor.fetchone()
-            
-            if not patient_data:
-                conn.close()
-                raise HTTPException(status_code=404, detail=f"Patient with ID {patient_id} not found")
-            
-            print(f"fill_template - Found patient: {patient_data['name']}")
-            
-            # Get user (doctor) data
-            cursor.execute(
-                """
-                SELECT * FROM users WHERE id = ?
-                """,
-                (user_id,)
-            )
-            user_data = cursor.fetchone()
-            
-            if not user_data:
-                conn.close()
-                raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-            
-            print(f"fill_template - Found user: {user_data['name']}")
-            
-            # Debug: Print the exact query we're about to run
-            query = f"""
-            SELECT * FROM universal_pdfs WHERE html_filename = '{template_filename}' OR html_filename LIKE '%/{template_filename}'
+        print(f"fill_template - Found patient: {patient_data['name']}")
+        
+        # Get user (doctor) data
+        user_data = await adb.fetchone(
             """
-            print(f"fill_template - Running query: {query}")
-            
-            # Get template information
-            cursor.execute(
-                """
-                SELECT * FROM universal_pdfs WHERE html_filename = ? OR html_filename LIKE ?
-                """,
-                (template_filename, f"%/{template_filename}")
-            )
-            template_data = cursor.fetchone()
-            
-            # Debug: Check if template was found
-            if template_data:
-                print(f"fill_template - Found template: {template_data['original_filename']}")
-                print(f"fill_template - Template data: {dict(template_data)}")
-            else:
-                print(f"fill_template - Template not found for filename: {template_filename}")
-                
-                # Debug: Check if the template exists in the database at all
-                cursor.execute("SELECT html_filename FROM universal_pdfs")
-                all_templates = cursor.fetchall()
-                print(f"fill_template - Available templates in database: {[t['html_filename'] for t in all_templates]}")
-                
-                conn.close()
-                raise HTTPException(status_code=404, detail=f"Template {template_filename} not found")
-            
-            # Construct the full template path
-            hospital_system = user_data["hospital_system"]
-            safe_hospital_system = re.sub(r'[^\w\s-]', '', hospital_system).strip().replace(' ', '_')
-            
-            # Check if the template is in the hospital system directory or root directory
-            template_path = os.path.join(HTML_OUTPUT_DIR, safe_hospital_system, template_filename)
-            print(f"fill_template - Checking template path: {template_path}")
-            
-            if not os.path.exists(template_path):
-                template_path = os.path.join(HTML_OUTPUT_DIR, template_filename)
-                print(f"fill_template - Checking alternative template path: {template_path}")
-                
-                if not os.path.exists(template_path):
-                    # Debug: List files in the directory to see what's available
-                    hospital_dir = os.path.join(HTML_OUTPUT_DIR, safe_hospital_system)
-                    if os.path.exists(hospital_dir):
-                        print(f"fill_template - Files in hospital directory: {os.listdir(hospital_dir)}")
-                    print(f"fill_template - Files in HTML_OUTPUT_DIR: {os.listdir(HTML_OUTPUT_DIR)}")
-                    
-                    conn.close()
-                    raise HTTPException(status_code=404, detail=f"Template file not found at {template_path}")
+            SELECT * FROM users WHERE id = ?
+            """,
+            (user_id,)
+        )
+        
+        if not user_data:
+            raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
+        
+        print(f"fill_template - Found user: {user_data['name']}")
+        
+        # Get template information (html_basename is indexed, so this is a lookup, not a scan)
+        template_data = await adb.fetchone(
+            """
+            SELECT * FROM universal_pdfs WHERE html_basename = ?
+            """,
+            (os.path.basename(template_filename),)
+        )
+        
+        # Debug: Check if template was found
+        if template_data:
+            print(f"fill_template - Found template: {template_data['original_filename']}")
+            print(f"fill_template - Template data: {dict(template_data)}")
+        else:
+            print(f"fill_template - Template not found for filename: {template_filename}")
             
-            print(f"fill_template - Using template path: {template_path}")
+            # Debug: Check if the template exists in the database at all
+            all_templates = await adb.fetchall("SELECT html_filename FROM universal_pdfs")
+            print(f"fill_template - Available templates in database: {[t['html_filename'] for t in all_templates]}")
             
-            # Prepare context data for chain2
-            context_data = {
-                "patient": {
-                    "name": patient_data["name"],
-                    "dob": patient_data["date_of_birth"] if patient_data["date_of_birth"] else "",
-                    "address": "",  # Add address field to patients table if needed
-                    "ethnicity": "",  # Add ethnicity field to patients table if needed
-                    "race": "",  # Add race field to patients table if needed
-                    "preferred_language": "",  # Add language field to patients table if needed
-                    "email": patient_data["email"] if patient_data["email"] else "",
-                    "gender": patient_data["gender"] if patient_data["gender"] else "",
-                    "age": patient_data["age"] if patient_data["age"] else "",
-                    "conditions": patient_data["conditions"] if patient_data["conditions"] else "",
-                    "medications": patient_data["medications"] if patient_data["medications"] else ""
-                },
-                "doctor": {
-                    "name": user_data["name"],
-                    "specialty": user_data["healthcare_title"],
-                    "license": "",  # Add license field to users table if needed
-                    "facility": user_data["hospital_system"]
-                },
-                "practice": {
-                    "name": user_data["hospital_system"],
-                    "address": "",  # Add address field to hospital systems if needed
-                    "phone": ""  # Add phone field to hospital systems if needed
-                },
-                "procedure": {
-                    "type": "",  # This would come from the form or template
-                    "date": datetime.now().strftime("%Y-%m-%d"),
-                    "codes": []
-                }
+            raise HTTPException(status_code=404, detail=f"Template {template_filename} not found")
+        
+        # Find the template in the hospital system directory or root directory
+        # Use the stored name, never the request's, to find the file
+        template = template_cache.get(user_data["hospital_system"], template_data["html_filename"])
+        
+        if template is None:
+            raise HTTPException(status_code=404, detail=f"Template file not found: {template_filename}")
+        
+        template_path = template.path
+        print(f"fill_template - Using template path: {template_path}")
+        
+        # Prepare context data for chain2
+        context_data = {
+            "patient": {
+                "name": patient_data["name"],
+                "dob": patient_data["date_of_birth"] if patient_data["date_of_birth"] else "",
+                "address": "",  # Add address field to patients table if needed
+                "ethnicity": "",  # Add ethnicity field to patients table if needed
+                "race": "",  # Add race field to patients table if needed
+                "preferred_language": "",  # Add language field to patients table if needed
+                "email": patient_data["email"] if patient_data["email"] else "",
+                "gender": patient_data["gender"] if patient_data["gender"] else "",
+                "age": patient_data["age"] if patient_data["age"] else "",
+                "conditions": patient_data["conditions"] if patient_data["conditions"] else "",
+                "medications": patient_data["medications"] if patient_data["medications"] else ""
+            },
+            "doctor": {
+                "name": user_data["name"],
+                "specialty": user_data["healthcare_title"],
+                "license": "",  # Add license field to users table if needed
+                "facility": user_data["hospital_system"]
+            },
+            "practice": {
+                "name": user_data["hospital_system"],
+                "address": "",  # Add address field to hospital systems if needed
+                "phone": ""  # Add phone field to hospital systems if needed
+            },
+            "procedure": {
+                "type": "",  # This would come from the form or template
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "codes": []
             }
-            
-            # Import chain2 function
-            try:
-                from chains.chain2 import chain2
-                print(f"fill_template - Successfully imported chain2 function")
-            except ImportError as e:
-                print(f"fill_template - Error importing chain2: {str(e)}")
-                conn.close()
-                raise HTTPException(status_code=500, detail=f"Error importing chain2: {str(e)}")
-            
-            # Process the template with chain2
-            print(f"fill_template - Calling chain2 with template_path: {template_path}")
-            success, result = chain2(template_path, context_data)
-            
-            if not success:
-                print(f"fill_template - chain2 processing failed: {result}")
-                conn.close()
-                raise HTTPException(status_code=500, detail=f"Error processing template: {result}")
-            
-            print(f"fill_template - chain2 processing succeeded: {result}")
-            
-            # Close the database connection
-            conn.close()
-            
-            # Return the result
-            return result
-            
-        finally:
-            # Release the lock and remove it from the dictionary
-            if lock_key in fill_template_locks:
-                fill_template_locks[lock_key].release()
-                del fill_template_locks[lock_key]
-                print(f"fill_template - Released lock for {lock_key}")
-            
+        }
+        
+        # Import chain2 function
+        try:
+            from chains.chain2 import achain2
+            print(f"fill_template - Successfully imported chain2 function")
+        except ImportError as e:
+            print(f"fill_template - Error importing chain2: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error importing chain2: {str(e)}")
+        
+        # Process the template with chain2, awaiting its model calls on the
+        # loop rather than in a threadpool thread (they are abandoned if the
+        # client disconnects)
+        print(f"fill_template - Calling chain2 with template_path: {template_path}")
+        success, result = await run_cancellable(
+            request, achain2, template_path, context_data, template.html.decode("utf-8"),
+            patient_id, user_id, request_id
+        )
+        
+        if not success:
+            print(f"fill_template - chain2 processing failed: {result}")
+            raise HTTPException(status_code=500, detail=f"Error processing template: {result}")
+        
+        print(f"fill_template - chain2 processing succeeded: {result}")
+        template_cache.invalidate(result["filled_template_filename"])
+        
+        # Return the result
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error filling template: {str(e)}")
-        import traceback
         print(f"Traceback: {traceback.format_exc()}")
-        
-        # Clean up the lock if an exception occurred
-        lock_key = f"{data.get('template_filename')}_{data.get('patient_id')}_{data.get('user_id')}" if 'data' in locals() else None
-        if lock_key and lock_key in fill_template_locks:
-            try:
-                fill_template_locks[lock_key].release()
-            except:
-                pass
-            del fill_template_locks[lock_key]
-            print(f"fill_template - Released lock for {lock_key} after exception")
-            
         raise HTTPException(status_code=500, detail=f"Failed to fill template: {str(e)}")
 
-@app.get("/api/filled-form/{filename}")
-def get_filled_form(filename: str, user_id: int):
+@app.api_route("/api/filled-form/{filename}", methods=["GET", "HEAD"])
+def get_filled_form(filename: str, user_id: int, request: Request, db: sqlite3.Connection = Depends(get_db)):
     """Get the content of a filled HTML form"""
     try:
-        # Connect to the database
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get user data to determine hospital system
         cursor.execute("SELECT hospital_system FROM users WHERE id = ?", (user_id,))
         user = cursor.fetchone()
         
         if not user:
-            conn.close()
             raise HTTPException(status_code=404, detail="User not found")
         
-        hospital_system = user['hospital_system']
-        safe_hospital_system = re.sub(r'[^\w\s-]', '', hospital_system).strip().replace(' ', '_')
-        
-        # Try to find the file in the hospital system directory
-        file_path = os.path.join(HTML_OUTPUT_DIR, safe_hospital_system, filename)
-        if not os.path.exists(file_path):
-            # If not found, try the root directory
-            file_path = os.path.join(HTML_OUTPUT_DIR, filename)
-            if not os.path.exists(file_path):
-                conn.close()
-                raise HTTPException(status_code=404, detail=f"Filled form not found: {filename}")
+        # Look in the hospital system directory, then the root directory
+        filled_form = template_cache.get(user['hospital_system'], filename)
+        if filled_form is None:
+            raise HTTPException(status_code=404, detail=f"Filled form not found: {filename}")
         
-        # Read the HTML content
-        with open(file_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-        
-        conn.close()
-        
-        # Return the HTML content
-        return HTMLResponse(content=html_content, status_code=200)
+        return bytes_response(
+            request, filled_form.html, filled_form.etag, filled_form.last_modified, filled_form.mtime,
+            media_type="text/html", cache_control=HTML_CACHE_CONTROL, variants=filled_form.variants
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting filled form: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get filled form: {str(e)}")
 
 @app.post("/send_form")
-async def send_form(request: Request):
+async def send_form(request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     """
     Handle form submissions and generate filled PDFs.
     Only processes the integer key → value mapping from form fields.
@@ -2324,12 +2041,8 @@ async def send_form(request: Request):
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         filled_filename = f"filled_form_{timestamp}.json"
         
-        # Connect to the database
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Insert into filled_forms table with default values for required fields
-        cursor.execute(
+        result = await adb.execute(
             """
             INSERT INTO filled_forms (user_id, patient_id, pdf_id, filled_data, filled_filename)
             VALUES (?, ?, ?, ?, ?)
@@ -2337,8 +2050,7 @@ async def send_form(request: Request):
             (user_id, patient_id, pdf_id, form_data_json, filled_filename)
         )
         
-        conn.commit()
-        submission_id = cursor.lastrowid
+        submission_id = result.lastrowid
         
         # Generate filled PDF using pdf_utils.py
         try:
@@ -2358,14 +2070,13 @@ async def send_form(request: Request):
                 output_pdf_path = os.path.join(pdf_output_dir, pdf_filename)
                 
                 # Fill the PDF with the form data - direct integer key to value mapping
-                fill_pdf(pdf_path, output_pdf_path, form_data)
+                await run_in_threadpool(fill_pdf, pdf_path, output_pdf_path, form_data)
                 
                 # Update the database with the PDF filename
-                cursor.execute(
+                await adb.execute(
                     "UPDATE filled_forms SET filled_pdf_filename = ? WHERE id = ?",
                     (pdf_filename, submission_id)
                 )
-                conn.commit()
                 print(f"Generated filled PDF: {output_pdf_path}")
                 
                 # Return the PDF URL in the response
@@ -2378,8 +2089,6 @@ async def send_form(request: Request):
             traceback.print_exc()
             pdf_url = None
         
-        conn.close()
-        
         # Return success response with the submission_id and PDF URL
         return {
             "success": True,
@@ -2393,71 +2102,326 @@ async def send_form(request: Request):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Failed to process form submission: {str(e)}")
 
-@app.get("/api/user/{user_id}/filled-forms-json")
-def get_user_filled_forms_json(user_id: int):
-    """Get all filled forms for a user with JSON data"""
-    try:
-        # Connect to the database
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get all filled forms for the user
-        cursor.execute(
-            """
-            SELECT ff.*, p.name as patient_name
-            FROM filled_forms ff
-            LEFT JOIN patients p ON ff.patient_id = p.id
-            WHERE ff.user_id = ?
-            ORDER BY ff.created_at DESC
-            """,
-            (user_id,)
+# Process pool for batch PDF fills. Each worker keeps its own parsed-form and
+# fill plan caches, so a template is compiled once per worker.
+FILL_WORKERS = int(os.getenv("CONFORM_FILL_WORKERS", str(os.cpu_count() or 2)))
+MAX_BATCH_FILLS = int(os.getenv("CONFORM_MAX_BATCH_FILLS", "500"))
+fill_executor = None
+fill_executor_lock = threading.Lock()
+
+# Batches still running, so a batch whose client disconnected isn't
+# garbage-collected before it finishes
+batch_tasks = set()
+
+def get_fill_executor():
+    """Start the fill process pool on first use"""
+    global fill_executor
+    with fill_executor_lock:
+        if fill_executor is None:
+            fill_executor = ProcessPoolExecutor(
+                max_workers=FILL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return fill_executor
+
+@app.on_event("shutdown")
+def stop_fill_executor():
+    """Stop the fill process pool when the server stops"""
+    if fill_executor is not None:
+        fill_executor.shutdown(wait=False, cancel_futures=True)
+
+# Endpoint to fill many copies of a form template at once
+@app.post("/api/fill-batch")
+async def fill_batch(request: Request, adb: AsyncDatabase = Depends(get_async_db)):
+    """
+    Fill a PDF template with many field-value maps in parallel.
+
+    The body is {"originalFilename"?, "userId"?, "patientId"?, "forms": [...]},
+    where each form is either a field-value map or {"patientId", "formData"}.
+    Progress is streamed back as newline-delimited JSON, and every filled_forms
+    row is recorded in a single transaction once the fills finish. The batch
+    runs as its own task, so it is recorded even if the client disconnects.
+    """
+    data = await request.json()
+    forms = data.get('forms')
+    
+    if not isinstance(forms, list) or not forms:
+        raise HTTPException(status_code=400, detail="forms must be a non-empty list")
+    if len(forms) > MAX_BATCH_FILLS:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {MAX_BATCH_FILLS} forms")
+    
+    user_id = data.get('userId', 1)
+    default_patient_id = data.get('patientId', 1)
+    original_filename = data.get('originalFilename')
+    
+    if original_filename:
+        pdf_path = os.path.join(UPLOADS_DIR, os.path.basename(original_filename))
+        pdf = await adb.fetchone(
+            "SELECT id FROM pdfs WHERE original_filename = ? ORDER BY id DESC LIMIT 1",
+            (original_filename,)
         )
+        pdf_id = pdf['id'] if pdf else data.get('pdfId', 1)
+    else:
+        # Same default template as /send_form
+        pdf_path = os.path.join(BASE_DIR, "test_files", "sterilization_form.pdf")
+        pdf_id = data.get('pdfId', 1)
+    
+    if not os.path.exists(pdf_path):
+        raise HTTPException(status_code=404, detail=f"PDF template not found: {os.path.basename(pdf_path)}")
+    
+    entries = []
+    for form in forms:
+        if isinstance(form, dict) and isinstance(form.get('formData'), dict):
+            entries.append((form.get('patientId', default_patient_id), form['formData']))
+        elif isinstance(form, dict):
+            entries.append((default_patient_id, form))
+        else:
+            raise HTTPException(status_code=400, detail="Each form must be an object")
+    
+    pdf_output_dir = os.path.join(HTML_OUTPUT_DIR, "filled_pdfs")
+    os.makedirs(pdf_output_dir, exist_ok=True)
+    batch_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    
+    from pdf_utils import fill_pdf
+    
+    loop = asyncio.get_running_loop()
+    executor = get_fill_executor()
+    events = asyncio.Queue()
+    
+    def record_batch(db, filled):
+        cursor = db.cursor()
+        submission_ids = {}
+        for index, pdf_filename in sorted(filled.items()):
+            patient_id, form_data = entries[index]
+            cursor.execute(
+                """
+                INSERT INTO filled_forms (user_id, patient_id, pdf_id, filled_data, filled_filename, filled_pdf_filename)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (user_id, patient_id, pdf_id, json.dumps(form_data),
+                 f"filled_form_{batch_id}_{index + 1}.json", pdf_filename)
+            )
+            submission_ids[index] = cursor.lastrowid
+        return submission_ids
+    
+    async def fill_one(index, form_data):
+        pdf_filename = f"filled_form_{batch_id}_{index + 1}.pdf"
+        output_pdf_path = os.path.join(pdf_output_dir, pdf_filename)
+        try:
+            await loop.run_in_executor(executor, fill_pdf, pdf_path, output_pdf_path, form_data)
+            return index, pdf_filename, None
+        except Exception as e:
+            return index, None, str(e)
+    
+    async def run_batch():
+        tasks = [asyncio.ensure_future(fill_one(i, form_data)) for i, (_, form_data) in enumerate(entries)]
+        filled = {}
+        errors = []
         
-        filled_forms = []
-        for row in cursor.fetchall():
-            # Parse the filled_data JSON
-            filled_data = json.loads(row['filled_data']) if row['filled_data'] else {}
+        try:
+            for completed, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+                index, pdf_filename, error = await next_done
+                if error:
+                    errors.append({"index": index, "error": error})
+                else:
+                    filled[index] = pdf_filename
+                events.put_nowait(json.dumps({
+                    "event": "progress",
+                    "index": index,
+                    "completed": completed,
+                    "total": len(entries),
+                    "pdfUrl": f"/html_outputs/filled_pdfs/{pdf_filename}" if pdf_filename else None,
+                    "error": error,
+                }) + "\n")
             
-            # Create a filled form object
-            filled_form = {
-                "id": row['id'],
-                "user_id": row['user_id'],
-                "patient_id": row['patient_id'],
-                "patient_name": row['patient_name'],
-                "pdf_id": row['pdf_id'],
-                "filled_data": filled_data,
-                "filled_filename": row['filled_filename'],
-                "created_at": row['created_at']
-            }
+            try:
+                submission_ids = await adb.transaction(record_batch, filled)
+            except Exception as e:
+                # Nothing was recorded, so don't leave the PDFs behind
+                print(f"Error recording batch {batch_id}: {str(e)}")
+                await run_in_threadpool(
+                    remove_files, [os.path.join(pdf_output_dir, name) for name in filled.values()]
+                )
+                events.put_nowait(json.dumps({"event": "error", "error": f"Failed to record filled forms: {str(e)}"}) + "\n")
+                return
             
-            # Add the HTML content if available
-            if row['filled_filename'] and row['filled_filename'].endswith('.html'):
-                try:
-                    html_path = os.path.join(HTML_OUTPUT_DIR, "filled_forms", row['filled_filename'])
-                    if os.path.exists(html_path):
-                        with open(html_path, 'r', encoding='utf-8') as f:
-                            filled_form['html_content'] = f.read()
-                except Exception as e:
-                    print(f"Error reading HTML file: {str(e)}")
+            print(f"Batch {batch_id}: filled {len(filled)} of {len(entries)} forms")
+            events.put_nowait(json.dumps({
+                "event": "done",
+                "batchId": batch_id,
+                "filled": len(filled),
+                "failed": errors,
+                "submissions": [
+                    {
+                        "index": index,
+                        "submission_id": submission_ids[index],
+                        "pdf_url": f"/html_outputs/filled_pdfs/{filled[index]}",
+                    }
+                    for index in sorted(submission_ids)
+                ],
+            }) + "\n")
+        except Exception as e:
+            print(f"Error running batch {batch_id}: {str(e)}")
+            events.put_nowait(json.dumps({"event": "error", "error": f"Batch failed: {str(e)}"}) + "\n")
+        finally:
+            for task in tasks:
+                task.cancel()
+            events.put_nowait(None)
+    
+    # The batch runs independently of the response, which only relays its events
+    batch_task = asyncio.ensure_future(run_batch())
+    batch_tasks.add(batch_task)
+    batch_task.add_done_callback(batch_tasks.discard)
+    
+    async def stream_events():
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+    
+    return StreamingResponse(stream_events(), media_type="application/x-ndjson")
+
+# Rows read per query when streaming filled forms as NDJSON
+STREAM_CHUNK_ROWS = int(os.getenv("CONFORM_STREAM_CHUNK_ROWS", "50"))
+
+# Fields returned by /api/user/{user_id}/filled-forms-json (for fields=)
+FILLED_FORM_JSON_FIELDS = (
+    "id", "user_id", "patient_id", "patient_name", "pdf_id", "filled_data",
+    "filled_filename", "created_at", "html_content", "content_url", "html_url"
+)
+
+def filled_form_html_path(filled_filename):
+    """Path of a filled form's HTML file, or None if it isn't an HTML form"""
+    if filled_filename and filled_filename.endswith('.html'):
+        return os.path.join(HTML_OUTPUT_DIR, "filled_forms", filled_filename)
+    return None
+
+def filled_form_json(row, include_data=True, include_html=True, summary=False):
+    """
+    Shape a filled_forms row (joined with the patient name) for the JSON routes.
+    
+    In summary mode the filled data and HTML are left out and replaced by the
+    URLs they can be fetched from.
+    """
+    filled_form = {
+        "id": row['id'],
+        "user_id": row['user_id'],
+        "patient_id": row['patient_id'],
+        "patient_name": row['patient_name'],
+        "pdf_id": row['pdf_id'],
+    }
+    if not summary:
+        # Parse the filled_data JSON (only if it was asked for)
+        filled_form["filled_data"] = (
+            (json.loads(row['filled_data']) if row['filled_data'] else {}) if include_data else None
+        )
+    filled_form["filled_filename"] = row['filled_filename']
+    filled_form["created_at"] = row['created_at']
+    
+    html_path = filled_form_html_path(row['filled_filename'])
+    if summary:
+        filled_form["content_url"] = f"/api/filled-form-json/{row['id']}"
+        if html_path:
+            filled_form["html_url"] = f"/api/filled-form-json/{row['id']}/html"
+    elif include_html and html_path:
+        # Add the HTML content if available
+        try:
+            if os.path.exists(html_path):
+                with open(html_path, 'r', encoding='utf-8') as f:
+                    filled_form['html_content'] = f.read()
+        except Exception as e:
+            print(f"Error reading HTML file: {str(e)}")
+    return filled_form
+
+@app.get("/api/user/{user_id}/filled-forms-json")
+def get_user_filled_forms_json(
+    user_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    stream: bool = False,
+):
+    """
+    Get a page of filled forms for a user with JSON data.
+    
+    summary=true returns metadata only, with content_url/html_url pointing at
+    the filled data and HTML. stream=true sends the page as NDJSON, one
+    {"event": "form"} line per row, then a {"event": "done"} line carrying
+    nextCursor. Rows are streamed STREAM_CHUNK_ROWS at a time, and the
+    connection is returned to the pool before each chunk is sent, so a slow
+    client never holds a reader.
+    """
+    try:
+        page = Page(limit, cursor, fields, FILLED_FORM_JSON_FIELDS)
+        key_columns = ("ff.created_at", "ff.id")
+        page.where(key_columns)  # rejects a bad cursor before any response is sent
+        wanted = page.fields or set(FILLED_FORM_JSON_FIELDS)
+        
+        def fetch(after, count):
+            condition, condition_params = page.where(key_columns, after=after)
+            with pool.read() as conn:
+                return conn.execute(
+                    f"""
+                    SELECT ff.*, p.name as patient_name
+                    FROM filled_forms ff
+                    LEFT JOIN patients p ON ff.patient_id = p.id
+                    WHERE ff.user_id = ? AND {condition}
+                    ORDER BY ff.created_at DESC, ff.id DESC
+                    LIMIT ?
+                    """,
+                    (user_id, *condition_params, count)
+                ).fetchall()
+        
+        def shape(row):
+            return page.project(filled_form_json(
+                row,
+                include_data="filled_data" in wanted,
+                include_html="html_content" in wanted,
+                summary=summary,
+            ))
+        
+        if stream:
+            def stream_forms():
+                count = 0
+                after = None
+                next_cursor = None
+                while True:
+                    # One extra row shows whether there is more to read
+                    want = STREAM_CHUNK_ROWS if page.limit is None else min(STREAM_CHUNK_ROWS, page.limit - count)
+                    rows = fetch(after, want + 1)
+                    for row in rows[:want]:
+                        yield json.dumps({"event": "form", "form": shape(row)}) + "\n"
+                    count += min(len(rows), want)
+                    if len(rows) <= want:
+                        break
+                    after = (rows[want - 1]['created_at'], rows[want - 1]['id'])
+                    if count == page.limit:
+                        next_cursor = encode_cursor(after)
+                        break
+                yield json.dumps({"event": "done", "count": count, "nextCursor": next_cursor}) + "\n"
             
-            filled_forms.append(filled_form)
+            return StreamingResponse(stream_forms(), media_type="application/x-ndjson")
         
-        conn.close()
+        # Get this page of filled forms for the user
+        rows = fetch(None, page.fetch_size)
+        rows, next_cursor = page.finish(rows, lambda row: (row['created_at'], row['id']))
         
-        return {"filled_forms": filled_forms}
+        filled_forms = [shape(row) for row in rows]
+        
+        return {"filled_forms": filled_forms, "nextCursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting filled forms: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get filled forms: {str(e)}")
 
 @app.get("/api/filled-form-json/{form_id}")
-def get_filled_form_json(form_id: int):
+def get_filled_form_json(form_id: int, db: sqlite3.Connection = Depends(get_db)):
     """Get a specific filled form with JSON data"""
     try:
-        # Connect to the database
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = db.cursor()
         
         # Get the filled form
         cursor.execute(
@@ -2472,41 +2436,34 @@ def get_filled_form_json(form_id: int):
         
         row = cursor.fetchone()
         if not row:
-            conn.close()
             raise HTTPException(status_code=404, detail=f"Filled form with ID {form_id} not found")
         
-        # Parse the filled_data JSON
-        filled_data = json.loads(row['filled_data']) if row['filled_data'] else {}
-        
-        # Create a filled form object
-        filled_form = {
-            "id": row['id'],
-            "user_id": row['user_id'],
-            "patient_id": row['patient_id'],
-            "patient_name": row['patient_name'],
-            "pdf_id": row['pdf_id'],
-            "filled_data": filled_data,
-            "filled_filename": row['filled_filename'],
-            "created_at": row['created_at']
-        }
-        
-        # Add the HTML content if available
-        if row['filled_filename'] and row['filled_filename'].endswith('.html'):
-            try:
-                html_path = os.path.join(HTML_OUTPUT_DIR, "filled_forms", row['filled_filename'])
-                if os.path.exists(html_path):
-                    with open(html_path, 'r', encoding='utf-8') as f:
-                        filled_form['html_content'] = f.read()
-            except Exception as e:
-                print(f"Error reading HTML file: {str(e)}")
-        
-        conn.close()
-        
-        return filled_form
+        return filled_form_json(row)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting filled form: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get filled form: {str(e)}")
 
+@app.api_route("/api/filled-form-json/{form_id}/html", methods=["GET", "HEAD"])
+def get_filled_form_json_html(form_id: int, request: Request, db: sqlite3.Connection = Depends(get_db)):
+    """Get the HTML of a filled form (the html_url of a summary row)"""
+    try:
+        row = db.execute("SELECT filled_filename FROM filled_forms WHERE id = ?", (form_id,)).fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail=f"Filled form with ID {form_id} not found")
+        
+        html_path = filled_form_html_path(row['filled_filename'])
+        if not html_path or not os.path.exists(html_path):
+            raise HTTPException(status_code=404, detail=f"HTML not found for filled form {form_id}")
+        
+        return file_response(request, html_path, media_type="text/html", cache_control=HTML_CACHE_CONTROL)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error getting filled form HTML: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get filled form HTML: {str(e)}")
+
 # Add a CORS middleware specifically for the /send_form endpoint
 @app.middleware("http")
 async def add_cors_headers_for_send_form(request, call_next):
@@ -2535,28 +2492,12 @@ async def add_cors_headers_for_send_form(request, call_next):
     
     return response
 
-@app.get("/api/filled-pdf/{form_id}")
-async def get_filled_pdf(form_id: int, request: Request):
+@app.api_route("/api/filled-pdf/{form_id}", methods=["GET", "HEAD"])
+async def get_filled_pdf(form_id: int, request: Request, adb: AsyncDatabase = Depends(get_async_db)):
     """Get the filled PDF file for a form"""
     try:
-        # Connect to the database
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # First, check if the filled_pdf_filename column exists
-        cursor.execute("PRAGMA table_info(filled_forms)")
-        columns = cursor.fetchall()
-        column_names = [column[1] for column in columns]
-        
-        # If filled_pdf_filename doesn't exist, add it
-        if 'filled_pdf_filename' not in column_names:
-            cursor.execute('ALTER TABLE filled_forms ADD COLUMN filled_pdf_filename TEXT')
-            conn.commit()
-            print("Added filled_pdf_filename column to filled_forms table")
-        
         # Get the filled form record
-        cursor.execute(
+        form = await adb.fetchone(
             """
             SELECT filled_pdf_filename
             FROM filled_forms
@@ -2565,9 +2506,6 @@ async def get_filled_pdf(form_id: int, request: Request):
             (form_id,)
         )
         
-        form = cursor.fetchone()
-        conn.close()
-        
         if not form or not form['filled_pdf_filename']:
             raise HTTPException(status_code=404, detail=f"Filled PDF not found for form ID {form_id}")
         
@@ -2577,55 +2515,104 @@ async def get_filled_pdf(form_id: int, request: Request):
         if not os.path.exists(pdf_path):
             raise HTTPException(status_code=404, detail=f"PDF file not found: {form['filled_pdf_filename']}")
         
-        # For HEAD requests, just return a 200 OK response
-        if request.method == "HEAD":
-            return Response(status_code=200)
-        
-        # For GET requests, return the file
-        return Response(
-            content=open(pdf_path, "rb").read(),
+        # Stream the file (HEAD and Range requests are handled without reading it all)
+        return file_response(
+            request, pdf_path,
             media_type="application/pdf",
-            headers={
-                "Content-Disposition": f"attachment; filename={form['filled_pdf_filename']}"
-            }
+            filename=form['filled_pdf_filename'],
+            disposition="attachment"
         )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting filled PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get filled PDF: {str(e)}")
 
-@app.get("/api/pdf-preview")
-async def get_pdf_preview(path: str):
+@app.api_route("/api/pdf-preview", methods=["GET", "HEAD"])
+async def get_pdf_preview(path: str, request: Request):
     """Serve a PDF file from an absolute path"""
     try:
         # Check if the file exists
         if not os.path.exists(path):
             raise HTTPException(status_code=404, detail=f"PDF file not found: {path}")
         
-        # Read the file
-        with open(path, "rb") as f:
-            content = f.read()
-        
-        # Return the file as a response
-        return Response(
-            content=content,
-            media_type="application/pdf",
-            headers={
-                "Content-Disposition": f"inline; filename={os.path.basename(path)}"
-            }
-        )
+        # Stream the file rather than reading it into memory
+        return file_response(request, path, media_type="application/pdf", filename=os.path.basename(path))
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error serving PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to serve PDF: {str(e)}")
 
+# Endpoint to export filled PDFs as a ZIP archive
+@app.get("/api/export/filled-pdfs")
+async def export_filled_pdfs(
+    user_id: Optional[int] = None,
+    patient_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    adb: AsyncDatabase = Depends(get_async_db)
+):
+    """
+    Stream a ZIP of the filled PDFs for a user and/or patient, optionally
+    limited to forms created between start_date and end_date (YYYY-MM-DD).
+    """
+    if user_id is None and patient_id is None:
+        raise HTTPException(status_code=400, detail="user_id or patient_id is required")
+    
+    conditions = ["ff.filled_pdf_filename IS NOT NULL"]
+    params = []
+    if user_id is not None:
+        conditions.append("ff.user_id = ?")
+        params.append(user_id)
+    if patient_id is not None:
+        conditions.append("ff.patient_id = ?")
+        params.append(patient_id)
+    try:
+        if start_date:
+            conditions.append("ff.created_at >= ?")
+            params.append(datetime.strptime(start_date, "%Y-%m-%d").strftime("%Y-%m-%d %H:%M:%S"))
+        if end_date:
+            conditions.append("ff.created_at < ?")
+            params.append((datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    
+    rows = await adb.fetchall(
+        f"""
+        SELECT ff.id, ff.patient_id, ff.filled_pdf_filename
+        FROM filled_forms ff
+        WHERE {' AND '.join(conditions)}
+        ORDER BY ff.created_at, ff.id
+        """,
+        tuple(params)
+    )
+    
+    pdf_output_dir = os.path.join(HTML_OUTPUT_DIR, "filled_pdfs")
+    
+    def archive_entries():
+        # Checked lazily so a file removed mid-export is skipped, not fatal
+        for row in rows:
+            pdf_filename = os.path.basename(row['filled_pdf_filename'])
+            pdf_path = os.path.join(pdf_output_dir, pdf_filename)
+            if os.path.exists(pdf_path):
+                yield f"patient_{row['patient_id']}/{row['id']}_{pdf_filename}", pdf_path
+            else:
+                print(f"Skipping missing filled PDF in export: {pdf_filename}")
+    
+    scope = f"user_{user_id}" if user_id is not None else f"patient_{patient_id}"
+    export_name = f"filled_pdfs_{scope}_{datetime.now().strftime('%Y%m%d%H%M%S')}.zip"
+    
+    return StreamingResponse(
+        iter_zip(archive_entries()),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={export_name}"}
+    )
+
 # Add this endpoint right after the get_filled_pdf endpoint
 
 if __name__ == "__main__":
-    # Create hospital system directories at startup
-    create_hospital_system_directories()
-    
-    # Initialize the database
-    init_db()
-    
+    # Migrations and hospital system directories run in the startup hooks
     # Run the FastAPI app with uvicorn on port 6969
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=6969)
\ No newline at end of file
@@ -0,0 +1,230 @@
+import os
+import re
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from precompress import negotiate
+
+# Bytes read from disk at a time when streaming files
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipStream:
+    """
+    Write-only file object that collects what zipfile writes so it can be
+    handed to the client and discarded.
+
+    It has no tell/seek, so zipfile writes each member with a trailing data
+    descriptor instead of seeking back to patch its header.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Return everything written since the last drain"""
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        return chunk
+
+
+def iter_zip(files, compression=zipfile.ZIP_DEFLATED):
+    """
+    Build a ZIP archive incrementally, yielding it chunk by chunk.
+
+    Files are read CHUNK_SIZE bytes at a time, so memory stays bounded no
+    matter how many files or how large the archive is.
+
+    Args:
+        files: Iterable of (archive_name, file_path) pairs
+        compression: zipfile compression method
+
+    Yields:
+        bytes: The next piece of the archive
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, mode="w", compression=compression) as archive:
+        for archive_name, file_path in files:
+            with open(file_path, "rb") as source, archive.open(archive_name, "w", force_zip64=True) as member:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    member.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+            data = stream.drain()
+            if data:
+                yield data
+    # Central directory
+    yield stream.drain()
+
+
+def iter_file(file_path, start=0, length=None):
+    """Yield a file (or a byte range of it) CHUNK_SIZE bytes at a time"""
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def file_etag(stat_result):
+    """Strong validator for a file version, derived from its mtime and size"""
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def parse_range(range_header, file_size):
+    """
+    Parse a single-range Range header.
+
+    Returns:
+        (start, end) inclusive byte offsets, None to serve the whole file
+        (no header, or multiple/unsupported ranges), or False if the range
+        can't be satisfied
+    """
+    if not range_header:
+        return None
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(file_size - length, 0), file_size - 1
+
+    start = int(first)
+    end = min(int(last), file_size - 1) if last else file_size - 1
+    if start >= file_size or start > end:
+        return False
+    return start, end
+
+
+def is_not_modified(request, etag, mtime):
+    """
+    Check a request's validators against the current version of a resource.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110.
+    ETags are compared weakly, which is what GET and HEAD call for.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        current = etag.removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") == current for tag in if_none_match.split(","))
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def file_response(request, file_path, media_type, filename=None, disposition="inline", headers=None, cache_control=None):
+    """
+    Serve a file from disk without reading it into memory.
+
+    Full responses go through FileResponse, which streams the file in chunks.
+    Single byte ranges are answered with 206, HEAD requests get headers only,
+    and every response carries an ETag and Last-Modified derived from the
+    file's stat. A request whose If-None-Match or If-Modified-Since still
+    matches gets a 304, so revalidating costs a stat and no read.
+
+    Args:
+        request: The incoming request (for Range, If-Range and the method)
+        file_path: Path to the file
+        media_type: Content type to send
+        filename: Name for the Content-Disposition header, if any
+        disposition: "inline" or "attachment"
+        headers: Extra response headers
+        cache_control: Cache-Control policy to send, if any
+    """
+    stat_result = os.stat(file_path)
+    file_size = stat_result.st_size
+    etag = file_etag(stat_result)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+
+    validators = {"etag": etag, "last-modified": last_modified}
+    if cache_control:
+        validators["cache-control"] = cache_control
+
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=validators)
+
+    response_headers = {"accept-ranges": "bytes", **validators}
+    if filename:
+        response_headers["content-disposition"] = f"{disposition}; filename={filename}"
+    response_headers.update(headers or {})
+
+    byte_range = parse_range(request.headers.get("range"), file_size)
+    if_range = request.headers.get("if-range")
+    if byte_range is not None and if_range and if_range not in (etag, last_modified):
+        # The client's copy is stale, so it needs the whole file
+        byte_range = None
+
+    head_only = request.method == "HEAD"
+
+    if byte_range is None:
+        if head_only:
+            response_headers["content-length"] = str(file_size)
+            return Response(status_code=200, headers=response_headers, media_type=media_type)
+        return FileResponse(file_path, media_type=media_type, headers=response_headers, stat_result=stat_result)
+
+    if byte_range is False:
+        return Response(status_code=416, headers={"content-range": f"bytes */{file_size}"})
+
+    start, end = byte_range
+    response_headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+    response_headers["content-length"] = str(end - start + 1)
+    if head_only:
+        return Response(status_code=206, headers=response_headers, media_type=media_type)
+    return StreamingResponse(
+        iter_file(file_path, start, end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=response_headers,
+    )
+
+
+def bytes_response(request, body, etag, last_modified, mtime, media_type, cache_control=None, variants=None):
+    """
+    Serve an in-memory copy of a file with the same validators file_response
+    would send, answering a still-valid conditional request with a 304.
+
+    If variants ({encoding: (body, etag)}) are given, the best one the
+    client's Accept-Encoding allows is sent instead, with its own ETag.
+    """
+    encoding = negotiate(request.headers.get("accept-encoding"), variants)
+    if encoding:
+        body, etag = variants[encoding]
+
+    validators = {"etag": etag, "last-modified": last_modified}
+    if cache_control:
+        validators["cache-control"] = cache_control
+    if variants is not None:
+        validators["vary"] = "Accept-Encoding"
+
+    if is_not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=validators)
+    if encoding:
+        validators["content-encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=validators)
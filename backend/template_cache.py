@@ -0,0 +1,164 @@
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from email.utils import formatdate
+
+from precompress import fresh_variants
+from streaming import file_etag
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HTML_OUTPUT_DIR = os.path.join(BASE_DIR, "html_outputs")
+
+# Upper bound on the HTML held in memory (overridable from the environment)
+TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("CONFORM_TEMPLATE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# A cached HTML file: its bytes plus the validators used for conditional GETs,
+# and its pre-compressed variants as {encoding: (bytes, etag)}
+TemplateEntry = namedtuple("TemplateEntry", ["path", "html", "etag", "last_modified", "mtime", "version", "variants"])
+
+
+def _entry_size(entry):
+    return len(entry.html) + sum(len(body) for body, _ in entry.variants.values())
+
+
+def safe_hospital_system_dir(hospital_system):
+    """Directory name used for a hospital system under html_outputs"""
+    return re.sub(r'[^\w\s-]', '', hospital_system or '').strip().replace(' ', '_')
+
+
+class TemplateHTMLCache:
+    """
+    Byte-bounded LRU of template HTML keyed by (hospital system, html filename).
+
+    Entries remember which file they came from, so a hit skips the
+    hospital-directory/root-directory lookup. Every hit still stats that file,
+    which catches files rewritten by another process (such as a job worker),
+    and writers in this process invalidate entries explicitly.
+    """
+
+    def __init__(self, html_output_dir=HTML_OUTPUT_DIR, max_bytes=TEMPLATE_CACHE_MAX_BYTES):
+        self.html_output_dir = html_output_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+
+    def _key(self, hospital_system, html_filename):
+        # html_filename is either a bare name or "<hospital dir>/<name>" as
+        # stored in universal_pdfs.html_filename. Names that would resolve
+        # outside the outputs root (e.g. "../x") get no key.
+        directory, name = os.path.split(html_filename or "")
+        directory = directory or safe_hospital_system_dir(hospital_system)
+        if name in ("", ".", ".."):
+            return None
+        root = os.path.realpath(self.html_output_dir)
+        for path in (os.path.join(root, directory, name), os.path.join(root, name)):
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                return None
+        return directory, name
+
+    def _resolve(self, key):
+        """Find the file for a key: the hospital system directory first, then the root"""
+        directory, name = key
+        candidates = [os.path.join(self.html_output_dir, name)]
+        if directory:
+            candidates.insert(0, os.path.join(self.html_output_dir, directory, name))
+        for path in candidates:
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= _entry_size(entry)
+
+    def get(self, hospital_system, html_filename):
+        """
+        Return the TemplateEntry for a template, reading it from disk on a miss.
+
+        Returns:
+            TemplateEntry or None if the file doesn't exist
+        """
+        key = self._key(hospital_system, html_filename)
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            try:
+                stat_result = os.stat(entry.path)
+                version = (stat_result.st_mtime_ns, stat_result.st_size)
+            except FileNotFoundError:
+                version = None
+            with self._lock:
+                if version == entry.version:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry
+                self._stats["stale"] += 1
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+
+        with self._lock:
+            self._stats["misses"] += 1
+
+        path = self._resolve(key)
+        if path is None:
+            return None
+
+        with open(path, "rb") as f:
+            stat_result = os.fstat(f.fileno())
+            html = f.read()
+
+        variants = {}
+        for encoding, (variant_path, variant_stat) in fresh_variants(path, stat_result).items():
+            with open(variant_path, "rb") as f:
+                variants[encoding] = (f.read(), file_etag(variant_stat))
+
+        entry = TemplateEntry(
+            path, html, file_etag(stat_result),
+            formatdate(stat_result.st_mtime, usegmt=True), stat_result.st_mtime,
+            (stat_result.st_mtime_ns, stat_result.st_size), variants,
+        )
+
+        size = _entry_size(entry)
+        if size <= self.max_bytes:
+            with self._lock:
+                self._drop(key)
+                self._entries[key] = entry
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= _entry_size(evicted)
+                    self._stats["evictions"] += 1
+        return entry
+
+    def invalidate(self, html_filename=None):
+        """Drop every entry for an html filename (in any hospital system), or everything"""
+        with self._lock:
+            if html_filename is None:
+                keys = list(self._entries)
+            else:
+                name = os.path.basename(html_filename)
+                keys = [key for key in self._entries if key[1] == name]
+            for key in keys:
+                self._drop(key)
+            self._stats["invalidations"] += len(keys)
+
+    def stats(self):
+        """Return cache counters for monitoring"""
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+            }
+
+
+# Process-wide cache shared by the HTML routes and chain1
+template_cache = TemplateHTMLCache()